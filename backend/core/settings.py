@@ -60,7 +60,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'store.middleware.AuthenticationMiddleware',
-    'store.middleware.TrackStatusMiddleware',
+    'store.middleware.SpotifyTokenMiddleware',
 ]
 
 CORS_ALLOWED_ORIGINS = [
@@ -124,6 +124,41 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+
+CACHES = {
+    # per-process entries derived from the database (vault deadlines and vaulted-id indexes),
+    # they're stamped with the version they match so locmem is fine with several processes
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+    # spotify response cache, locmem evicts least recently used entries at MAX_ENTRIES
+    'spotify': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'spotify',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+            'CULL_FREQUENCY': 10,  # drop the oldest 10% when full
+        },
+    },
+}
+
+# seconds to keep each spotify endpoint cached, 0 disables caching for it
+SPOTIFY_CACHE_TTLS = {
+    'track': 60 * 60 * 24,  # catalog, shared across users
+    'search': 60 * 10,
+    'recommendations': 60 * 60,
+    'me/playlists': 60,  # per user
+    'me/top/tracks': 60 * 60,
+    'me/tracks': 60 * 5,
+    'me/player/recently-played': 60 * 2,  # only for excluding recent plays, the widget stays live
+}
+
+# typeahead search
+SEARCH_SETTINGS = {
+    'PREFIX_MIN_LENGTH': 3,  # shortest cached query whose complete results can answer a longer one
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -172,11 +207,95 @@ SPOTIFY_CLIENT_ID = env('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = env('SPOTIFY_CLIENT_SECRET')
 SPOTIFY_REDIRECT_URI = env('SPOTIFY_REDIRECT_URI')
 
+# Spotify HTTP client settings (shared keep-alive pool, one per process)
+SPOTIFY_HTTP = {
+    'POOL_CONNECTIONS': 4,  # number of hosts to keep pools for
+    'POOL_MAXSIZE': 32,  # keep-alive connections per host, size to worker threads
+    'POOL_BLOCK': False,  # open extra connections instead of waiting when the pool is full
+    'ASYNC_MAX_CONNECTIONS': 200,  # in-flight calls per event loop for the async client
+    'BATCH_CONCURRENCY': 4,  # concurrent chunk requests for multi-id lookups
+    'CONNECT_TIMEOUT': 3.05,  # seconds
+    'READ_TIMEOUT': 10,  # seconds
+    'AUTH_HEADER': 'Authorization',
+    'AUTH_SCHEME': 'Bearer',
+}
+
+# Spotify request scheduler (rate limits, 429 retries, circuit breaker)
+SPOTIFY_RATE_LIMIT = {
+    'APP_RATE': 50,  # requests per second across the app, per process
+    'APP_BURST': 100,
+    'USER_RATE': 5,  # requests per second per user
+    'USER_BURST': 20,
+    'TRACKED_USERS': 10000,  # per-user buckets kept in memory (lru)
+    'MAX_QUEUE_WAIT': 5,  # seconds a call may wait for budget (or Retry-After) before failing with 429
+    'MAX_RETRIES': 3,
+    'RETRY_BACKOFF': 0.5,  # seconds, doubled per attempt for 5xx/connection errors
+    'RETRY_JITTER': 0.5,  # seconds of random jitter added to every retry
+    'BREAKER_FAILURES': 5,  # consecutive failures that open the circuit
+    'BREAKER_RESET_SECONDS': 30,
+}
+
+# Spotify token settings
+SPOTIFY_TOKEN_SETTINGS = {
+    'REFRESH_MARGIN_SECONDS': 300,  # refresh this long before expires_at
+    'REFRESHER_INTERVAL_SECONDS': 60,  # background refresher poll, keep below the margin
+}
+
 # Track settings
 TRACK_SETTINGS = {
     'DEVELOPMENT_MODE': DEBUG,  # tie to debug mode
     'DEVELOPMENT_LOCK_DAYS': 1,  # 1 day for testing
     'PRODUCTION_LOCK_WEEKS': 2,  # 2 weeks for production
+    'TRANSITION_MAX_SLEEP_SECONDS': 300,  # longest the transition engine sleeps between checks
+    'CHECK_MAX_IDS': 1000,  # spotify ids per tracks/check request
+    'BULK_MAX_ITEMS': 500,  # tracks per bulk create/transition request
+    'EXPORT_CHUNK_SIZE': 2000,  # rows fetched per round trip when exporting a vault
+    'IMPORT_BATCH_SIZE': 500,  # tracks upserted per statement when importing
+    'IMPORT_MAX_ERRORS': 50,  # invalid lines reported back, the rest are only counted
+}
+
+RECOMMENDATION_SETTINGS = {
+    'BURIED_TTL_SECONDS': 60 * 60 * 6,  # how long a precomputed candidate list is served
+    'BURIED_MAX_CANDIDATES': 100,  # stored per user, vaulted ones are dropped on read
+    'BURIED_PAGE_SIZE': 20,  # returned per request
+    'SAVED_TRACKS_SCAN': 200,  # saved tracks looked at when computing
+    'REFRESH_INTERVAL_SECONDS': 60 * 10,  # between passes of the precompute worker
+    'UNIQUE_DEFAULT_LIMIT': 20,  # unique recommendations returned by default
+    'UNIQUE_MAX_LIMIT': 50,
+    'UNIQUE_OVERFETCH': 3,  # ask spotify for this many times the limit before filtering
+}
+
+LISTENING_SETTINGS = {
+    'INGEST_INTERVAL_SECONDS': 60 * 5,  # between recently-played ingestion passes
+    'REDISCOVERED_LIMIT': 20,  # tracks returned by the rediscovered endpoint
+}
+
+# server-sent vault events, streamed from the async view under core/asgi.py
+VAULT_EVENT_SETTINGS = {
+    'RETENTION_SECONDS': 60 * 10,  # how long events stay replayable for reconnecting clients
+    'PRUNE_EVERY': 500,  # every nth publish deletes the events past retention
+    'MAX_REPLAY': 500,  # events replayed at most, a longer gap makes the client reload
+    'POLL_INTERVAL_SECONDS': 1,  # how often each process checks the log for new events, one indexed query
+    'GAP_TIMEOUT_SECONDS': 5,  # how long a skipped id, maybe an uncommitted write, holds back later events
+    'HEARTBEAT_SECONDS': 15,
+    'MAX_STREAM_SECONDS': 60 * 5,  # streams are closed and resumed, so dead connections don't pile up
+    'RETRY_MS': 3000,  # browser reconnect delay
+    'QUEUE_SIZE': 100,  # undelivered events per stream before it's told to reload
+}
+
+# bulk reveal of available tracks into the user's playlist
+REVEAL_JOB_SETTINGS = {
+    'BATCH_SIZE': 500,  # tracks per step, written to spotify 100 uris per call
+    'POLL_INTERVAL_SECONDS': 5,  # between queue checks when running as a worker
+    'STALE_AFTER_SECONDS': 60 * 5,  # running jobs without a heartbeat this long are picked up again
+}
+
+# background refresh of track metadata from spotify
+METADATA_REFRESH = {
+    'MAX_AGE_DAYS': 30,  # refresh every row at least this often
+    'INCOMPLETE_MAX_AGE_DAYS': 1,  # rows missing a release date or cover art retry sooner
+    'BATCH_SIZE': 500,  # rows per pass step, fetched 50 ids per spotify call
+    'INTERVAL_SECONDS': 60 * 60,  # between passes when running as a worker
 }
 
 # Logging configuration
@@ -200,5 +319,17 @@ LOGGING = {
             'handlers': ['console'],
             'level': 'INFO',
         },
+        'store.services.transitions': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'store.management.commands.refresh_track_metadata': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'store.migrations': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
     },
 }
@@ -1,5 +1,6 @@
 from django.contrib import admin
 from store.models.track import TrackMetadata, Track
+from store.services.vault import vault_versions
 
 @admin.register(TrackMetadata)
 class TrackMetadataAdmin(admin.ModelAdmin):
@@ -18,4 +19,21 @@ class TrackAdmin(admin.ModelAdmin):
 
     def get_title(self, obj):
         return f"{obj.metadata.title} - {obj.metadata.artist}"
-    get_title.short_description = 'Track' 
\ No newline at end of file
+    get_title.short_description = 'Track'
+
+    # admin edits count as vault writes too
+    def save_model(self, request, obj, form, change):
+        # user or metadata may have changed, let the locked-id index rebuild
+        if change and 'user' in form.changed_data:
+            vault_versions.bump(form.initial['user'], reindex=True)
+        super().save_model(request, obj, form, change)
+        vault_versions.bump(obj.user_id, reindex=True)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        vault_versions.bump(obj.user_id, reindex=True)
+
+    def delete_queryset(self, request, queryset):
+        user_ids = list(queryset.values_list('user_id', flat=True))
+        super().delete_queryset(request, queryset)
+        vault_versions.bump_many(user_ids) 
\ No newline at end of file
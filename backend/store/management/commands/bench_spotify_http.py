@@ -0,0 +1,99 @@
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.core.management.base import BaseCommand
+
+from store.services.spotify import SpotifyService
+
+SEARCH_RESPONSE = json.dumps({
+    'tracks': {
+        'items': [
+            {
+                'id': f'track{i}',
+                'name': f'Track {i}',
+                'artists': [{'name': 'Artist'}],
+                'album': {'name': 'Album', 'images': [], 'release_date': '2024-01-01'},
+                'preview_url': None,
+            }
+            for i in range(15)
+        ]
+    }
+}).encode()
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    """minimal spotify stand-in that supports keep-alive"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(SEARCH_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(SEARCH_RESPONSE)
+
+    def log_message(self, format, *args):
+        pass  # keep benchmark output clean
+
+class Command(BaseCommand):
+    help = 'Benchmark per-call spotify latency with and without the pooled session against a local fake server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=500, help='calls per mode')
+        parser.add_argument('--latency-ms', type=float, default=0, help='artificial server think time')
+
+    def handle(self, *args, **options):
+        calls = options['calls']
+        latency = options['latency_ms'] / 1000
+
+        if latency:
+            original_get = FakeSpotifyHandler.do_GET
+
+            def delayed_get(handler):
+                time.sleep(latency)
+                original_get(handler)
+            FakeSpotifyHandler.do_GET = delayed_get
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSpotifyHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        base_url = f'http://127.0.0.1:{server.server_port}/v1'
+
+        try:
+            # before: module-level requests call, new connection every time
+            def unpooled():
+                requests.get(
+                    f'{base_url}/search',
+                    headers={'Authorization': 'Bearer bench'},
+                    params={'q': 'bench', 'type': 'track', 'limit': 15}
+                ).json()
+
+            # after: service call through the shared keep-alive pool
+            spotify = SpotifyService('bench')
+            spotify.BASE_URL = base_url
+
+            def pooled():
+                spotify.search_tracks('bench')
+
+            for label, call in [('unpooled (before)', unpooled), ('pooled (after)', pooled)]:
+                call()  # warm up
+                timings = []
+                for _ in range(calls):
+                    start = time.perf_counter()
+                    call()
+                    timings.append((time.perf_counter() - start) * 1000)
+                timings.sort()
+                self.stdout.write(
+                    f"{label:<20} mean {statistics.mean(timings):.3f}ms  "
+                    f"p50 {timings[len(timings) // 2]:.3f}ms  "
+                    f"p95 {timings[int(len(timings) * 0.95)]:.3f}ms"
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.stdout.write(self.style.SUCCESS(f'Benchmarked {calls} calls per mode'))
@@ -0,0 +1,83 @@
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from store.models.track import Track, TrackMetadata
+from store.renderers import FastJSONRenderer
+from store.serializers.track import TrackSerializer, TrackRowSerializer
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = 'Benchmark track list serialization, drf serializers vs the value-row fast path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000, help='tracks in the benchmark vault')
+        parser.add_argument('--repeat', type=int, default=5, help='runs per mode, best one is reported')
+
+    def handle(self, *args, **options):
+        # everything happens in a transaction that is rolled back at the end
+        try:
+            with transaction.atomic():
+                self.run(options['rows'], options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run(self, rows, repeat):
+        user = User.objects.create(username=f'bench-{time.time_ns()}')
+        now = timezone.now()
+        metadata = TrackMetadata.objects.bulk_create([
+            TrackMetadata(
+                spotify_id=f'bench{i}',
+                title=f'Track {i} — Live',
+                artist='Artist',
+                album='Album',
+                preview_url=None if i % 3 else f'https://p.scdn.co/mp3-preview/{i}',
+                image_url=f'https://i.scdn.co/image/{i}',
+                release_date='2024-01-01',
+            )
+            for i in range(rows)
+        ])
+        Track.objects.bulk_create([
+            Track(
+                user=user,
+                metadata=item,
+                status=['pending', 'available', 'revealed'][i % 3],
+                locked_at=now - timedelta(days=30),
+                available_at=now + timedelta(days=(i % 14) - 7),
+                revealed_at=now if i % 3 == 2 else None,
+            )
+            for i, item in enumerate(metadata)
+        ])
+        queryset = Track.objects.filter(user=user).order_by('-created_at', '-id')
+
+        # before: model instances through TrackSerializer and the stdlib renderer
+        def drf():
+            data = TrackSerializer(queryset.select_related('metadata'), many=True).data
+            return JSONRenderer().render(data)
+
+        # after: named value rows and the orjson renderer
+        def fast():
+            serializer = TrackRowSerializer()
+            return FastJSONRenderer().render(serializer.serialize(serializer.rows(queryset)))
+
+        if drf() != fast():
+            raise CommandError('fast path output differs from TrackSerializer')
+
+        for label, call in [('drf serializer (before)', drf), ('value rows (after)', fast)]:
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                call()
+                timings.append(time.perf_counter() - start)
+            best = min(timings)
+            self.stdout.write(f'{label:<24} {best * 1000:.1f}ms  {rows / best:,.0f} rows/sec')
+
+        self.stdout.write(self.style.SUCCESS(f'Benchmarked {rows} rows, output is byte-identical'))
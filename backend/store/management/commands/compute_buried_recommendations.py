@@ -0,0 +1,50 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+from store.models.spotify import SpotifyToken
+from store.services.recommendations import RecommendationService
+from store.services.spotify import SpotifyService
+
+class Command(BaseCommand):
+    help = 'Precompute buried recommendations for users whose list is missing or about to expire'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='keep running as a background worker')
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=settings.RECOMMENDATION_SETTINGS['REFRESH_INTERVAL_SECONDS'],
+            help='seconds between passes when looping'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            self.compute_due(options['interval'])
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def compute_due(self, interval):
+        # recompute anything that would expire before the next pass
+        horizon = timezone.now() + timedelta(seconds=interval)
+        tokens = SpotifyToken.objects.filter(
+            Q(user__buriedrecommendations__isnull=True)
+            | Q(user__buriedrecommendations__expires_at__lte=horizon)
+        )
+
+        computed = failed = 0
+        for token in tokens.iterator():
+            try:
+                spotify = SpotifyService(token.get_valid_access_token(), user_id=token.user_id)
+                RecommendationService.compute_buried(spotify, token.user_id)
+                computed += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Failed to compute recommendations for user {token.user_id}: {str(e)}")
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Computed buried recommendations for {computed} users ({failed} failed)')
+        )
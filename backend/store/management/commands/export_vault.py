@@ -0,0 +1,28 @@
+import sys
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from store.services.backup import VaultBackupService
+
+class Command(BaseCommand):
+    help = "Export a user's vault as ndjson, one track per line"
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--output', help='file to write, defaults to stdout')
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['username']).first()
+        if user is None:
+            raise CommandError(f"User {options['username']} does not exist")
+
+        output = open(options['output'], 'w') if options['output'] else sys.stdout
+        exported = 0
+        try:
+            for line in VaultBackupService.export_lines(user.id):
+                output.write(line)
+                exported += 1
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        # stderr, so stdout stays a clean export
+        self.stderr.write(f'Exported {exported} tracks for {user.username}')
@@ -3,6 +3,7 @@ from django.utils import timezone
 from datetime import timedelta
 from django.conf import settings
 from store.models.track import Track
+from store.services.vault import vault_versions
 
 class Command(BaseCommand):
     help = 'Fix tracks with missing available_at dates'
@@ -26,6 +27,7 @@ class Command(BaseCommand):
         for track in tracks:
             track.available_at = track.locked_at + locked_time
             track.save()
+            vault_versions.bump(track.user_id)
             count += 1
             self.stdout.write(f"Fixed track {track.id}: available_at set to {track.available_at}")
         
@@ -0,0 +1,42 @@
+import sys
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from store.services.backup import VaultBackupService
+from store.services.vault import vault_versions
+
+class Command(BaseCommand):
+    help = "Import an ndjson vault export into a user's vault"
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--input', help='file to read, defaults to stdin')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.TRACK_SETTINGS['IMPORT_BATCH_SIZE'],
+            help='tracks upserted per statement'
+        )
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['username']).first()
+        if user is None:
+            raise CommandError(f"User {options['username']} does not exist")
+
+        source = open(options['input']) if options['input'] else sys.stdin
+        try:
+            result = VaultBackupService.import_lines(user.id, source, options['batch_size'])
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        if result['created'] or result['updated']:
+            vault_versions.bump(user.id, reindex=True)
+
+        for error in result['errors']:
+            self.stderr.write(f"Line {error['line']}: {error['errors']}")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported tracks for {user.username}: {result['created']} created, {result['updated']} updated, "
+                f"{result['unchanged']} unchanged, {result['invalid']} invalid"
+            )
+        )
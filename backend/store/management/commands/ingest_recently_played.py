@@ -0,0 +1,40 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from store.models.spotify import SpotifyToken
+from store.services.listening import ListeningHistoryService
+from store.services.spotify import SpotifyService
+
+class Command(BaseCommand):
+    help = "Ingest each user's recently played history since their cursor and record played_at on vault tracks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='keep running as a background worker')
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=settings.LISTENING_SETTINGS['INGEST_INTERVAL_SECONDS'],
+            help='seconds between passes when looping'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            self.ingest_all()
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def ingest_all(self):
+        users = updated = failed = 0
+        for token in SpotifyToken.objects.iterator():
+            try:
+                spotify = SpotifyService(token.get_valid_access_token(), user_id=token.user_id)
+                updated += ListeningHistoryService.ingest(spotify, token.user_id)
+                users += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Failed to ingest plays for user {token.user_id}: {str(e)}")
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Ingested plays for {users} users, {updated} tracks updated ({failed} failed)')
+        )
@@ -0,0 +1,42 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from store.models.spotify import SpotifyToken, refresh_margin
+
+class Command(BaseCommand):
+    help = 'Proactively refresh spotify tokens that are about to expire'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='keep running as a background refresher')
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=settings.SPOTIFY_TOKEN_SETTINGS['REFRESHER_INTERVAL_SECONDS'],
+            help='seconds between passes when looping'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            self.refresh_expiring()
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def refresh_expiring(self):
+        margin = refresh_margin()
+        tokens = SpotifyToken.objects.filter(expires_at__lte=timezone.now() + margin)
+
+        refreshed = failed = 0
+        for token in tokens.iterator():
+            try:
+                # single-flight, a request refreshing the same row just waits on us
+                token.refresh(margin=margin)
+                refreshed += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Failed to refresh token for user {token.user_id}: {str(e)}")
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Refreshed {refreshed} tokens ({failed} failed)')
+        )
@@ -0,0 +1,70 @@
+import logging
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from store.models.track import TrackMetadata
+from store.services.spotify import SpotifyService
+from store.services.track import TrackService
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Refresh stale or incomplete track metadata from spotify in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='keep running as a background worker')
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=settings.METADATA_REFRESH['INTERVAL_SECONDS'],
+            help='seconds between passes when looping'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.METADATA_REFRESH['BATCH_SIZE'],
+            help='rows loaded and refreshed per step'
+        )
+        parser.add_argument('--limit', type=int, default=None, help='stop a pass after this many rows')
+
+    def handle(self, *args, **options):
+        while True:
+            self.refresh_pass(options['batch_size'], options['limit'])
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def refresh_pass(self, batch_size, limit=None):
+        started = time.monotonic()
+        now = timezone.now()
+        spotify = SpotifyService.for_app()
+        stale = TrackMetadata.objects.stale(now).order_by('id')
+
+        checked = updated = missing = failed = 0
+        last_id = 0
+        while limit is None or checked < limit:
+            size = batch_size if limit is None else min(batch_size, limit - checked)
+            # walk by id so rows that fail aren't picked up again in this pass
+            rows = list(stale.filter(id__gt=last_id)[:size])
+            if not rows:
+                break
+            last_id = rows[-1].id
+            checked += len(rows)
+            try:
+                changed, not_found = TrackService.refresh_metadata(spotify, rows, now)
+                updated += len(changed)
+                missing += len(not_found)
+            except Exception as e:
+                failed += len(rows)
+                self.stderr.write(f"Failed to refresh metadata batch ending at {last_id}: {str(e)}")
+
+        elapsed = time.monotonic() - started
+        rate = checked / elapsed if elapsed else 0
+        summary = (
+            f'checked {checked}, updated {updated}, missing on spotify {missing}, failed {failed} '
+            f'in {elapsed:.1f}s ({rate:.0f} rows/sec)'
+        )
+        logger.info(f"Metadata refresh: {summary}")
+        self.stdout.write(self.style.SUCCESS(f'Refreshed track metadata: {summary}'))
+        return {'checked': checked, 'updated': updated, 'missing': missing, 'failed': failed, 'seconds': elapsed}
@@ -0,0 +1,72 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from store.models.spotify import SpotifyToken
+from store.services.reveal import RevealJobLost, RevealJobService
+from store.services.scheduler import SpotifyRateLimited, SpotifyUnavailable
+from store.services.spotify import SpotifyService
+
+class Command(BaseCommand):
+    help = 'Reveal available tracks into users\' playlists for queued reveal jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='keep running as a background worker')
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=settings.REVEAL_JOB_SETTINGS['POLL_INTERVAL_SECONDS'],
+            help='seconds between queue checks when looping'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.REVEAL_JOB_SETTINGS['BATCH_SIZE'],
+            help='tracks revealed per step'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            self.run_queued(options['batch_size'])
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def run_queued(self, batch_size):
+        completed = requeued = failed = 0
+        while True:
+            job = RevealJobService.claim()
+            if job is None:
+                break
+            try:
+                token = SpotifyToken.objects.get(user_id=job.user_id)
+                spotify = SpotifyService(token.get_valid_access_token(), user_id=job.user_id)
+                job = RevealJobService.run(job, spotify, batch_size)
+                completed += 1
+                self.stdout.write(f"Revealed {job.revealed} of {job.total} tracks for user {job.user_id}")
+            except RevealJobLost as e:
+                # another worker has it now, leave the job to them
+                self.stderr.write(str(e))
+            except (SpotifyRateLimited, SpotifyUnavailable) as e:
+                # spotify asked us to back off, resume on a later pass
+                self.settle(RevealJobService.requeue, job)
+                requeued += 1
+                self.stderr.write(f"Reveal job {job.id} paused: {str(e)}")
+                break
+            except SpotifyToken.DoesNotExist:
+                self.settle(RevealJobService.fail, job, 'Spotify not connected')
+                failed += 1
+            except Exception as e:
+                self.settle(RevealJobService.fail, job, str(e))
+                failed += 1
+                self.stderr.write(f"Reveal job {job.id} failed: {str(e)}")
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Ran reveal jobs: {completed} completed, {requeued} paused, {failed} failed')
+        )
+
+    def settle(self, action, job, *args):
+        # a job claimed by another worker meanwhile is theirs to finish
+        try:
+            action(job, *args)
+        except RevealJobLost as e:
+            self.stderr.write(str(e))
@@ -1,19 +1,29 @@
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from store.models.track import Track
+from store.services.transitions import TrackTransitionEngine
 
 class Command(BaseCommand):
     help = 'Update track statuses based on available_at dates'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--watch',
+            action='store_true',
+            help='keep running and apply transitions as they come due'
+        )
+
     def handle(self, *args, **options):
-        now = timezone.now()
-        
-        # find pending tracks that should be available
-        updated = Track.objects.filter(
-            status='pending',
-            available_at__lte=now
-        ).update(status='available')
+        engine = TrackTransitionEngine()
+
+        if options['watch']:
+            try:
+                engine.run()
+            except KeyboardInterrupt:
+                engine.stop()
+            return
+
+        # one-shot mode, e.g. from cron
+        updated = engine.apply_due()
         
         self.stdout.write(
             self.style.SUCCESS(f'Successfully updated {updated} tracks to available')
-        ) 
\ No newline at end of file
+        )
@@ -1,16 +1,21 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.utils.functional import cached_property, empty
 from store.models.spotify import SpotifyToken
-from django.utils import timezone
-from store.models.track import Track
-from datetime import timedelta
-import logging
-
-logger = logging.getLogger(__name__)
+from store.services.spotify import SpotifyService
 
 class AuthenticationMiddleware:
+    # async capable so async views stay on the event loop instead of a thread per request
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
         response = self.get_response(request)
         
         # Add authentication status to response headers
@@ -18,59 +23,47 @@ class AuthenticationMiddleware:
         
         return response
 
-class SpotifyTokenMiddleware:
-    def __init__(self, get_response):
-        self.get_response = get_response
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        # async views resolve request.user themselves, only a view that didn't needs the session lookup
+        if getattr(request.user, '_wrapped', None) is empty:
+            authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+        else:
+            authenticated = request.user.is_authenticated
+        response['X-User-Authenticated'] = str(authenticated)
+        return response
 
-    def __call__(self, request):
-        if request.user.is_authenticated:
-            try:
-                token = request.user.spotifytoken
-                if token.is_expired:
-                    token.refresh()
-            except SpotifyToken.DoesNotExist:
-                pass
-        return self.get_response(request)
+class RequestSpotify:
+    """request-scoped spotify access, loads the token once and reuses one service"""
+    def __init__(self, request):
+        self._request = request
+
+    @cached_property
+    def token(self):
+        # none when the user is anonymous or hasn't connected spotify
+        user = self._request.user
+        if not user.is_authenticated:
+            return None
+        return SpotifyToken.objects.filter(user=user).first()
+
+    @cached_property
+    def service(self) -> SpotifyService:
+        # raises DoesNotExist so views keep their not-connected handling
+        if self.token is None:
+            raise SpotifyToken.DoesNotExist('Spotify not connected')
+        return SpotifyService(self.token.get_valid_access_token(), user_id=self.token.user_id)
+
+class SpotifyTokenMiddleware:
+    """attach a lazy request.spotify, nothing is loaded unless a view asks for it"""
+    sync_capable = True
+    async_capable = True
 
-class TrackStatusMiddleware:
-    # class-level cache of last check times per user
-    _last_check_times = {}
-    # how often to check for updates (in seconds)
-    CHECK_INTERVAL = 60  # check once per minute
-    
     def __init__(self, get_response):
         self.get_response = get_response
-        logger.info("TrackStatusMiddleware initialized")
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        if hasattr(request, 'user') and request.user.is_authenticated:
-            now = timezone.now()
-            user_id = request.user.id
-            
-            # check if we need to process updates for this user
-            last_check = self._last_check_times.get(user_id)
-            if not last_check or (now - last_check) > timedelta(seconds=self.CHECK_INTERVAL):
-                logger.info(f"Checking updates for user {user_id}")
-                
-                # get all pending tracks that should be available in a single query
-                tracks_to_update = Track.objects.filter(
-                    user=request.user,
-                    status='pending',
-                    available_at__lte=now
-                )
-                
-                count = tracks_to_update.count()
-                if count > 0:
-                    logger.info(f"Found {count} tracks to update")
-                    # use bulk update for better performance
-                    tracks_to_update.update(status='available')
-                    logger.info(f"Updated {count} tracks to available")
-                else:
-                    logger.debug("No tracks to update")  # changed to debug level
-                
-                # update last check time
-                self._last_check_times[user_id] = now
-            else:
-                logger.debug(f"Skipping check for user {user_id}, last check was {(now - last_check).total_seconds():.1f}s ago")
-        
+        request.spotify = RequestSpotify(request)
+        # in an async stack this returns get_response's coroutine for the handler to await
         return self.get_response(request)
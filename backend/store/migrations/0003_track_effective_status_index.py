@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0002_track_played_at'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='track',
+            name='tracks_user_id_b6404d_idx',
+        ),
+        migrations.AddIndex(
+            model_name='track',
+            index=models.Index(fields=['user', 'status', 'available_at'], name='tracks_user_id_12a05f_idx'),
+        ),
+    ]
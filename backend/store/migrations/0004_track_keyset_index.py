@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0003_track_effective_status_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='track',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='tracks_user_id_c47424_idx'),
+        ),
+    ]
@@ -0,0 +1,79 @@
+import logging
+from collections import defaultdict
+from django.db import migrations
+from django.db.models import Count, Min
+
+logger = logging.getLogger(__name__)
+
+# later statuses win when a user has the same track twice
+STATUS_RANK = {'active': 0, 'pending': 1, 'available': 2, 'revealed': 3}
+
+
+def survivor_key(track):
+    # most advanced status first, then the oldest copy
+    return (-STATUS_RANK.get(track.status, 0), track.created_at, track.id)
+
+
+def dedupe_track_metadata(apps, schema_editor):
+    """keep the oldest row per spotify_id and point every track at it
+
+    a user holding copies on two of the rows keeps one track: the most
+    advanced status, oldest first. it takes the earliest created_at and
+    revealed_at and the latest played_at of the copies, the rest are
+    deleted and logged.
+    """
+    TrackMetadata = apps.get_model('store', 'TrackMetadata')
+    Track = apps.get_model('store', 'Track')
+
+    duplicates = (
+        TrackMetadata.objects.values('spotify_id')
+        .annotate(rows=Count('id'), keep=Min('id'))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates:
+        keep = duplicate['keep']
+        extra = list(
+            TrackMetadata.objects.filter(spotify_id=duplicate['spotify_id'])
+            .exclude(id=keep)
+            .values_list('id', flat=True)
+        )
+
+        copies = defaultdict(list)
+        for track in Track.objects.filter(metadata_id__in=[keep, *extra]):
+            copies[track.user_id].append(track)
+
+        for user_id, tracks in copies.items():
+            survivor, *others = sorted(tracks, key=survivor_key)
+            for other in others:
+                survivor.created_at = min(survivor.created_at, other.created_at)
+                if other.revealed_at and (not survivor.revealed_at or other.revealed_at < survivor.revealed_at):
+                    survivor.revealed_at = other.revealed_at
+                if other.played_at and (not survivor.played_at or other.played_at > survivor.played_at):
+                    survivor.played_at = other.played_at
+                logger.warning(
+                    f"Deleting duplicate track {other.id} ({other.status}) of user {user_id} "
+                    f"for {duplicate['spotify_id']}, keeping track {survivor.id} ({survivor.status})"
+                )
+
+            if others:
+                Track.objects.filter(id__in=[other.id for other in others]).delete()
+            # only the merged columns, the rest of the survivor stays as it was
+            Track.objects.filter(id=survivor.id).update(
+                metadata_id=keep,
+                created_at=survivor.created_at,
+                revealed_at=survivor.revealed_at,
+                played_at=survivor.played_at
+            )
+
+        TrackMetadata.objects.filter(id__in=extra).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0004_track_keyset_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_track_metadata, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0005_dedupe_track_metadata'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='trackmetadata',
+            name='track_metad_spotify_5ece5f_idx',
+        ),
+        migrations.AlterField(
+            model_name='trackmetadata',
+            name='spotify_id',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
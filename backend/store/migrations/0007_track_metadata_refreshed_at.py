@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_track_metadata_unique_spotify_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackmetadata',
+            name='refreshed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='trackmetadata',
+            index=models.Index(fields=['refreshed_at'], name='track_metad_refresh_c1d950_idx'),
+        ),
+    ]
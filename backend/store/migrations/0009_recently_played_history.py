@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:17
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('store', '0008_buried_recommendations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecentlyPlayedCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('after', models.BigIntegerField(default=0)),
+                ('synced_at', models.DateTimeField(null=True)),
+            ],
+            options={
+                'db_table': 'recently_played_cursors',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='track',
+            index=models.Index(fields=['user', '-played_at'], name='tracks_user_id_d3a3c6_idx'),
+        ),
+        migrations.AddField(
+            model_name='recentlyplayedcursor',
+            name='user',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('store', '0009_recently_played_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevealJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('playlist_id', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('cutoff', models.DateTimeField()),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('revealed', models.PositiveIntegerField(default=0)),
+                ('last_track_id', models.BigIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'reveal_jobs',
+                'indexes': [models.Index(fields=['status', 'updated_at'], name='reveal_jobs_status_805703_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='revealjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'running'])), fields=('user',), name='one_active_reveal_job_per_user'),
+        ),
+    ]
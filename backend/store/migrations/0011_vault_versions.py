@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('store', '0010_reveal_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VaultVersion',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('version', models.BigIntegerField(default=0)),
+                ('modified_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'vault_versions',
+            },
+        ),
+    ]
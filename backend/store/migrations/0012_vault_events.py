@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('store', '0011_vault_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VaultEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('event', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'vault_events',
+                'indexes': [models.Index(fields=['created_at'], name='vault_event_created_0adcb1_idx')],
+            },
+        ),
+    ]
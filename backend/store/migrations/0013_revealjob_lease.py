@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 03:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0012_vault_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='revealjob',
+            name='lease',
+            field=models.UUIDField(null=True),
+        ),
+    ]
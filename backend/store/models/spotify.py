@@ -1,9 +1,19 @@
-from django.db import models
+import threading
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta
 from store.services.spotify import SpotifyService
 
+# striped per-user locks so threads in one process share a single refresh,
+# the row lock in refresh() does the same across processes
+_REFRESH_LOCKS = [threading.Lock() for _ in range(64)]
+
+def refresh_margin() -> timedelta:
+    return timedelta(seconds=settings.SPOTIFY_TOKEN_SETTINGS['REFRESH_MARGIN_SECONDS'])
+
 class SpotifyToken(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     access_token = models.TextField()
@@ -13,14 +23,44 @@ class SpotifyToken(models.Model):
     @property
     def is_expired(self) -> bool:
         return timezone.now() >= self.expires_at
+
+    @property
+    def needs_refresh(self) -> bool:
+        # expired or inside the proactive refresh margin
+        return timezone.now() + refresh_margin() >= self.expires_at
     
-    def refresh(self):
-        spotify = SpotifyService()
-        new_token_data = spotify.refresh_token(self.refresh_token)
-        
-        self.access_token = new_token_data['access_token']
-        self.expires_at = timezone.now() + timedelta(seconds=new_token_data['expires_in'])
-        self.save()
+    def refresh(self, margin: timedelta = timedelta(0)):
+        """refresh single-flight per user, concurrent callers reuse the winner's token
+
+        the row lock is held across the call to spotify, so a refresh in
+        another process waits on it rather than spending the refresh token
+        twice. that call runs with SPOTIFY_HTTP's (connect, read) timeout,
+        and the token response is one small read, so the hold stays within
+        about CONNECT_TIMEOUT + READ_TIMEOUT.
+        """
+        with _REFRESH_LOCKS[self.user_id % len(_REFRESH_LOCKS)]:
+            with transaction.atomic():
+                current = SpotifyToken.objects.select_for_update().get(pk=self.pk)
+
+                # another request or the background refresher got here first
+                if timezone.now() + margin < current.expires_at:
+                    self.access_token = current.access_token
+                    self.refresh_token = current.refresh_token
+                    self.expires_at = current.expires_at
+                    return
+
+                spotify = SpotifyService()
+                new_token_data = spotify.refresh_token(current.refresh_token)
+
+                self.access_token = new_token_data['access_token']
+                # spotify may rotate the refresh token
+                self.refresh_token = new_token_data.get('refresh_token', current.refresh_token)
+                self.expires_at = timezone.now() + timedelta(seconds=new_token_data['expires_in'])
+                self.save(update_fields=['access_token', 'refresh_token', 'expires_at'])
+
+    async def arefresh(self):
+        # share the locked sync path so async callers join the same single flight
+        await sync_to_async(self.refresh)()
     
     @property
     def is_valid(self) -> bool:
@@ -36,6 +76,12 @@ class SpotifyToken(models.Model):
             self.refresh()
         return self.access_token
 
+    async def aget_valid_access_token(self) -> str:
+        # async variant for views running on the event loop
+        if self.is_expired:
+            await self.arefresh()
+        return self.access_token
+
 class SpotifyPlaylistSettings(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     playlist_id = models.CharField(max_length=255)
@@ -45,3 +91,69 @@ class SpotifyPlaylistSettings(models.Model):
 
     class Meta:
         db_table = 'spotify_playlist_settings'
+
+class BuriedRecommendations(models.Model):
+    """ranked buried-recommendation candidates per user, precomputed by a background job"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    candidates = models.JSONField(default=list)  # [{'metadata': {...}, 'source': 'saved' | 'recommended'}]
+    computed_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    @property
+    def is_expired(self) -> bool:
+        return timezone.now() >= self.expires_at
+
+    class Meta:
+        db_table = 'buried_recommendations'
+
+class RecentlyPlayedCursor(models.Model):
+    """how far a user's recently-played history has been ingested"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    after = models.BigIntegerField(default=0)  # unix ms of the newest play ingested, spotify's after cursor
+    synced_at = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = 'recently_played_cursors'
+
+class RevealJob(models.Model):
+    """reveal every available track into the user's playlist, run by the reveal worker"""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    ACTIVE_STATUSES = ['queued', 'running']
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    playlist_id = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    # tracks available when the job was queued, later unlocks wait for the next job
+    cutoff = models.DateTimeField()
+    total = models.PositiveIntegerField(default=0)
+    revealed = models.PositiveIntegerField(default=0)
+    last_track_id = models.BigIntegerField(default=0)  # resume point, tracks are walked by id
+    lease = models.UUIDField(null=True)  # set by claim(), a worker only writes while it still holds it
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)  # doubles as the worker heartbeat
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in self.ACTIVE_STATUSES
+
+    class Meta:
+        db_table = 'reveal_jobs'
+        constraints = [
+            # one job in flight per user
+            models.UniqueConstraint(
+                fields=['user'],
+                condition=models.Q(status__in=['queued', 'running']),
+                name='one_active_reveal_job_per_user'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'updated_at']),
+        ]
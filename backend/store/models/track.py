@@ -1,22 +1,104 @@
-from django.db import models
+from datetime import timedelta
+from django.conf import settings
+from django.db import connections, models, router
+from django.db.models import Case, CharField, F, Q, Value, When
 from django.contrib.auth.models import User
 from django.utils import timezone
 
+PLACEHOLDER_IMAGE_URL = '/placeholder-album.jpg'
+
+class TrackMetadataQuerySet(models.QuerySet):
+    def upsert(self, **fields):
+        """insert or fetch the row for fields['spotify_id'] in one race-free statement
+
+        an existing row is kept as is, the no-op update only makes RETURNING
+        hand back the stored row on conflict.
+        """
+        db = self._db or router.db_for_write(self.model)
+        connection = connections[db]
+        quote = connection.ops.quote_name
+        inserting = [self.model._meta.get_field(name) for name in fields]
+        returning = self.model._meta.concrete_fields
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {quote(self.model._meta.db_table)} ({', '.join(quote(field.column) for field in inserting)}) "
+                f"VALUES ({', '.join(['%s'] * len(inserting))}) "
+                f"ON CONFLICT ({quote('spotify_id')}) DO UPDATE SET {quote('spotify_id')} = EXCLUDED.{quote('spotify_id')} "
+                f"RETURNING {', '.join(quote(field.column) for field in returning)}",
+                [field.get_db_prep_save(fields[field.name], connection) for field in inserting]
+            )
+            row = cursor.fetchone()
+        return self.model.from_db(db, [field.attname for field in returning], row)
+
+    def stale(self, now=None):
+        """rows due for a refresh from spotify, incomplete ones come due sooner"""
+        now = now or timezone.now()
+        config = settings.METADATA_REFRESH
+        incomplete = Q(release_date='') | Q(image_url=PLACEHOLDER_IMAGE_URL)
+        return self.filter(
+            Q(refreshed_at__isnull=True)
+            | Q(refreshed_at__lt=now - timedelta(days=config['MAX_AGE_DAYS']))
+            | (incomplete & Q(refreshed_at__lt=now - timedelta(days=config['INCOMPLETE_MAX_AGE_DAYS'])))
+        )
+
 class TrackMetadata(models.Model):
-    spotify_id = models.CharField(max_length=255, db_index=True)
+    spotify_id = models.CharField(max_length=255, unique=True)
     title = models.CharField(max_length=255)
     artist = models.CharField(max_length=255)
     album = models.CharField(max_length=255)
     preview_url = models.URLField(null=True, blank=True)
     image_url = models.URLField()
     release_date = models.CharField(max_length=10, blank=True)  # format: YYYY-MM-DD
+    refreshed_at = models.DateTimeField(null=True, blank=True)  # last synced from spotify, null if only client-posted
+
+    objects = TrackMetadataQuerySet.as_manager()
 
     class Meta:
         db_table = 'track_metadata'
         indexes = [
-            models.Index(fields=['spotify_id']),
+            models.Index(fields=['refreshed_at']),
         ]
 
+class TrackQuerySet(models.QuerySet):
+    """reads derive 'available' from available_at so they never wait on a background job"""
+
+    def with_effective_status(self, now=None):
+        # annotate effective_status: pending tracks past available_at read as available
+        now = now or timezone.now()
+        return self.annotate(effective_status=Case(
+            When(status='pending', available_at__lte=now, then=Value('available')),
+            default=F('status'),
+            output_field=CharField(),
+        ))
+
+    def with_status(self, status, now=None):
+        """filter on effective status, served by the (user, status, available_at) index"""
+        now = now or timezone.now()
+        if status == 'available':
+            return self.filter(Q(status='available') | Q(status='pending', available_at__lte=now))
+        if status == 'pending':
+            return self.filter(Q(status='pending') & (Q(available_at__gt=now) | Q(available_at__isnull=True)))
+        return self.filter(status=status)
+
+    def make_due_available(self, now):
+        """move every pending track whose available_at has passed to available in one UPDATE
+
+        returns the (user_id, id) pairs it changed, so callers never act on a
+        row another writer already moved on.
+        """
+        db = self._db or router.db_for_write(self.model)
+        connection = connections[db]
+        quote = connection.ops.quote_name
+        available_at = self.model._meta.get_field('available_at').get_db_prep_value(now, connection)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {quote(self.model._meta.db_table)} SET {quote('status')} = %s "
+                f"WHERE {quote('status')} = %s AND {quote('available_at')} <= %s "
+                f"RETURNING {quote('user_id')}, {quote('id')}",
+                ['available', 'pending', available_at]
+            )
+            return cursor.fetchall()
+
 class Track(models.Model):
     STATUS_CHOICES = [
         ('active', 'Active'),       # being added
@@ -33,11 +115,77 @@ class Track(models.Model):
     revealed_at = models.DateTimeField(null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     played_at = models.DateTimeField(null=True)  # when the track was last played on spotify
+
+    objects = TrackQuerySet.as_manager()
+
+    @staticmethod
+    def derive_status(status, available_at, now=None):
+        """python twin of TrackQuerySet.with_effective_status"""
+        if status == 'pending' and available_at and available_at <= (now or timezone.now()):
+            return 'available'
+        return status
     
     class Meta:
         db_table = 'tracks'
         unique_together = ['user', 'metadata']
         indexes = [
-            models.Index(fields=['user', 'status']),
+            models.Index(fields=['user', 'status', 'available_at']),
+            # keyset pagination walks this index from the cursor
+            models.Index(fields=['user', '-created_at', '-id']),
+            # rediscovered tracks, most recently played first
+            models.Index(fields=['user', '-played_at']),
             models.Index(fields=['metadata']),
-        ] 
\ No newline at end of file
+        ] 
+
+class VaultVersionQuerySet(models.QuerySet):
+    def bump(self, user_ids, now=None):
+        """add one to each user's version in one race-free statement, returns {user_id: version}
+
+        users without a row start at 1. ids are sorted so concurrent bumps
+        lock rows in the same order.
+        """
+        user_ids = sorted(set(user_ids))
+        if not user_ids:
+            return {}
+        now = now or timezone.now()
+        db = self._db or router.db_for_write(self.model)
+        connection = connections[db]
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        modified_at = self.model._meta.get_field('modified_at').get_db_prep_save(now, connection)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({quote('user_id')}, {quote('version')}, {quote('modified_at')}) "
+                f"VALUES {', '.join(['(%s, 1, %s)'] * len(user_ids))} "
+                f"ON CONFLICT ({quote('user_id')}) DO UPDATE SET "
+                f"{quote('version')} = {table}.{quote('version')} + 1, "
+                f"{quote('modified_at')} = EXCLUDED.{quote('modified_at')} "
+                f"RETURNING {quote('user_id')}, {quote('version')}",
+                [value for user_id in user_ids for value in (user_id, modified_at)]
+            )
+            return dict(cursor.fetchall())
+
+class VaultVersion(models.Model):
+    """per-user vault version behind the track etags, in the database so every process sees each bump"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    version = models.BigIntegerField(default=0)
+    modified_at = models.DateTimeField()
+
+    objects = VaultVersionQuerySet.as_manager()
+
+    class Meta:
+        db_table = 'vault_versions'
+
+class VaultEvent(models.Model):
+    """vault status change read by the event streams, the id is the sse event id"""
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    event = models.JSONField()  # {'type': ..., 'track_ids': [...], 'spotify_ids': [...]}
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'vault_events'
+        indexes = [
+            # pruning past the retention window
+            models.Index(fields=['created_at']),
+        ]
@@ -0,0 +1,31 @@
+import orjson
+from rest_framework.renderers import JSONRenderer
+
+class FastJSONRenderer(JSONRenderer):
+    """orjson-backed JSONRenderer for the track listings
+
+    the same bytes as the stock renderer for strings, ints, bools, nulls
+    and datetimes, which is all a track row holds (store.tests checks it).
+    floats are not: orjson writes 1e16 where json writes 1e+16 and turns nan
+    into null instead of failing, so only set it on views without floats.
+    datetimes and anything orjson can't encode natively go through drf's
+    encoder, indented (browsable/?indent) output falls back to json.dumps.
+    """
+    OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        renderer_context = renderer_context or {}
+        if self.get_indent(accepted_media_type, renderer_context) is not None or not self.compact or self.ensure_ascii:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=self.OPTIONS)
+        except TypeError:
+            # non-str keys, huge ints, nan under strict mode, let json.dumps decide
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # same javascript-safe escaping as JSONRenderer
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
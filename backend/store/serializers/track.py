@@ -1,3 +1,5 @@
+from django.conf import settings
+from django.utils import timezone
 from rest_framework import serializers
 from store.models.track import TrackMetadata, Track
 
@@ -16,8 +18,45 @@ class TrackMetadataSerializer(serializers.ModelSerializer):
         ]
 
 class TrackSerializer(serializers.ModelSerializer):
-    """basic track serializer"""
+    """basic track serializer, pass fields=[...] to only render a subset"""
     metadata = TrackMetadataSerializer(read_only=True)
+
+    # columns each output field needs, used to narrow the SELECT for sparse fieldsets
+    FIELD_COLUMNS = {
+        'id': ['id'],
+        'metadata': ['metadata'] + [f'metadata__{name}' for name in TrackMetadataSerializer.Meta.fields],
+        'status': ['status', 'available_at'],
+        'locked_at': ['locked_at'],
+        'available_at': ['available_at'],
+        'revealed_at': ['revealed_at'],
+        'created_at': ['created_at'],
+        'played_at': ['played_at'],
+    }
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def parse_fields(cls, value):
+        """turn ?fields=a,b into a list, None when every field is wanted"""
+        if not value:
+            return None
+        fields = [name.strip() for name in value.split(',') if name.strip()]
+        unknown = [name for name in fields if name not in cls.FIELD_COLUMNS]
+        if unknown:
+            raise serializers.ValidationError({'fields': f"Unknown fields: {', '.join(unknown)}"})
+        return fields
+
+    @classmethod
+    def columns_for(cls, fields):
+        # id and created_at are always loaded, the keyset cursor is built from them
+        columns = {'id', 'created_at'}
+        for name in fields:
+            columns.update(cls.FIELD_COLUMNS[name])
+        return sorted(columns)
     
     class Meta:
         model = Track
@@ -32,6 +71,62 @@ class TrackSerializer(serializers.ModelSerializer):
             'played_at'
         ]
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # report due pending tracks as available without waiting for the transition engine,
+        # status stays a plain writable field on input
+        if 'status' in data:
+            data['status'] = Track.derive_status(instance.status, instance.available_at)
+        return data
+
+def format_datetime(value, tz):
+    """DateTimeField.to_representation without the field lookups"""
+    if not value:
+        return None
+    value = value.astimezone(tz).isoformat()
+    return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+class TrackRowSerializer:
+    """read-only fast path for TrackSerializer(many=True)
+
+    works on named .values_list() rows instead of model instances and skips
+    drf's per-field machinery, the rendered output is the same bytes.
+    """
+    DATETIME_FIELDS = {'locked_at', 'available_at', 'revealed_at', 'created_at', 'played_at'}
+    METADATA_FIELDS = TrackMetadataSerializer.Meta.fields
+
+    def __init__(self, fields=None):
+        # keep TrackSerializer's field order
+        self.fields = [name for name in TrackSerializer.Meta.fields if fields is None or name in fields]
+
+    def columns(self):
+        # the fk column itself isn't needed, only the joined metadata values
+        return [column for column in TrackSerializer.columns_for(self.fields) if column != 'metadata']
+
+    def rows(self, queryset):
+        return queryset.values_list(*self.columns(), named=True)
+
+    def serialize(self, rows, now=None):
+        now = now or timezone.now()
+        tz = timezone.get_current_timezone()
+        metadata_columns = [(name, f'metadata__{name}') for name in self.METADATA_FIELDS]
+
+        def metadata(row):
+            return {name: getattr(row, column) for name, column in metadata_columns}
+
+        getters = []
+        for name in self.fields:
+            if name == 'metadata':
+                getters.append((name, metadata))
+            elif name == 'status':
+                getters.append((name, lambda row: Track.derive_status(row.status, row.available_at, now)))
+            elif name in self.DATETIME_FIELDS:
+                getters.append((name, lambda row, name=name: format_datetime(getattr(row, name), tz)))
+            else:
+                getters.append((name, lambda row, name=name: getattr(row, name)))
+
+        return [{name: getter(row) for name, getter in getters} for row in rows]
+
 class TrackCreateSerializer(serializers.ModelSerializer):
     """serializer for creating a new track"""
     spotify_id = serializers.CharField(write_only=True)
@@ -58,12 +153,8 @@ class TrackCreateSerializer(serializers.ModelSerializer):
             'release_date': validated_data.pop('release_date', '')
         }
         
-        # try to get existing metadata first
-        metadata = TrackMetadata.objects.filter(spotify_id=metadata_fields['spotify_id']).first()
-        
-        if not metadata:
-            # create metadata from provided data
-            metadata = TrackMetadata.objects.create(**metadata_fields)
+        # insert or reuse the shared metadata row in one statement, safe under concurrency
+        metadata = TrackMetadata.objects.upsert(**metadata_fields)
         
         try:
             # create track with pending status since it's being sealed
@@ -94,3 +185,32 @@ class TrackCreateSerializer(serializers.ModelSerializer):
             )
         except Exception as e:
             raise serializers.ValidationError(f'failed to create track: {str(e)}')
+
+class TrackBulkTransitionSerializer(serializers.Serializer):
+    """body of tracks/bulk/transition"""
+    action = serializers.ChoiceField(choices=['lock', 'reveal', 'make_available'])
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+
+    def validate_ids(self, value):
+        if len(value) > settings.TRACK_SETTINGS['BULK_MAX_ITEMS']:
+            raise serializers.ValidationError(f"At most {settings.TRACK_SETTINGS['BULK_MAX_ITEMS']} ids per request")
+        return value
+
+class TrackImportMetadataSerializer(serializers.Serializer):
+    spotify_id = serializers.CharField(max_length=255)
+    title = serializers.CharField(max_length=255)
+    artist = serializers.CharField(max_length=255)
+    album = serializers.CharField(max_length=255)
+    preview_url = serializers.URLField(required=False, allow_null=True)
+    image_url = serializers.URLField()
+    release_date = serializers.CharField(max_length=10, required=False, allow_blank=True, default='')
+
+class TrackImportSerializer(serializers.Serializer):
+    """one line of a vault export"""
+    metadata = TrackImportMetadataSerializer()
+    status = serializers.ChoiceField(choices=Track.STATUS_CHOICES)
+    locked_at = serializers.DateTimeField(required=False, allow_null=True)
+    available_at = serializers.DateTimeField(required=False, allow_null=True)
+    revealed_at = serializers.DateTimeField(required=False, allow_null=True)
+    created_at = serializers.DateTimeField(required=False, allow_null=True)
+    played_at = serializers.DateTimeField(required=False, allow_null=True)
@@ -0,0 +1,138 @@
+import json
+from itertools import islice
+from typing import Dict, Iterable, Iterator
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Case, Value, When
+from store.models.track import Track, TrackMetadata
+from store.serializers.track import TrackImportSerializer, TrackRowSerializer
+
+# every track field but the local id, which means nothing in another database
+EXPORT_FIELDS = ['metadata', 'status', 'locked_at', 'available_at', 'revealed_at', 'created_at', 'played_at']
+TRACK_IMPORT_FIELDS = ['status', 'locked_at', 'available_at', 'revealed_at', 'played_at']
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+class VaultBackupService:
+    """export a vault as ndjson, one track per line shaped like the tracks api, and import it back"""
+
+    @staticmethod
+    def export_lines(user_id: int, chunk_size: int = None) -> Iterator[str]:
+        """yield one json line per track, oldest first, a chunk of rows in memory at a time"""
+        chunk_size = chunk_size or settings.TRACK_SETTINGS['EXPORT_CHUNK_SIZE']
+        serializer = TrackRowSerializer(EXPORT_FIELDS)
+        # a server-side cursor on postgres, rows are fetched chunk_size at a time
+        rows = serializer.rows(Track.objects.filter(user_id=user_id).order_by('id')).iterator(chunk_size=chunk_size)
+        for chunk in batched(rows, chunk_size):
+            for track in serializer.serialize(chunk):
+                yield json.dumps(track, cls=DjangoJSONEncoder) + '\n'
+
+    @staticmethod
+    def import_lines(user_id: int, lines: Iterable, batch_size: int = None) -> Dict:
+        """upsert tracks from ndjson lines in batches, returns counts and the first errors
+
+        metadata rows that already exist are kept as they are, the catalog is
+        shared and kept fresh from spotify. tracks already in the vault take
+        the imported status and dates, lines that match the vault as it is
+        count as unchanged and aren't written.
+        """
+        batch_size = batch_size or settings.TRACK_SETTINGS['IMPORT_BATCH_SIZE']
+        max_errors = settings.TRACK_SETTINGS['IMPORT_MAX_ERRORS']
+        counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+        invalid = 0
+        errors = []
+
+        def parsed():
+            nonlocal invalid
+            for number, line in enumerate(lines, start=1):
+                if isinstance(line, bytes):
+                    line = line.decode()
+                if not line.strip():
+                    continue
+                try:
+                    serializer = TrackImportSerializer(data=json.loads(line))
+                    valid = serializer.is_valid()
+                except ValueError:
+                    valid, serializer = False, None
+                if valid:
+                    yield serializer.validated_data
+                    continue
+                invalid += 1
+                if len(errors) < max_errors:
+                    errors.append({'line': number, 'errors': serializer.errors if serializer else 'Invalid JSON'})
+
+        for batch in batched(parsed(), batch_size):
+            for key, count in VaultBackupService.import_batch(user_id, batch).items():
+                counts[key] += count
+        return {**counts, 'invalid': invalid, 'errors': errors}
+
+    @staticmethod
+    def import_batch(user_id: int, items) -> Dict[str, int]:
+        """one metadata insert, two lookups, one track upsert and one created_at update
+
+        returns how many tracks were created, updated, or already matched their line.
+        """
+        # the last line wins when a track is listed twice
+        items = {item['metadata']['spotify_id']: item for item in items}
+        counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+        with transaction.atomic():
+            TrackMetadata.objects.bulk_create(
+                [TrackMetadata(**item['metadata']) for item in items.values()],
+                ignore_conflicts=True
+            )
+            metadata_ids = dict(
+                TrackMetadata.objects.filter(spotify_id__in=list(items)).values_list('spotify_id', 'id')
+            )
+            existing = {
+                row[0]: row[1:]
+                for row in Track.objects.filter(
+                    user_id=user_id,
+                    metadata_id__in=list(metadata_ids.values())
+                ).values_list('metadata_id', *TRACK_IMPORT_FIELDS, 'created_at')
+            }
+
+            changed = {}
+            for spotify_id, item in items.items():
+                metadata_id = metadata_ids[spotify_id]
+                current = existing.get(metadata_id)
+                if current is None:
+                    counts['created'] += 1
+                elif (
+                    current[:-1] != tuple(item.get(field) for field in TRACK_IMPORT_FIELDS)
+                    or (item.get('created_at') and current[-1] != item['created_at'])
+                ):
+                    counts['updated'] += 1
+                else:
+                    counts['unchanged'] += 1
+                    continue
+                changed[metadata_id] = item
+            if not changed:
+                return counts
+
+            Track.objects.bulk_create(
+                [
+                    Track(
+                        user_id=user_id,
+                        metadata_id=metadata_id,
+                        **{field: item.get(field) for field in TRACK_IMPORT_FIELDS}
+                    )
+                    for metadata_id, item in changed.items()
+                ],
+                update_conflicts=True,
+                unique_fields=['user', 'metadata'],
+                update_fields=TRACK_IMPORT_FIELDS
+            )
+            # created_at is auto_now_add, which bulk_create always overrides
+            dated = [(metadata_id, item['created_at']) for metadata_id, item in changed.items() if item.get('created_at')]
+            if dated:
+                Track.objects.filter(
+                    user_id=user_id,
+                    metadata_id__in=[metadata_id for metadata_id, _ in dated]
+                ).update(created_at=Case(*[
+                    When(metadata_id=metadata_id, then=Value(created_at)) for metadata_id, created_at in dated
+                ]))
+        return counts
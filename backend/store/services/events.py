@@ -0,0 +1,215 @@
+import asyncio
+import json
+import logging
+import time
+import weakref
+from collections import defaultdict
+from datetime import timedelta
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+from django.utils import timezone
+from store.models.track import VaultEvent
+
+logger = logging.getLogger(__name__)
+
+class VaultEvents:
+    """log of vault status changes (locked, available, revealed, reverted), read by the event streams
+
+    every write appends a row to vault_events, so events published by the
+    workers reach the streams open in any web process. the row id is the
+    sse event id, a reconnecting client asks for everything after the last
+    id it saw. rows are kept for RETENTION_SECONDS, every PRUNE_EVERY-th
+    publish deletes the older ones.
+    """
+
+    def _entry(self, event_type: str, track_ids: Iterable[int], spotify_ids: Iterable[str]) -> Dict:
+        event = {'type': event_type}
+        if track_ids:
+            event['track_ids'] = list(track_ids)
+        if spotify_ids:
+            event['spotify_ids'] = list(spotify_ids)
+        return event
+
+    def publish(self, user_id: int, event_type: str, track_ids: Iterable[int] = (),
+                spotify_ids: Iterable[str] = ()) -> int:
+        """append an event for the user, returns its sequence number"""
+        config = settings.VAULT_EVENT_SETTINGS
+        seq = VaultEvent.objects.create(user_id=user_id, event=self._entry(event_type, track_ids, spotify_ids)).id
+        if seq % config['PRUNE_EVERY'] == 0:
+            self.prune()
+        return seq
+
+    def prune(self) -> int:
+        cutoff = timezone.now() - timedelta(seconds=settings.VAULT_EVENT_SETTINGS['RETENTION_SECONDS'])
+        return VaultEvent.objects.filter(created_at__lt=cutoff).delete()[0]
+
+    async def alatest(self) -> int:
+        return await VaultEvent.objects.order_by('-id').values_list('id', flat=True).afirst() or 0
+
+    async def aread(self, after: int, until: int) -> Tuple[List[Tuple[int, Dict]], bool]:
+        """entries with after < seq <= until, and whether nothing in between was lost
+
+        lost means pruned or past MAX_REPLAY. ids a rolled back or still open
+        transaction took are just missing, they never were events.
+        """
+        limit = settings.VAULT_EVENT_SETTINGS['MAX_REPLAY']
+        rows = [
+            row async for row in VaultEvent.objects.filter(id__gt=after, id__lte=until)
+            .order_by('-id').values_list('id', 'user_id', 'event')[:limit]
+        ]
+        rows.reverse()
+        oldest = await VaultEvent.objects.order_by('id').values_list('id', flat=True).afirst()
+        truncated = len(rows) == limit and rows[0][0] > after + 1
+        pruned = after < until and (oldest is None or oldest > after + 1)
+        entries = [(seq, {'user_id': user_id, 'event': event}) for seq, user_id, event in rows]
+        return entries, not truncated and not pruned
+
+vault_events = VaultEvents()
+
+class VaultEventBroadcaster:
+    """fans the event log out to the streams open in this process
+
+    one task per event loop polls the log and hands each user's events to
+    their subscriber queues, so open connections cost no database or cache
+    reads of their own. the task stops when the last stream closes.
+    """
+
+    def __init__(self):
+        self.subscribers = defaultdict(set)  # user_id -> {asyncio.Queue}
+        self.cursor = 0  # last sequence handed out
+        self.gaps = {}  # seq missing from the log -> when to stop waiting for it
+        self.task = None
+        self._starting = asyncio.Lock()
+
+    async def subscribe(self, user_id: int) -> asyncio.Queue:
+        async with self._starting:
+            if self.task is None or self.task.done():
+                self.cursor = await vault_events.alatest()
+                self.task = asyncio.ensure_future(self._run())
+        queue = asyncio.Queue(maxsize=settings.VAULT_EVENT_SETTINGS['QUEUE_SIZE'])
+        self.subscribers[user_id].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue):
+        queues = self.subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[user_id]
+        if not self.subscribers and self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def _deliver(self, queue: asyncio.Queue, item):
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # the client fell too far behind, tell it to reload instead
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+    async def _run(self):
+        interval = settings.VAULT_EVENT_SETTINGS['POLL_INTERVAL_SECONDS']
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._poll()
+            except DatabaseError:
+                # keep the streams open through a dropped connection, the next poll reconnects
+                logger.exception("Failed to read vault events")
+                await sync_to_async(close_old_connections)()
+
+    async def _poll(self):
+        latest = await vault_events.alatest()
+        if latest <= self.cursor:
+            return
+        entries, complete = await vault_events.aread(self.cursor, latest)
+
+        if not complete:
+            self.gaps.clear()
+            if self.cursor:
+                # events were lost (pruned or too many at once), every stream has to reload
+                for queues in self.subscribers.values():
+                    for queue in queues:
+                        self._deliver(queue, None)
+        else:
+            # an id missing from the log may belong to a writer that hasn't committed yet,
+            # later events are held back until it shows up or GAP_TIMEOUT_SECONDS pass
+            now = time.monotonic()
+            timeout = settings.VAULT_EVENT_SETTINGS['GAP_TIMEOUT_SECONDS']
+            present = {seq for seq, _ in entries}
+            self.gaps = {
+                seq: self.gaps.get(seq, now + timeout)
+                for seq in range(self.cursor + 1, latest + 1)
+                if seq not in present
+            }
+            waiting = [seq for seq, deadline in self.gaps.items() if deadline > now]
+            if waiting:
+                # ids that timed out before the first one still waited on were never events
+                latest = min(waiting) - 1
+                entries = [(seq, entry) for seq, entry in entries if seq <= latest]
+
+        for seq, entry in entries:
+            for queue in self.subscribers.get(entry['user_id'], ()):
+                self._deliver(queue, (seq, entry['event']))
+        self.cursor = latest
+
+# one broadcaster per event loop, queues and tasks can't be shared across loops
+_broadcasters = weakref.WeakKeyDictionary()
+
+def get_broadcaster() -> VaultEventBroadcaster:
+    loop = asyncio.get_running_loop()
+    broadcaster = _broadcasters.get(loop)
+    if broadcaster is None:
+        broadcaster = _broadcasters[loop] = VaultEventBroadcaster()
+    return broadcaster
+
+def format_event(event_type: str, data: Dict, event_id: int = None) -> str:
+    lines = [f'id: {event_id}'] if event_id is not None else []
+    lines += [f'event: {event_type}', f'data: {json.dumps(data)}']
+    return '\n'.join(lines) + '\n\n'
+
+async def stream_events(user_id: int, last_event_id: Optional[int] = None) -> AsyncIterator[str]:
+    """sse body for one user: a replay after last_event_id, then live events and heartbeats
+
+    ends after MAX_STREAM_SECONDS, the browser reconnects on its own and
+    resumes from the last id it got.
+    """
+    config = settings.VAULT_EVENT_SETTINGS
+    broadcaster = get_broadcaster()
+    # subscribe before replaying so nothing published in between is missed
+    queue = await broadcaster.subscribe(user_id)
+    try:
+        yield f"retry: {config['RETRY_MS']}\n\n"
+        sent = max(broadcaster.cursor, last_event_id or 0)
+        if last_event_id is not None and last_event_id < broadcaster.cursor:
+            entries, complete = await vault_events.aread(last_event_id, broadcaster.cursor)
+            if not complete:
+                yield format_event('reset', {})
+            for seq, entry in entries:
+                if entry['user_id'] == user_id:
+                    yield format_event(entry['event']['type'], entry['event'], seq)
+
+        deadline = time.monotonic() + config['MAX_STREAM_SECONDS']
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                item = await asyncio.wait_for(queue.get(), min(config['HEARTBEAT_SECONDS'], remaining))
+            except asyncio.TimeoutError:
+                # comment line, keeps proxies from closing an idle connection
+                yield ': heartbeat\n\n'
+                continue
+            if item is None:
+                yield format_event('reset', {})
+                continue
+            seq, event = item
+            if seq > sent:
+                sent = seq
+                yield format_event(event['type'], event, seq)
+    finally:
+        broadcaster.unsubscribe(user_id, queue)
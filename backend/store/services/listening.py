@@ -0,0 +1,62 @@
+from typing import Dict
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from store.models.spotify import RecentlyPlayedCursor
+from store.models.track import Track, TrackMetadata
+from store.services.vault import vault_versions
+
+class ListeningHistoryService:
+    @staticmethod
+    def record_plays(user_id: int, plays: Dict) -> int:
+        """set played_at from {spotify_id: played_at} in one UPDATE, returns rows changed
+
+        a row only moves forward, replaying the same history changes nothing.
+        """
+        if not plays:
+            return 0
+        metadata_ids = dict(
+            TrackMetadata.objects.filter(spotify_id__in=list(plays)).values_list('spotify_id', 'id')
+        )
+        played = {metadata_ids[spotify_id]: played_at for spotify_id, played_at in plays.items() if spotify_id in metadata_ids}
+        if not played:
+            return 0
+
+        newer = Q()
+        whens = []
+        for metadata_id, played_at in played.items():
+            condition = Q(metadata_id=metadata_id) & (Q(played_at__isnull=True) | Q(played_at__lt=played_at))
+            newer |= condition
+            whens.append(When(condition, then=played_at))
+
+        updated = Track.objects.filter(Q(user_id=user_id) & newer).update(
+            played_at=Case(*whens, default=F('played_at'))
+        )
+        if updated:
+            vault_versions.bump(user_id)
+        return updated
+
+    @staticmethod
+    def ingest(spotify, user_id: int) -> int:
+        """pull plays since the user's cursor and record them, returns tracks updated"""
+        cursor, _ = RecentlyPlayedCursor.objects.get_or_create(user_id=user_id)
+
+        plays = {}
+        newest = cursor.after
+        for item in spotify.iter_recently_played(after=cursor.after):
+            track = item.get('track') or {}
+            played_at = parse_datetime(item['played_at'])
+            if not track.get('id') or played_at is None:
+                continue
+            # keep the latest play per track
+            if track['id'] not in plays or plays[track['id']] < played_at:
+                plays[track['id']] = played_at
+            newest = max(newest, int(played_at.timestamp() * 1000))
+
+        updated = ListeningHistoryService.record_plays(user_id, plays)
+
+        # the cursor only moves after the plays are stored, a crash just replays them
+        cursor.after = newest
+        cursor.synced_at = timezone.now()
+        cursor.save(update_fields=['after', 'synced_at'])
+        return updated
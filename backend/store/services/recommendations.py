@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import zip_longest
+from typing import Dict, List
+from django.conf import settings
+from django.utils import timezone
+from store.models.spotify import BuriedRecommendations
+from store.services.spotify_cache import spotify_cache
+from store.services.track import metadata_from_spotify
+from store.services.vault import vault_versions
+
+def playable(track) -> bool:
+    # local files and region-removed tracks come back without an id
+    return bool(track and track.get('id'))
+
+class RecommendationService:
+    @staticmethod
+    def rank_buried(top: List[Dict], saved: List[Dict], recommended: List[Dict], exclude, limit: int) -> List[Dict]:
+        """saved tracks that fell out of the user's top tracks, oldest saves first,
+        interleaved with recommendations seeded from what they play now"""
+        top_ids = {track['id'] for track in top if playable(track)}
+        buried = sorted(
+            (item for item in saved if playable(item['track']) and item['track']['id'] not in top_ids),
+            key=lambda item: item['added_at']
+        )
+
+        seen = set(exclude) | top_ids
+        candidates = []
+        for saved_item, track in zip_longest(buried, recommended):
+            for source, candidate in [('saved', saved_item and saved_item['track']), ('recommended', track)]:
+                if playable(candidate) and candidate['id'] not in seen:
+                    seen.add(candidate['id'])
+                    candidates.append({'metadata': metadata_from_spotify(candidate), 'source': source})
+        return candidates[:limit]
+
+    @staticmethod
+    def compute_buried(spotify, user_id: int) -> BuriedRecommendations:
+        """fetch top, saved and recommended tracks once and store the ranked candidates"""
+        config = settings.RECOMMENDATION_SETTINGS
+        top = spotify.get_user_top_tracks(limit=50)['items']
+        saved = list(spotify.iter_saved_tracks(max_items=config['SAVED_TRACKS_SCAN']))
+
+        seeds = [track['id'] for track in top if playable(track)][:5]
+        if not seeds:
+            seeds = [item['track']['id'] for item in saved if playable(item['track'])][:5]
+        recommended = spotify.get_recommendations(seeds, limit=50)['tracks'] if seeds else []
+
+        candidates = RecommendationService.rank_buried(
+            top, saved, recommended,
+            exclude=vault_versions.locked_ids(user_id),
+            limit=config['BURIED_MAX_CANDIDATES']
+        )
+        now = timezone.now()
+        recommendations, _ = BuriedRecommendations.objects.update_or_create(
+            user_id=user_id,
+            defaults={
+                'candidates': candidates,
+                'computed_at': now,
+                'expires_at': now + timedelta(seconds=config['BURIED_TTL_SECONDS']),
+            }
+        )
+        return recommendations
+
+    @staticmethod
+    def get_buried(user_id: int, spotify=None, limit: int = None) -> Dict:
+        """serve the stored candidates, computing them only when missing or expired"""
+        limit = limit or settings.RECOMMENDATION_SETTINGS['BURIED_PAGE_SIZE']
+        recommendations = BuriedRecommendations.objects.filter(user_id=user_id).first()
+        if (recommendations is None or recommendations.is_expired) and spotify is not None:
+            recommendations = RecommendationService.compute_buried(spotify, user_id)
+        if recommendations is None:
+            return {'tracks': [], 'computed_at': None}
+
+        # tracks vaulted since the list was computed drop out here
+        vaulted = vault_versions.locked_ids(user_id)
+        tracks = [
+            candidate for candidate in recommendations.candidates
+            if candidate['metadata']['spotify_id'] not in vaulted
+        ]
+        return {'tracks': tracks[:limit], 'computed_at': recommendations.computed_at}
+
+    @staticmethod
+    def exclusion_set(spotify, user_id: int) -> frozenset:
+        """spotify ids that don't count as unique: the vault plus what was just played"""
+        def fetch():
+            return spotify.get_recently_played(limit=50)
+        recent = spotify_cache.get_or_fetch('me/player/recently-played', {'limit': 50}, fetch, user_id=user_id)
+        played = {item['track']['id'] for item in recent['items'] if playable(item.get('track'))}
+        return vault_versions.locked_ids(user_id) | played
+
+    @staticmethod
+    def get_unique(spotify, user_id: int, seeds: List[str] = None, limit: int = None) -> Dict:
+        """recommendations with vaulted and recently played tracks filtered out
+
+        the first call overfetches, if filtering leaves too few each seed is
+        asked on its own, concurrently. every spotify call is cached per seed
+        set so repeat loads only redo the in-memory filtering.
+        """
+        config = settings.RECOMMENDATION_SETTINGS
+        # clamped like KeysetPagination.get_page_size, a non-positive limit would never fill
+        limit = config['UNIQUE_DEFAULT_LIMIT'] if limit is None else max(1, min(limit, config['UNIQUE_MAX_LIMIT']))
+        if not seeds:
+            top = spotify.get_user_top_tracks(limit=20)['items']
+            seeds = [track['id'] for track in top if playable(track)][:5]
+        if not seeds:
+            return {'tracks': [], 'seeds': []}
+
+        exclude = RecommendationService.exclusion_set(spotify, user_id)
+        spotify_limit = 100  # spotify's max per recommendations call
+        tracks = {}
+
+        def collect(results):
+            for track in results['tracks']:
+                if len(tracks) == limit:
+                    return
+                if playable(track) and track['id'] not in exclude and track['id'] not in tracks:
+                    tracks[track['id']] = track
+
+        collect(spotify.get_recommendations(seeds, limit=min(limit * config['UNIQUE_OVERFETCH'], spotify_limit)))
+
+        if len(tracks) < limit and len(seeds) > 1:
+            # refill from single-seed calls, they return different neighbourhoods
+            workers = min(len(seeds), settings.SPOTIFY_HTTP['BATCH_CONCURRENCY'])
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                refills = executor.map(lambda seed: spotify.get_recommendations([seed], limit=spotify_limit), seeds)
+                for results in refills:
+                    collect(results)
+
+        return {
+            'tracks': [metadata_from_spotify(track) for track in tracks.values()],
+            'seeds': seeds,
+        }
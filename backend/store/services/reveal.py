@@ -0,0 +1,139 @@
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from store.models.spotify import RevealJob, SpotifyPlaylistSettings
+from store.models.track import Track
+from store.services.spotify import PLAYLIST_ID_FIELDS, playlist_chunks, playlist_diff
+from store.services.events import vault_events
+from store.services.vault import vault_versions
+
+class RevealJobLost(Exception):
+    """another worker claimed the job after this one's lease went stale"""
+
+class RevealJobService:
+    @staticmethod
+    def revealable(user_id: int, cutoff):
+        """tracks a job queued at `cutoff` reveals"""
+        return Track.objects.filter(user_id=user_id).with_status('available', cutoff)
+
+    @staticmethod
+    def start(user):
+        """queue a reveal job for the user's playlist, returns (job, created)
+
+        a job already in flight is returned instead of queueing another.
+        raises SpotifyPlaylistSettings.DoesNotExist without a playlist.
+        """
+        playlist = SpotifyPlaylistSettings.objects.get(user=user)
+        active = RevealJob.objects.filter(user=user, status__in=RevealJob.ACTIVE_STATUSES).first()
+        if active:
+            return active, False
+
+        now = timezone.now()
+        total = RevealJobService.revealable(user.id, now).count()
+        try:
+            with transaction.atomic():
+                job = RevealJob.objects.create(
+                    user=user,
+                    playlist_id=playlist.playlist_id,
+                    cutoff=now,
+                    total=total,
+                    # nothing to reveal, no need to wait for the worker
+                    status='queued' if total else 'completed',
+                    finished_at=None if total else now,
+                )
+        except IntegrityError:
+            # a concurrent request queued one first
+            return RevealJob.objects.get(user=user, status__in=RevealJob.ACTIVE_STATUSES), False
+        return job, True
+
+    @staticmethod
+    def claim():
+        """take the oldest queued job, or a running one whose worker stopped heartbeating"""
+        stale = timezone.now() - timedelta(seconds=settings.REVEAL_JOB_SETTINGS['STALE_AFTER_SECONDS'])
+        with transaction.atomic():
+            job = RevealJob.objects.select_for_update(skip_locked=True).filter(
+                Q(status='queued') | Q(status='running', updated_at__lt=stale)
+            ).order_by('updated_at').first()
+            if job is None:
+                return None
+            job.status = 'running'
+            job.started_at = job.started_at or timezone.now()
+            # a fresh lease, whoever held the job before can't write to it anymore
+            job.lease = uuid.uuid4()
+            job.save(update_fields=['status', 'started_at', 'lease', 'updated_at'])
+        return job
+
+    @staticmethod
+    def heartbeat(job: RevealJob, **fields):
+        """save fields and refresh updated_at, raises RevealJobLost once the lease is gone"""
+        fields['updated_at'] = timezone.now()
+        if not RevealJob.objects.filter(id=job.id, status='running', lease=job.lease).update(**fields):
+            raise RevealJobLost(f'Reveal job {job.id} was claimed by another worker')
+        for name, value in fields.items():
+            setattr(job, name, value)
+
+    @staticmethod
+    def run(job: RevealJob, spotify, batch_size: int = None) -> RevealJob:
+        """reveal the job's tracks a batch at a time, picking up after last_track_id
+
+        each batch is one set of chunked playlist writes, then a locking read
+        of the tracks still revealable and one UPDATE, committed together with
+        the resume point. the playlist is read first, so tracks
+        a crashed attempt already added aren't added twice.
+
+        every chunk write is preceded by a heartbeat, so a slow batch isn't
+        mistaken for a dead worker, and a worker that lost its lease stops
+        with RevealJobLost before writing anything else.
+        """
+        batch_size = batch_size or settings.REVEAL_JOB_SETTINGS['BATCH_SIZE']
+        present = {
+            item['track']['id']
+            for item in spotify.iter_playlist_tracks(job.playlist_id, fields=PLAYLIST_ID_FIELDS)
+            if (item.get('track') or {}).get('id')
+        }
+        tracks = RevealJobService.revealable(job.user_id, job.cutoff).order_by('id')
+
+        while True:
+            batch = list(
+                tracks.filter(id__gt=job.last_track_id).values_list('id', 'metadata__spotify_id')[:batch_size]
+            )
+            if not batch:
+                break
+
+            added = playlist_diff(present, add=[spotify_id for _, spotify_id in batch])['added']
+            for chunk in playlist_chunks(added, spotify.PLAYLIST_WRITE_SIZE):
+                RevealJobService.heartbeat(job)
+                spotify.add_tracks_to_playlist(job.playlist_id, chunk)
+                present.update(chunk)
+
+            with transaction.atomic():
+                # tracks revealed by hand meanwhile don't match anymore and aren't counted
+                revealed_ids = list(tracks.select_for_update().filter(
+                    id__in=[track_id for track_id, _ in batch]
+                ).values_list('id', flat=True))
+                # the tracks only change if the lease is still ours, otherwise this rolls back
+                RevealJobService.heartbeat(
+                    job,
+                    last_track_id=batch[-1][0],
+                    revealed=job.revealed + len(revealed_ids)
+                )
+                if revealed_ids:
+                    Track.objects.filter(id__in=revealed_ids).update(status='revealed', revealed_at=timezone.now())
+            if revealed_ids:
+                vault_versions.bump(job.user_id)
+                vault_events.publish(job.user_id, 'revealed', track_ids=revealed_ids)
+
+        RevealJobService.heartbeat(job, status='completed', finished_at=timezone.now())
+        return job
+
+    @staticmethod
+    def requeue(job: RevealJob):
+        # picked up again on the next pass, from last_track_id
+        RevealJobService.heartbeat(job, status='queued', lease=None)
+
+    @staticmethod
+    def fail(job: RevealJob, error: str):
+        RevealJobService.heartbeat(job, status='failed', error=error, finished_at=timezone.now())
@@ -0,0 +1,335 @@
+import asyncio
+import random
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict
+from django.conf import settings
+from django.utils import timezone
+
+class SpotifyRateLimited(Exception):
+    """spotify or our own budget says slow down"""
+    def __init__(self, message: str, retry_after: float = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class SpotifyUnavailable(Exception):
+    """circuit is open, spotify looks degraded"""
+    def __init__(self, message: str, retry_after: float = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def parse_retry_after(value, default: float = 1) -> float:
+    """Retry-After as seconds, it may be a number of seconds or an http date"""
+    if value is None:
+        return default
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(value) - timezone.now()).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+class TokenBucket:
+    """thread-safe token bucket that hands out reservations instead of blocking"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0  # set from spotify's Retry-After
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float):
+        """take a token, returns seconds to wait before using it or None if over max_wait"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # tokens may go negative, each reservation queues behind the previous ones
+            wait = max((1 - self.tokens) / self.rate if self.tokens < 1 else 0, self.blocked_until - now)
+            if wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def retry_after(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            return max(1, (1 - tokens) / self.rate, self.blocked_until - now)
+
+    def release(self):
+        # hand back a reservation we ended up not using
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def block(self, seconds: float):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class CircuitBreaker:
+    """closed -> open after consecutive failures, half-open lets one probe through"""
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def admit(self):
+        """'closed' or 'probe' when a call may go through, None when it's rejected"""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return 'closed'
+            if state == 'half-open' and not self.probing:
+                self.probing = True
+                return 'probe'
+            return None
+
+    def allow(self) -> bool:
+        return self.admit() is not None
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0
+        return max(0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def release_probe(self):
+        # the probe never reached spotify (throttled, cancelled), let the next call probe instead
+        with self._lock:
+            self.probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self) -> bool:
+        """returns True when this failure opened the circuit"""
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                opened = self.opened_at is None or self.probing
+                self.opened_at = time.monotonic()
+                self.probing = False
+                return opened
+            return False
+
+class RequestScheduler:
+    """central gate for spotify api traffic
+
+    every call takes a token from the app-wide bucket and the caller's user
+    bucket, 429s are retried after Retry-After (plus jitter) and repeated
+    5xx/connection failures open a circuit breaker that fails fast.
+    """
+    RETRY_STATUSES = {500, 502, 503, 504}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._user_buckets = OrderedDict()
+        self._app_bucket = None
+        self._breaker = None
+        self.metrics = defaultdict(int)
+        self.queue_depth = 0
+
+    @property
+    def config(self) -> Dict:
+        return settings.SPOTIFY_RATE_LIMIT
+
+    @property
+    def app_bucket(self) -> TokenBucket:
+        if self._app_bucket is None:
+            self._app_bucket = TokenBucket(self.config['APP_RATE'], self.config['APP_BURST'])
+        return self._app_bucket
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        if self._breaker is None:
+            self._breaker = CircuitBreaker(self.config['BREAKER_FAILURES'], self.config['BREAKER_RESET_SECONDS'])
+        return self._breaker
+
+    def user_bucket(self, user_key) -> TokenBucket:
+        # bounded lru so idle users don't accumulate forever
+        with self._lock:
+            bucket = self._user_buckets.get(user_key)
+            if bucket is None:
+                bucket = TokenBucket(self.config['USER_RATE'], self.config['USER_BURST'])
+                self._user_buckets[user_key] = bucket
+                while len(self._user_buckets) > self.config['TRACKED_USERS']:
+                    self._user_buckets.popitem(last=False)
+            else:
+                self._user_buckets.move_to_end(user_key)
+            return bucket
+
+    def _count(self, metric: str, amount: int = 1):
+        with self._lock:
+            self.metrics[metric] += amount
+
+    def _queue(self, delta: int):
+        with self._lock:
+            self.queue_depth += delta
+            self.metrics['max_queue_depth'] = max(self.metrics['max_queue_depth'], self.queue_depth)
+
+    def _admit(self, user_key):
+        """reserve app and user tokens, returns (wait before sending, whether the call is the breaker's probe)
+
+        the breaker is asked last, so a half-open probe is only taken by a
+        call that's actually going to be sent.
+        """
+        max_wait = self.config['MAX_QUEUE_WAIT']
+        user_wait = 0
+        user_bucket = None
+        if user_key is not None:
+            user_bucket = self.user_bucket(user_key)
+            user_wait = user_bucket.reserve(max_wait)
+            if user_wait is None:
+                self._count('throttled_user')
+                raise SpotifyRateLimited('Too many Spotify requests for this user', user_bucket.retry_after())
+
+        app_wait = self.app_bucket.reserve(max_wait)
+        if app_wait is None:
+            if user_bucket:
+                user_bucket.release()
+            self._count('throttled_app')
+            raise SpotifyRateLimited('Too many Spotify requests', self.app_bucket.retry_after())
+
+        admitted = self.breaker.admit()
+        if admitted is None:
+            if user_bucket:
+                user_bucket.release()
+            self.app_bucket.release()
+            self._count('circuit_rejected')
+            raise SpotifyUnavailable('Spotify is temporarily unavailable', self.breaker.retry_after())
+
+        wait = max(user_wait, app_wait)
+        if wait:
+            self._count('throttle_waits')
+        return wait, admitted == 'probe'
+
+    def _retry_delay(self, outcome: str, attempt: int) -> float:
+        """seconds to sleep before the next attempt"""
+        jitter = random.uniform(0, self.config['RETRY_JITTER'])
+        if outcome == 'rate_limited':
+            # the app bucket is blocked for Retry-After, admission does the waiting
+            return jitter
+        # server errors and dropped connections back off exponentially
+        return self.config['RETRY_BACKOFF'] * (2 ** attempt) + jitter
+
+    def _classify(self, response=None, error: Exception = None):
+        """feed the breaker, returns 'rate_limited' or 'failed' when the call could be retried"""
+        if error is not None or response.status_code in self.RETRY_STATUSES:
+            if self.breaker.record_failure():
+                self._count('circuit_opened')
+            return 'failed'
+        # a 429 still means spotify is up
+        self.breaker.record_success()
+        if response.status_code == 429:
+            self._count('rate_limited_429')
+            # spotify's limit is app-wide, make every caller back off
+            self.app_bucket.block(parse_retry_after(response.headers.get('Retry-After')))
+            return 'rate_limited'
+        return None
+
+    def _should_retry(self, outcome, attempt: int, retry_errors: bool) -> bool:
+        if outcome is None or attempt == self.config['MAX_RETRIES']:
+            return False
+        # failed writes may have been applied, only 429s are safe to resend
+        return outcome == 'rate_limited' or retry_errors
+
+    def execute(self, send: Callable, user_key=None, retry_errors: bool = True):
+        """run send() under the app and user budgets, with retries and the breaker"""
+        self._count('requests')
+        for attempt in range(self.config['MAX_RETRIES'] + 1):
+            wait, probe = self._admit(user_key)
+            response, error, outcome = None, None, None
+            classified = False
+            try:
+                if wait:
+                    self._queue(1)
+                    try:
+                        time.sleep(wait)
+                    finally:
+                        self._queue(-1)
+                try:
+                    response = send()
+                except Exception as e:
+                    error = e
+                outcome = self._classify(response, error)
+                classified = True
+            finally:
+                if probe and not classified:
+                    # interrupted before the breaker heard back, don't leave a probe hanging
+                    self.breaker.release_probe()
+            if not self._should_retry(outcome, attempt, retry_errors):
+                break
+            self._count('retries')
+            time.sleep(self._retry_delay(outcome, attempt))
+
+        return self._finish(response, error)
+
+    async def aexecute(self, send: Callable, user_key=None, retry_errors: bool = True):
+        """async execute, send() must return an awaitable"""
+        self._count('requests')
+        for attempt in range(self.config['MAX_RETRIES'] + 1):
+            wait, probe = self._admit(user_key)
+            response, error, outcome = None, None, None
+            classified = False
+            try:
+                if wait:
+                    self._queue(1)
+                    try:
+                        await asyncio.sleep(wait)
+                    finally:
+                        self._queue(-1)
+                try:
+                    response = await send()
+                except Exception as e:
+                    error = e
+                outcome = self._classify(response, error)
+                classified = True
+            finally:
+                if probe and not classified:
+                    # cancelled before the breaker heard back, don't leave a probe hanging
+                    self.breaker.release_probe()
+            if not self._should_retry(outcome, attempt, retry_errors):
+                break
+            self._count('retries')
+            await asyncio.sleep(self._retry_delay(outcome, attempt))
+
+        return self._finish(response, error)
+
+    def _finish(self, response, error):
+        if error is not None:
+            raise error
+        if response.status_code == 429:
+            raise SpotifyRateLimited(
+                'Spotify rate limit exceeded', parse_retry_after(response.headers.get('Retry-After'))
+            )
+        return response
+
+    def stats(self) -> Dict:
+        """scheduler metrics for this process"""
+        with self._lock:
+            return {
+                **self.metrics,
+                'queue_depth': self.queue_depth,
+                'tracked_users': len(self._user_buckets),
+                'circuit': self.breaker.state,
+            }
+
+scheduler = RequestScheduler()
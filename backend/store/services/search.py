@@ -0,0 +1,93 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from typing import Dict, List, Optional
+from store.services.spotify_cache import spotify_cache
+from store.services.vault import vault_versions
+
+def normalize_query(query: str) -> str:
+    # spotify search ignores case and extra spaces, so "Daft  Punk" and "daft punk" share an entry
+    return ' '.join(query.casefold().split())
+
+def format_search_track(track):
+    """shape a spotify search item like an unsaved vault track"""
+    return {
+        'id': 0,  # temporary id since it's not saved yet
+        'metadata': {
+            'spotify_id': track['id'],
+            'title': track['name'],
+            'artist': ', '.join(artist['name'] for artist in track['artists']),
+            'album': track['album']['name'],
+            'image_url': track['album']['images'][0]['url'] if track['album']['images'] else '/placeholder-album.jpg',
+            'preview_url': track['preview_url'],
+            'release_date': track['album']['release_date']
+        },
+        'status': 'active'  # default status for search results
+    }
+
+def format_search_results(results: Dict) -> Dict:
+    """formatted items, complete when spotify had nothing beyond them"""
+    items = results['tracks']['items']
+    return {
+        'tracks': [format_search_track(track) for track in items if track],
+        'complete': results['tracks'].get('total', len(items) + 1) <= len(items),
+    }
+
+def prefix_params(query: str, limit: int) -> List[Dict]:
+    """cache params of the query's shorter prefixes, longest first"""
+    shortest = settings.SEARCH_SETTINGS['PREFIX_MIN_LENGTH']
+    prefixes = dict.fromkeys(normalize_query(query[:end]) for end in range(len(query) - 1, shortest - 1, -1))
+    return [{'q': prefix, 'limit': limit} for prefix in prefixes if len(prefix) >= shortest]
+
+def from_prefix(cached: List[Dict], query: str) -> Optional[Dict]:
+    """narrow the longest complete prefix result down to the query, None without one
+
+    spotify matches the words against title, artist and album, so what a
+    longer query finds is among the matches of a complete shorter one.
+    """
+    complete = next((result for result in cached if result['complete']), None)
+    if complete is None:
+        return None
+    words = query.split()
+    return {
+        'tracks': [
+            track for track in complete['tracks']
+            if all(word in normalize_query(' '.join([
+                track['metadata']['title'], track['metadata']['artist'], track['metadata']['album']
+            ])) for word in words)
+        ],
+        'complete': True,
+    }
+
+def mark_vaulted(tracks: List[Dict], vaulted: frozenset) -> List[Dict]:
+    return [{**track, 'in_vault': track['metadata']['spotify_id'] in vaulted} for track in tracks]
+
+class SearchService:
+    """typeahead search: formatted results are cached once for every user,
+    only the in_vault flag is worked out per user, against the cached vault index.
+    a miss is answered from a cached shorter prefix when spotify returned all
+    of that prefix's matches, so typing on past a narrow query costs no call."""
+
+    @staticmethod
+    def search(spotify, user_id: int, query: str, limit: int = 15) -> List[Dict]:
+        query = normalize_query(query)
+
+        def fetch():
+            reused = from_prefix(spotify_cache.peek_many('search', prefix_params(query, limit)), query)
+            if reused is not None:
+                return reused
+            return format_search_results(spotify.search_tracks(query, limit, use_cache=False))
+        # concurrent identical keystrokes from any user share one spotify call
+        result = spotify_cache.get_or_fetch('search', {'q': query, 'limit': limit}, fetch)
+        return mark_vaulted(result['tracks'], vault_versions.locked_ids(user_id))
+
+    @staticmethod
+    async def asearch(spotify, user_id: int, query: str, limit: int = 15) -> List[Dict]:
+        query = normalize_query(query)
+
+        async def fetch():
+            reused = from_prefix(await spotify_cache.apeek_many('search', prefix_params(query, limit)), query)
+            if reused is not None:
+                return reused
+            return format_search_results(await spotify.search_tracks(query, limit, use_cache=False))
+        result = await spotify_cache.aget_or_fetch('search', {'q': query, 'limit': limit}, fetch)
+        return mark_vaulted(result['tracks'], await sync_to_async(vault_versions.locked_ids)(user_id))
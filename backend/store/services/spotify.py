@@ -1,20 +1,110 @@
-from typing import Dict
+from typing import Dict, Iterator, List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from django.conf import settings
-import os
+from django.core.cache import cache
 from urllib.parse import urlencode
+from store.services.spotify_cache import spotify_cache
+from store.services.scheduler import scheduler
+
+# shared keep-alive session, one per process
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    """get the process-wide pooled session used for all spotify calls"""
+    global _session, _session_pid
+    # rebuild after fork so workers never share sockets with the parent
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                config = settings.SPOTIFY_HTTP
+                adapter = HTTPAdapter(
+                    pool_connections=config['POOL_CONNECTIONS'],
+                    pool_maxsize=config['POOL_MAXSIZE'],
+                    pool_block=config['POOL_BLOCK'],
+                )
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+                _session_pid = os.getpid()
+    return _session
+
+def get_timeout() -> tuple:
+    """(connect, read) timeout for spotify calls"""
+    config = settings.SPOTIFY_HTTP
+    return (config['CONNECT_TIMEOUT'], config['READ_TIMEOUT'])
+
+# only the track ids are needed to diff a playlist
+PLAYLIST_ID_FIELDS = 'items(track(id)),total,next'
+
+def playlist_chunks(track_ids: list, size: int) -> List[list]:
+    return [track_ids[i:i + size] for i in range(0, len(track_ids), size)]
+
+def playlist_diff(present: set, add: list = (), remove: list = ()) -> Dict:
+    """what actually has to change for the playlist to hold `add` and not `remove`
+
+    an id asked to be both added and removed is added.
+    """
+    add = list(dict.fromkeys(add))
+    wanted = set(add)
+    remove = [track_id for track_id in dict.fromkeys(remove) if track_id not in wanted]
+    return {
+        'added': [track_id for track_id in add if track_id not in present],
+        'removed': [track_id for track_id in remove if track_id in present],
+        'unchanged': (
+            [track_id for track_id in add if track_id in present]
+            + [track_id for track_id in remove if track_id not in present]
+        ),
+    }
 
 class SpotifyService:
     BASE_URL = 'https://api.spotify.com/v1'
     AUTH_URL = 'https://accounts.spotify.com/api/token'
     AUTH_ENDPOINT = 'https://accounts.spotify.com/authorize'
+    REVOKE_URL = 'https://accounts.spotify.com/api/token/revoke'
+    TRACKS_BATCH_SIZE = 50  # spotify's max ids per /tracks call
+    PAGE_SIZE = 50  # spotify's max page size for library/playlist listings
+    PLAYLIST_WRITE_SIZE = 100  # spotify's max uris per playlist add/remove call
 
-    def __init__(self, access_token: str = None):
+    def __init__(self, access_token: str = None, user_id: int = None):
         self.access_token = access_token
+        self.user_id = user_id  # scopes cached /me/* responses
         self.client_id = settings.SPOTIFY_CLIENT_ID
         self.client_secret = settings.SPOTIFY_CLIENT_SECRET
         self.redirect_uri = settings.SPOTIFY_REDIRECT_URI
 
+    def _auth_headers(self) -> Dict:
+        config = settings.SPOTIFY_HTTP
+        return {config['AUTH_HEADER']: f"{config['AUTH_SCHEME']} {self.access_token}"}
+
+    def _request(self, method: str, url: str, authenticated: bool = True, **kwargs) -> requests.Response:
+        """send a request through the shared keep-alive session"""
+        headers = kwargs.pop('headers', {})
+        kwargs.setdefault('timeout', get_timeout())
+        if not authenticated:
+            return get_session().request(method, url, headers=headers, **kwargs)
+
+        # api calls go through the rate limit scheduler
+        headers = {**self._auth_headers(), **headers}
+        return scheduler.execute(
+            lambda: get_session().request(method, url, headers=headers, **kwargs),
+            user_key=self.user_id,
+            retry_errors=method == 'GET',
+        )
+
+    def _user_cached(self, endpoint: str, params: Dict, fetch):
+        # /me data is only cached when we know whose it is
+        if self.user_id is None:
+            return fetch()
+        return spotify_cache.get_or_fetch(endpoint, params, fetch, user_id=self.user_id)
+
     def get_auth_url(self) -> str:
         """Get Spotify OAuth URL."""
         params = {
@@ -29,7 +119,7 @@ class SpotifyService:
 
     @staticmethod
     def exchange_code(code: str) -> Dict:
-        response = requests.post(
+        response = get_session().post(
             SpotifyService.AUTH_URL,
             data={
                 'grant_type': 'authorization_code',
@@ -37,33 +127,62 @@ class SpotifyService:
                 'redirect_uri': settings.SPOTIFY_REDIRECT_URI,
                 'client_id': settings.SPOTIFY_CLIENT_ID,
                 'client_secret': settings.SPOTIFY_CLIENT_SECRET,
-            }
+            },
+            timeout=get_timeout()
         )
         if not response.ok:
             print(f"Spotify token exchange error: {response.text}")
         return response.json()
 
-    def search_tracks(self, query: str, limit: int = 15) -> Dict:
-        response = requests.get(
-            f'{self.BASE_URL}/search',
-            headers={'Authorization': f'Bearer {self.access_token}'},
-            params={'q': query, 'type': 'track', 'limit': limit}
-        )
-        return response.json()
+    @classmethod
+    def for_app(cls) -> 'SpotifyService':
+        """service on a client-credentials token, for catalog calls that need no user"""
+        token = cache.get('spotify:app_token')
+        if token is None:
+            response = get_session().post(
+                cls.AUTH_URL,
+                data={
+                    'grant_type': 'client_credentials',
+                    'client_id': settings.SPOTIFY_CLIENT_ID,
+                    'client_secret': settings.SPOTIFY_CLIENT_SECRET,
+                },
+                timeout=get_timeout()
+            )
+            if not response.ok:
+                raise Exception(f"failed to get app token: {response.status_code} - {response.text}")
+            data = response.json()
+            token = data['access_token']
+            # shared by every worker until shortly before it expires
+            cache.set('spotify:app_token', token, max(data.get('expires_in', 3600) - 60, 1))
+        return cls(token)
+
+    def search_tracks(self, query: str, limit: int = 15, use_cache: bool = True) -> Dict:
+        params = {'q': query, 'type': 'track', 'limit': limit}
+
+        def fetch():
+            response = self._request('GET', f'{self.BASE_URL}/search', params=params)
+            if not response.ok:
+                raise Exception(f"Failed to search tracks: {response.text}")
+            return response.json()
+        if not use_cache:
+            return fetch()
+        return spotify_cache.get_or_fetch('search', params, fetch)
 
     def get_user_playlists(self) -> Dict:
-        response = requests.get(
-            f'{self.BASE_URL}/me/playlists',
-            headers={'Authorization': f'Bearer {self.access_token}'},
-            params={'limit': 50}  # adjust limit as needed
-        )
-        if not response.ok:
-            raise Exception(f"Failed to fetch playlists: {response.text}")
-        return response.json()
+        params = {'limit': 50}  # adjust limit as needed
+
+        def fetch():
+            response = self._request('GET', f'{self.BASE_URL}/me/playlists', params=params)
+            if not response.ok:
+                raise Exception(f"Failed to fetch playlists: {response.text}")
+            return response.json()
+        return self._user_cached('me/playlists', params, fetch)
 
     def refresh_token(self, refresh_token: str) -> Dict:
-        response = requests.post(
+        response = self._request(
+            'POST',
             self.AUTH_URL,
+            authenticated=False,
             data={
                 'grant_type': 'refresh_token',
                 'refresh_token': refresh_token,
@@ -77,9 +196,9 @@ class SpotifyService:
         return response.json()
 
     def get_playlist_tracks(self, playlist_id: str) -> Dict:
-        response = requests.get(
+        response = self._request(
+            'GET',
             f'{self.BASE_URL}/playlists/{playlist_id}/tracks',
-            headers={'Authorization': f'Bearer {self.access_token}'},
             params={'limit': 50}  # adjust limit as needed
         )
         if not response.ok:
@@ -88,49 +207,52 @@ class SpotifyService:
 
     def get_user_top_tracks(self, limit: int = 20) -> Dict:
         """Get user's top tracks."""
-        response = requests.get(
-            f'{self.BASE_URL}/me/top/tracks',
-            headers={'Authorization': f'Bearer {self.access_token}'},
-            params={
-                'limit': limit,
-                'time_range': 'medium_term'
-            }
-        )
-        if not response.ok:
-            raise Exception(f"Failed to fetch top tracks: {response.text}")
-        return response.json()
+        params = {
+            'limit': limit,
+            'time_range': 'medium_term'
+        }
+
+        def fetch():
+            response = self._request('GET', f'{self.BASE_URL}/me/top/tracks', params=params)
+            if not response.ok:
+                raise Exception(f"Failed to fetch top tracks: {response.text}")
+            return response.json()
+        return self._user_cached('me/top/tracks', params, fetch)
 
     def get_user_saved_tracks(self, limit: int = 20) -> Dict:
         """Get user's saved tracks as fallback."""
-        response = requests.get(
-            f'{self.BASE_URL}/me/tracks',
-            headers={'Authorization': f'Bearer {self.access_token}'},
-            params={'limit': limit}
-        )
-        if not response.ok:
-            raise Exception(f"Failed to fetch saved tracks: {response.text}")
-        return response.json()
+        params = {'limit': limit}
+
+        def fetch():
+            response = self._request('GET', f'{self.BASE_URL}/me/tracks', params=params)
+            if not response.ok:
+                raise Exception(f"Failed to fetch saved tracks: {response.text}")
+            return response.json()
+        return self._user_cached('me/tracks', params, fetch)
 
     def get_recommendations(self, seed_tracks: list, limit: int = 20) -> Dict:
         """Get recommendations based on seed tracks."""
-        response = requests.get(
-            f'{self.BASE_URL}/recommendations',
-            headers={'Authorization': f'Bearer {self.access_token}'},
-            params={
-                'seed_tracks': ','.join(seed_tracks[:3]),  # spotify limit
-                'limit': limit
-            }
-        )
-        if not response.ok:
-            raise Exception(f"Failed to fetch recommendations: {response.text}")
-        return response.json()
+        params = {
+            'seed_tracks': ','.join(seed_tracks[:3]),  # spotify limit
+            'limit': limit
+        }
+
+        def fetch():
+            response = self._request('GET', f'{self.BASE_URL}/recommendations', params=params)
+            if not response.ok:
+                raise Exception(f"Failed to fetch recommendations: {response.text}")
+            return response.json()
+        return spotify_cache.get_or_fetch('recommendations', params, fetch)
 
-    def get_recently_played(self, limit: int = 6) -> Dict:
-        """get user's recently played tracks"""
-        response = requests.get(
+    def get_recently_played(self, limit: int = 6, after: int = None) -> Dict:
+        """get user's recently played tracks, after is a unix ms cursor"""
+        params = {'limit': limit}
+        if after is not None:
+            params['after'] = after
+        response = self._request(
+            'GET',
             f'{self.BASE_URL}/me/player/recently-played',
-            headers={'Authorization': f'Bearer {self.access_token}'},
-            params={'limit': limit}
+            params=params
         )
         if not response.ok:
             raise Exception(f"failed to fetch recent tracks: {response.text}")
@@ -138,8 +260,10 @@ class SpotifyService:
 
     def get_access_token(self, code: str) -> Dict:
         """Exchange code for tokens."""
-        response = requests.post(
+        response = self._request(
+            'POST',
             self.AUTH_URL,
+            authenticated=False,
             data={
                 'grant_type': 'authorization_code',
                 'code': code,
@@ -154,43 +278,73 @@ class SpotifyService:
         
         return response.json()
 
-    def add_tracks_to_playlist(self, playlist_id: str, track_uris: list) -> Dict:
-        """Add tracks to a playlist."""
-        response = requests.post(
-            f'{self.BASE_URL}/playlists/{playlist_id}/tracks',
-            headers={'Authorization': f'Bearer {self.access_token}'},
-            json={'uris': [f'spotify:track:{track_id}' for track_id in track_uris]}
-        )
+    def _write_playlist_chunk(self, method: str, playlist_id: str, body: Dict) -> Dict:
+        response = self._request(method, f'{self.BASE_URL}/playlists/{playlist_id}/tracks', json=body)
         if not response.ok:
-            raise Exception(f"Failed to add tracks to playlist: {response.text}")
+            action = 'add tracks to' if method == 'POST' else 'remove tracks from'
+            raise Exception(f"Failed to {action} playlist: {response.text}")
         return response.json()
 
-    def remove_tracks_from_playlist(self, playlist_id: str, track_uris: list) -> Dict:
+    def _write_playlist(self, method: str, playlist_id: str, bodies: List[Dict]) -> Dict:
+        """send playlist writes concurrently, returns the snapshot of the last one to finish"""
+        if len(bodies) <= 1:
+            return self._write_playlist_chunk(method, playlist_id, bodies[0]) if bodies else {}
+        result = {}
+        workers = min(len(bodies), settings.SPOTIFY_HTTP['BATCH_CONCURRENCY'])
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._write_playlist_chunk, method, playlist_id, body) for body in bodies]
+            for future in as_completed(futures):
+                result = future.result()
+        return result
+
+    def add_tracks_to_playlist(self, playlist_id: str, track_uris: list) -> Dict:
+        """Add tracks to a playlist."""
+        # chunks are appended concurrently, order is only kept within a chunk
+        return self._write_playlist('POST', playlist_id, [
+            {'uris': [f'spotify:track:{track_id}' for track_id in chunk]}
+            for chunk in playlist_chunks(track_uris, self.PLAYLIST_WRITE_SIZE)
+        ])
+
+    def remove_tracks_from_playlist(self, playlist_id: str, track_uris: list, snapshot_id: str = None) -> Dict:
         """Remove tracks from a playlist."""
-        response = requests.delete(
-            f'{self.BASE_URL}/playlists/{playlist_id}/tracks',
-            headers={'Authorization': f'Bearer {self.access_token}'},
-            json={'tracks': [{'uri': f'spotify:track:{track_id}'} for track_id in track_uris]}
-        )
-        if not response.ok:
-            raise Exception(f"Failed to remove tracks from playlist: {response.text}")
-        return response.json()
+        snapshot = {'snapshot_id': snapshot_id} if snapshot_id else {}
+        return self._write_playlist('DELETE', playlist_id, [
+            {'tracks': [{'uri': f'spotify:track:{track_id}'} for track_id in chunk], **snapshot}
+            for chunk in playlist_chunks(track_uris, self.PLAYLIST_WRITE_SIZE)
+        ])
+
+    def sync_playlist(self, playlist_id: str, add: list = (), remove: list = ()) -> Dict:
+        """bring a playlist in line with the wanted adds and removes, sending only the difference"""
+        snapshot_id = self._get_page(
+            f'{self.BASE_URL}/playlists/{playlist_id}',
+            {'fields': 'snapshot_id'}
+        )['snapshot_id']
+        present = {
+            item['track']['id']
+            for item in self.iter_playlist_tracks(playlist_id, fields=PLAYLIST_ID_FIELDS)
+            if (item.get('track') or {}).get('id')
+        }
+        diff = playlist_diff(present, add, remove)
+
+        # removals are pinned to the snapshot the diff was computed against
+        if diff['removed']:
+            snapshot_id = self.remove_tracks_from_playlist(playlist_id, diff['removed'], snapshot_id)['snapshot_id']
+        if diff['added']:
+            snapshot_id = self.add_tracks_to_playlist(playlist_id, diff['added'])['snapshot_id']
+        return {'snapshot_id': snapshot_id, **diff}
 
     def create_playlist(self, name: str = "My Vault Playlist") -> Dict:
         """Create a new playlist for the user."""
         # get user id first
-        user_response = requests.get(
-            f'{self.BASE_URL}/me',
-            headers={'Authorization': f'Bearer {self.access_token}'}
-        )
+        user_response = self._request('GET', f'{self.BASE_URL}/me')
         if not user_response.ok:
             raise Exception(f"Failed to get user info: {user_response.text}")
         user_id = user_response.json()['id']
 
         # create playlist
-        response = requests.post(
+        response = self._request(
+            'POST',
             f'{self.BASE_URL}/users/{user_id}/playlists',
-            headers={'Authorization': f'Bearer {self.access_token}'},
             json={
                 'name': name,
                 'description': 'Created by Vault - Your personal music time capsule',
@@ -199,18 +353,146 @@ class SpotifyService:
         )
         if not response.ok:
             raise Exception(f"Failed to create playlist: {response.text}")
+
+        # the cached playlist list no longer includes everything
+        if self.user_id is not None:
+            spotify_cache.delete('me/playlists', {'limit': 50}, user_id=self.user_id)
         return response.json()
 
     def get_track(self, track_id: str) -> Dict:
         """get track metadata by id"""
-        try:
-            response = requests.get(
-                f'{self.BASE_URL}/tracks/{track_id}',
-                headers={'Authorization': f'Bearer {self.access_token}'}
-            )
+        def fetch():
+            response = self._request('GET', f'{self.BASE_URL}/tracks/{track_id}')
             if not response.ok:
                 raise Exception(f"failed to fetch track: {response.status_code} - {response.text}")
             return response.json()
+
+        try:
+            # shares entries with get_tracks
+            return spotify_cache.get_or_fetch('track', {'id': track_id}, fetch)
         except Exception as e:
             raise Exception(f"failed to fetch track: {str(e)}")
-    
\ No newline at end of file
+
+    def _get_tracks_chunk(self, track_ids: List[str]) -> List:
+        response = self._request(
+            'GET',
+            f'{self.BASE_URL}/tracks',
+            params={'ids': ','.join(track_ids)}
+        )
+        if not response.ok:
+            raise Exception(f"failed to fetch tracks: {response.status_code} - {response.text}")
+        return response.json()['tracks']
+
+    def get_tracks(self, track_ids: List[str], use_cache: bool = True) -> Dict:
+        """get metadata for any number of tracks, chunked and fetched concurrently"""
+        track_ids = list(dict.fromkeys(track_ids))  # dedupe, keep input order
+        cached = spotify_cache.get_many('track', track_ids) if use_cache else {}
+        to_fetch = [track_id for track_id in track_ids if track_id not in cached]
+        chunks = [
+            to_fetch[i:i + self.TRACKS_BATCH_SIZE]
+            for i in range(0, len(to_fetch), self.TRACKS_BATCH_SIZE)
+        ]
+        if len(chunks) <= 1:
+            results = [self._get_tracks_chunk(chunk) for chunk in chunks]
+        else:
+            workers = min(len(chunks), settings.SPOTIFY_HTTP['BATCH_CONCURRENCY'])
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(self._get_tracks_chunk, chunks))
+
+        # spotify returns null for unknown ids, in request order
+        fetched = {}
+        for chunk, chunk_tracks in zip(chunks, results):
+            for track_id, track in zip(chunk, chunk_tracks):
+                if track is not None:
+                    fetched[track_id] = track
+        spotify_cache.set_many('track', fetched)
+
+        found = {**cached, **fetched}
+        return {
+            'tracks': [found[track_id] for track_id in track_ids if track_id in found],
+            'missing': [track_id for track_id in track_ids if track_id not in found],
+        }
+
+    def _get_page(self, url: str, params: Dict) -> Dict:
+        response = self._request('GET', url, params=params)
+        if not response.ok:
+            raise Exception(f"Failed to fetch page: {response.status_code} - {response.text}")
+        return response.json()
+
+    def _iter_pages(self, url: str, max_items: int = None, params: Dict = None) -> Iterator[Dict]:
+        """yield items from every page, prefetching a window of pages concurrently once total is known"""
+        params = {**(params or {}), 'limit': self.PAGE_SIZE}
+        page = self._get_page(url, {**params, 'offset': 0})
+        total = page.get('total')
+
+        if total is None:
+            # no total to plan with, just follow the next links
+            remaining = max_items
+            while True:
+                items = page['items'] if remaining is None else page['items'][:remaining]
+                yield from items
+                if remaining is not None:
+                    remaining -= len(items)
+                if not page.get('next') or remaining == 0:
+                    return
+                page = self._get_page(page['next'], {})
+
+        if max_items is not None:
+            total = min(total, max_items)
+        yield from page['items'][:total]
+
+        offsets = iter(range(self.PAGE_SIZE, total, self.PAGE_SIZE))
+        window = settings.SPOTIFY_HTTP['BATCH_CONCURRENCY']
+        executor = ThreadPoolExecutor(max_workers=window)
+        try:
+            # keep at most `window` pages in flight, yield them in order
+            pending = deque()
+            for offset in offsets:
+                pending.append((offset, executor.submit(self._get_page, url, {**params, 'offset': offset})))
+                if len(pending) >= window:
+                    break
+            while pending:
+                offset, future = pending.popleft()
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    pending.append((next_offset, executor.submit(self._get_page, url, {**params, 'offset': next_offset})))
+                yield from future.result()['items'][:total - offset]
+        finally:
+            # stop fetching if the consumer goes away early
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def iter_recently_played(self, after: int = 0) -> Iterator[Dict]:
+        """every play after the cursor, oldest page first, following spotify's after cursors"""
+        while True:
+            page = self.get_recently_played(limit=self.PAGE_SIZE, after=after)
+            yield from page['items']
+            cursor = (page.get('cursors') or {}).get('after')
+            if len(page['items']) < self.PAGE_SIZE or not cursor or int(cursor) <= after:
+                return
+            after = int(cursor)
+
+    def iter_user_playlists(self, max_items: int = None) -> Iterator[Dict]:
+        """lazily yield every playlist of the user"""
+        return self._iter_pages(f'{self.BASE_URL}/me/playlists', max_items)
+
+    def iter_playlist_tracks(self, playlist_id: str, max_items: int = None, fields: str = None) -> Iterator[Dict]:
+        """lazily yield every item of a playlist"""
+        params = {'fields': fields} if fields else None
+        return self._iter_pages(f'{self.BASE_URL}/playlists/{playlist_id}/tracks', max_items, params)
+
+    def iter_saved_tracks(self, max_items: int = None) -> Iterator[Dict]:
+        """lazily yield every saved track of the user"""
+        return self._iter_pages(f'{self.BASE_URL}/me/tracks', max_items)
+
+    def revoke_token(self) -> None:
+        """revoke the current access token"""
+        self._request(
+            'POST',
+            self.REVOKE_URL,
+            authenticated=False,
+            data={
+                'token': self.access_token,
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+            }
+        )
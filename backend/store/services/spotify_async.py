@@ -0,0 +1,401 @@
+import asyncio
+import weakref
+from typing import AsyncIterator, Dict, List
+import httpx
+from django.conf import settings
+from store.services.spotify import PLAYLIST_ID_FIELDS, SpotifyService, playlist_chunks, playlist_diff
+from store.services.spotify_cache import spotify_cache
+from store.services.scheduler import scheduler
+
+# one pooled client per event loop, clients can't be shared across loops
+_clients = weakref.WeakKeyDictionary()
+
+def get_client() -> httpx.AsyncClient:
+    """get the pooled async client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        config = settings.SPOTIFY_HTTP
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=config['ASYNC_MAX_CONNECTIONS'],
+                max_keepalive_connections=config['POOL_MAXSIZE'],
+            ),
+            timeout=httpx.Timeout(config['READ_TIMEOUT'], connect=config['CONNECT_TIMEOUT']),
+        )
+        _clients[loop] = client
+    return client
+
+class AsyncSpotifyService:
+    """asyncio counterpart of SpotifyService with the same method surface"""
+    BASE_URL = SpotifyService.BASE_URL
+    AUTH_URL = SpotifyService.AUTH_URL
+    AUTH_ENDPOINT = SpotifyService.AUTH_ENDPOINT
+    REVOKE_URL = SpotifyService.REVOKE_URL
+    TRACKS_BATCH_SIZE = SpotifyService.TRACKS_BATCH_SIZE
+    PAGE_SIZE = SpotifyService.PAGE_SIZE
+    PLAYLIST_WRITE_SIZE = SpotifyService.PLAYLIST_WRITE_SIZE
+
+    def __init__(self, access_token: str = None, user_id: int = None):
+        self.access_token = access_token
+        self.user_id = user_id  # scopes cached /me/* responses
+        self.client_id = settings.SPOTIFY_CLIENT_ID
+        self.client_secret = settings.SPOTIFY_CLIENT_SECRET
+        self.redirect_uri = settings.SPOTIFY_REDIRECT_URI
+
+    def _auth_headers(self) -> Dict:
+        config = settings.SPOTIFY_HTTP
+        return {config['AUTH_HEADER']: f"{config['AUTH_SCHEME']} {self.access_token}"}
+
+    async def _request(self, method: str, url: str, authenticated: bool = True, **kwargs) -> httpx.Response:
+        """send a request through the loop's pooled client"""
+        headers = kwargs.pop('headers', {})
+        if not authenticated:
+            return await get_client().request(method, url, headers=headers, **kwargs)
+
+        # api calls go through the rate limit scheduler
+        headers = {**self._auth_headers(), **headers}
+        return await scheduler.aexecute(
+            lambda: get_client().request(method, url, headers=headers, **kwargs),
+            user_key=self.user_id,
+            retry_errors=method == 'GET',
+        )
+
+    async def _user_cached(self, endpoint: str, params: Dict, fetch):
+        # /me data is only cached when we know whose it is
+        if self.user_id is None:
+            return await fetch()
+        return await spotify_cache.aget_or_fetch(endpoint, params, fetch, user_id=self.user_id)
+
+    def get_auth_url(self) -> str:
+        """Get Spotify OAuth URL."""
+        return SpotifyService().get_auth_url()
+
+    async def search_tracks(self, query: str, limit: int = 15, use_cache: bool = True) -> Dict:
+        params = {'q': query, 'type': 'track', 'limit': limit}
+
+        async def fetch():
+            response = await self._request('GET', f'{self.BASE_URL}/search', params=params)
+            if not response.is_success:
+                raise Exception(f"Failed to search tracks: {response.text}")
+            return response.json()
+        if not use_cache:
+            return await fetch()
+        return await spotify_cache.aget_or_fetch('search', params, fetch)
+
+    async def get_user_playlists(self) -> Dict:
+        params = {'limit': 50}
+
+        async def fetch():
+            response = await self._request('GET', f'{self.BASE_URL}/me/playlists', params=params)
+            if not response.is_success:
+                raise Exception(f"Failed to fetch playlists: {response.text}")
+            return response.json()
+        return await self._user_cached('me/playlists', params, fetch)
+
+    async def refresh_token(self, refresh_token: str) -> Dict:
+        response = await self._request(
+            'POST',
+            self.AUTH_URL,
+            authenticated=False,
+            data={
+                'grant_type': 'refresh_token',
+                'refresh_token': refresh_token,
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+            }
+        )
+        if not response.is_success:
+            print(f"Spotify token refresh error: {response.text}")
+            raise Exception('Failed to refresh token')
+        return response.json()
+
+    async def get_playlist_tracks(self, playlist_id: str) -> Dict:
+        response = await self._request(
+            'GET',
+            f'{self.BASE_URL}/playlists/{playlist_id}/tracks',
+            params={'limit': 50}
+        )
+        if not response.is_success:
+            raise Exception(f"Failed to fetch playlist tracks: {response.text}")
+        return response.json()
+
+    async def get_user_top_tracks(self, limit: int = 20) -> Dict:
+        """Get user's top tracks."""
+        params = {
+            'limit': limit,
+            'time_range': 'medium_term'
+        }
+
+        async def fetch():
+            response = await self._request('GET', f'{self.BASE_URL}/me/top/tracks', params=params)
+            if not response.is_success:
+                raise Exception(f"Failed to fetch top tracks: {response.text}")
+            return response.json()
+        return await self._user_cached('me/top/tracks', params, fetch)
+
+    async def get_user_saved_tracks(self, limit: int = 20) -> Dict:
+        """Get user's saved tracks as fallback."""
+        params = {'limit': limit}
+
+        async def fetch():
+            response = await self._request('GET', f'{self.BASE_URL}/me/tracks', params=params)
+            if not response.is_success:
+                raise Exception(f"Failed to fetch saved tracks: {response.text}")
+            return response.json()
+        return await self._user_cached('me/tracks', params, fetch)
+
+    async def get_recommendations(self, seed_tracks: list, limit: int = 20) -> Dict:
+        """Get recommendations based on seed tracks."""
+        params = {
+            'seed_tracks': ','.join(seed_tracks[:3]),  # spotify limit
+            'limit': limit
+        }
+
+        async def fetch():
+            response = await self._request('GET', f'{self.BASE_URL}/recommendations', params=params)
+            if not response.is_success:
+                raise Exception(f"Failed to fetch recommendations: {response.text}")
+            return response.json()
+        return await spotify_cache.aget_or_fetch('recommendations', params, fetch)
+
+    async def get_recently_played(self, limit: int = 6, after: int = None) -> Dict:
+        """get user's recently played tracks, after is a unix ms cursor"""
+        params = {'limit': limit}
+        if after is not None:
+            params['after'] = after
+        response = await self._request(
+            'GET',
+            f'{self.BASE_URL}/me/player/recently-played',
+            params=params
+        )
+        if not response.is_success:
+            raise Exception(f"failed to fetch recent tracks: {response.text}")
+        return response.json()
+
+    async def get_access_token(self, code: str) -> Dict:
+        """Exchange code for tokens."""
+        response = await self._request(
+            'POST',
+            self.AUTH_URL,
+            authenticated=False,
+            data={
+                'grant_type': 'authorization_code',
+                'code': code,
+                'redirect_uri': self.redirect_uri,
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+            }
+        )
+        if not response.is_success:
+            raise Exception(f"Failed to get access token: {response.text}")
+        return response.json()
+
+    async def _write_playlist_chunk(self, method: str, playlist_id: str, body: Dict, semaphore: asyncio.Semaphore) -> Dict:
+        # httpx only accepts a body on DELETE through the generic request call
+        async with semaphore:
+            response = await self._request(method, f'{self.BASE_URL}/playlists/{playlist_id}/tracks', json=body)
+        if not response.is_success:
+            action = 'add tracks to' if method == 'POST' else 'remove tracks from'
+            raise Exception(f"Failed to {action} playlist: {response.text}")
+        return response.json()
+
+    async def _write_playlist(self, method: str, playlist_id: str, bodies: List[Dict]) -> Dict:
+        """send playlist writes concurrently, returns the snapshot of the last one to finish"""
+        semaphore = asyncio.Semaphore(settings.SPOTIFY_HTTP['BATCH_CONCURRENCY'])
+        result = {}
+        for write in asyncio.as_completed([
+            self._write_playlist_chunk(method, playlist_id, body, semaphore) for body in bodies
+        ]):
+            result = await write
+        return result
+
+    async def add_tracks_to_playlist(self, playlist_id: str, track_uris: list) -> Dict:
+        """Add tracks to a playlist."""
+        # chunks are appended concurrently, order is only kept within a chunk
+        return await self._write_playlist('POST', playlist_id, [
+            {'uris': [f'spotify:track:{track_id}' for track_id in chunk]}
+            for chunk in playlist_chunks(track_uris, self.PLAYLIST_WRITE_SIZE)
+        ])
+
+    async def remove_tracks_from_playlist(self, playlist_id: str, track_uris: list, snapshot_id: str = None) -> Dict:
+        """Remove tracks from a playlist."""
+        snapshot = {'snapshot_id': snapshot_id} if snapshot_id else {}
+        return await self._write_playlist('DELETE', playlist_id, [
+            {'tracks': [{'uri': f'spotify:track:{track_id}'} for track_id in chunk], **snapshot}
+            for chunk in playlist_chunks(track_uris, self.PLAYLIST_WRITE_SIZE)
+        ])
+
+    async def sync_playlist(self, playlist_id: str, add: list = (), remove: list = ()) -> Dict:
+        """bring a playlist in line with the wanted adds and removes, sending only the difference"""
+        snapshot_id = (await self._get_page(
+            f'{self.BASE_URL}/playlists/{playlist_id}',
+            {'fields': 'snapshot_id'}
+        ))['snapshot_id']
+        present = {
+            item['track']['id']
+            async for item in self.iter_playlist_tracks(playlist_id, fields=PLAYLIST_ID_FIELDS)
+            if (item.get('track') or {}).get('id')
+        }
+        diff = playlist_diff(present, add, remove)
+
+        # removals are pinned to the snapshot the diff was computed against
+        if diff['removed']:
+            snapshot_id = (await self.remove_tracks_from_playlist(playlist_id, diff['removed'], snapshot_id))['snapshot_id']
+        if diff['added']:
+            snapshot_id = (await self.add_tracks_to_playlist(playlist_id, diff['added']))['snapshot_id']
+        return {'snapshot_id': snapshot_id, **diff}
+
+    async def create_playlist(self, name: str = "My Vault Playlist") -> Dict:
+        """Create a new playlist for the user."""
+        # get user id first
+        user_response = await self._request('GET', f'{self.BASE_URL}/me')
+        if not user_response.is_success:
+            raise Exception(f"Failed to get user info: {user_response.text}")
+        user_id = user_response.json()['id']
+
+        # create playlist
+        response = await self._request(
+            'POST',
+            f'{self.BASE_URL}/users/{user_id}/playlists',
+            json={
+                'name': name,
+                'description': 'Created by Vault - Your personal music time capsule',
+                'public': False
+            }
+        )
+        if not response.is_success:
+            raise Exception(f"Failed to create playlist: {response.text}")
+
+        # the cached playlist list no longer includes everything
+        if self.user_id is not None:
+            await spotify_cache.adelete('me/playlists', {'limit': 50}, user_id=self.user_id)
+        return response.json()
+
+    async def get_track(self, track_id: str) -> Dict:
+        """get track metadata by id"""
+        async def fetch():
+            response = await self._request('GET', f'{self.BASE_URL}/tracks/{track_id}')
+            if not response.is_success:
+                raise Exception(f"failed to fetch track: {response.status_code} - {response.text}")
+            return response.json()
+
+        try:
+            # shares entries with get_tracks
+            return await spotify_cache.aget_or_fetch('track', {'id': track_id}, fetch)
+        except Exception as e:
+            raise Exception(f"failed to fetch track: {str(e)}")
+
+    async def _get_tracks_chunk(self, track_ids: List[str], semaphore: asyncio.Semaphore) -> List:
+        async with semaphore:
+            response = await self._request(
+                'GET',
+                f'{self.BASE_URL}/tracks',
+                params={'ids': ','.join(track_ids)}
+            )
+        if not response.is_success:
+            raise Exception(f"failed to fetch tracks: {response.status_code} - {response.text}")
+        return response.json()['tracks']
+
+    async def get_tracks(self, track_ids: List[str], use_cache: bool = True) -> Dict:
+        """get metadata for any number of tracks, chunked and fetched concurrently"""
+        track_ids = list(dict.fromkeys(track_ids))  # dedupe, keep input order
+        cached = await spotify_cache.aget_many('track', track_ids) if use_cache else {}
+        to_fetch = [track_id for track_id in track_ids if track_id not in cached]
+        chunks = [
+            to_fetch[i:i + self.TRACKS_BATCH_SIZE]
+            for i in range(0, len(to_fetch), self.TRACKS_BATCH_SIZE)
+        ]
+        semaphore = asyncio.Semaphore(settings.SPOTIFY_HTTP['BATCH_CONCURRENCY'])
+        results = await asyncio.gather(*[self._get_tracks_chunk(chunk, semaphore) for chunk in chunks])
+
+        # spotify returns null for unknown ids, in request order
+        fetched = {}
+        for chunk, chunk_tracks in zip(chunks, results):
+            for track_id, track in zip(chunk, chunk_tracks):
+                if track is not None:
+                    fetched[track_id] = track
+        await spotify_cache.aset_many('track', fetched)
+
+        found = {**cached, **fetched}
+        return {
+            'tracks': [found[track_id] for track_id in track_ids if track_id in found],
+            'missing': [track_id for track_id in track_ids if track_id not in found],
+        }
+
+    async def _get_page(self, url: str, params: Dict) -> Dict:
+        response = await self._request('GET', url, params=params)
+        if not response.is_success:
+            raise Exception(f"Failed to fetch page: {response.status_code} - {response.text}")
+        return response.json()
+
+    async def _iter_pages(self, url: str, max_items: int = None, params: Dict = None) -> AsyncIterator[Dict]:
+        """yield items from every page, prefetching a window of pages concurrently once total is known"""
+        params = {**(params or {}), 'limit': self.PAGE_SIZE}
+        page = await self._get_page(url, {**params, 'offset': 0})
+        total = page.get('total')
+
+        if total is None:
+            # no total to plan with, just follow the next links
+            remaining = max_items
+            while True:
+                items = page['items'] if remaining is None else page['items'][:remaining]
+                for item in items:
+                    yield item
+                if remaining is not None:
+                    remaining -= len(items)
+                if not page.get('next') or remaining == 0:
+                    return
+                page = await self._get_page(page['next'], {})
+
+        if max_items is not None:
+            total = min(total, max_items)
+        for item in page['items'][:total]:
+            yield item
+
+        offsets = iter(range(self.PAGE_SIZE, total, self.PAGE_SIZE))
+        window = settings.SPOTIFY_HTTP['BATCH_CONCURRENCY']
+        pending = []
+        try:
+            # keep at most `window` pages in flight, yield them in order
+            for offset in offsets:
+                pending.append((offset, asyncio.ensure_future(self._get_page(url, {**params, 'offset': offset}))))
+                if len(pending) >= window:
+                    break
+            while pending:
+                offset, task = pending.pop(0)
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    pending.append((next_offset, asyncio.ensure_future(self._get_page(url, {**params, 'offset': next_offset}))))
+                for item in (await task)['items'][:total - offset]:
+                    yield item
+        finally:
+            # stop fetching if the consumer goes away early
+            for _, task in pending:
+                task.cancel()
+
+    def iter_user_playlists(self, max_items: int = None) -> AsyncIterator[Dict]:
+        """lazily yield every playlist of the user"""
+        return self._iter_pages(f'{self.BASE_URL}/me/playlists', max_items)
+
+    def iter_playlist_tracks(self, playlist_id: str, max_items: int = None, fields: str = None) -> AsyncIterator[Dict]:
+        """lazily yield every item of a playlist"""
+        params = {'fields': fields} if fields else None
+        return self._iter_pages(f'{self.BASE_URL}/playlists/{playlist_id}/tracks', max_items, params)
+
+    def iter_saved_tracks(self, max_items: int = None) -> AsyncIterator[Dict]:
+        """lazily yield every saved track of the user"""
+        return self._iter_pages(f'{self.BASE_URL}/me/tracks', max_items)
+
+    async def revoke_token(self) -> None:
+        """revoke the current access token"""
+        await self._request(
+            'POST',
+            self.REVOKE_URL,
+            authenticated=False,
+            data={
+                'token': self.access_token,
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+            }
+        )
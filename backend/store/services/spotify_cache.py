@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+import json
+import threading
+import weakref
+from collections import defaultdict
+from typing import Callable, Dict, List
+from django.conf import settings
+from django.core.cache import caches
+
+class _Flight:
+    """one in-progress fetch that concurrent misses wait on"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SpotifyCache:
+    """response cache for spotify lookups
+
+    catalog data (tracks, search, recommendations) is keyed without any user
+    so every user shares it, /me/* data is always keyed by user id. ttls are
+    per endpoint and size/eviction come from the cache alias (lru for locmem).
+    concurrent misses on the same key share one fetch.
+    """
+
+    def __init__(self, alias: str = 'spotify'):
+        self.alias = alias
+        self._lock = threading.Lock()
+        self._hits = defaultdict(int)
+        self._misses = defaultdict(int)
+        self._coalesced = defaultdict(int)
+        self._inflight = {}  # key -> _Flight of the thread fetching it
+        self._ainflight = weakref.WeakKeyDictionary()  # loop -> {key: future}, futures are per loop
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def ttl(self, endpoint: str):
+        return settings.SPOTIFY_CACHE_TTLS.get(endpoint)
+
+    def key(self, endpoint: str, params: Dict = None, user_id: int = None) -> str:
+        digest = hashlib.sha1(json.dumps(params or {}, sort_keys=True).encode()).hexdigest()
+        scope = f'user:{user_id}' if user_id is not None else 'catalog'
+        return f'{scope}:{endpoint}:{digest}'
+
+    def _record(self, endpoint: str, hits: int, misses: int):
+        with self._lock:
+            self._hits[endpoint] += hits
+            self._misses[endpoint] += misses
+
+    def _record_coalesced(self, endpoint: str):
+        with self._lock:
+            self._coalesced[endpoint] += 1
+
+    def get_or_fetch(self, endpoint: str, params: Dict, fetch: Callable, user_id: int = None):
+        """return the cached response or call fetch() and cache what it returns"""
+        ttl = self.ttl(endpoint)
+        if not ttl:
+            return fetch()
+
+        key = self.key(endpoint, params, user_id)
+        value = self.cache.get(key)
+        if value is not None:
+            self._record(endpoint, 1, 0)
+            return value
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                self._misses[endpoint] += 1
+            else:
+                self._coalesced[endpoint] += 1
+        if not leader:
+            # another thread is already asking spotify, share its answer
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fetch()
+            self.cache.set(key, flight.value, ttl)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.done.set()
+
+    async def aget_or_fetch(self, endpoint: str, params: Dict, fetch: Callable, user_id: int = None):
+        """async get_or_fetch, fetch() must return an awaitable"""
+        ttl = self.ttl(endpoint)
+        if not ttl:
+            return await fetch()
+
+        key = self.key(endpoint, params, user_id)
+        value = await self.cache.aget(key)
+        if value is not None:
+            self._record(endpoint, 1, 0)
+            return value
+
+        loop = asyncio.get_running_loop()
+        inflight = self._ainflight.setdefault(loop, {})
+        if key in inflight:
+            self._record_coalesced(endpoint)
+            future = inflight[key]
+            try:
+                # shielded so one caller going away doesn't cancel the others' fetch
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+            # the caller that was fetching went away, start over
+            return await self.aget_or_fetch(endpoint, params, fetch, user_id)
+
+        self._record(endpoint, 0, 1)
+        future = inflight[key] = loop.create_future()
+        try:
+            value = await fetch()
+            await self.cache.aset(key, value, ttl)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # the leader reports it, don't warn when nobody else waited
+            raise
+        finally:
+            del inflight[key]
+
+    def delete(self, endpoint: str, params: Dict = None, user_id: int = None):
+        self.cache.delete(self.key(endpoint, params, user_id))
+
+    async def adelete(self, endpoint: str, params: Dict = None, user_id: int = None):
+        await self.cache.adelete(self.key(endpoint, params, user_id))
+
+    def peek_many(self, endpoint: str, params_list: List[Dict], user_id: int = None) -> List:
+        """cached responses for several params, in the given order, misses left out and not counted"""
+        if not self.ttl(endpoint) or not params_list:
+            return []
+        keys = [self.key(endpoint, params, user_id) for params in params_list]
+        found = self.cache.get_many(keys)
+        return [found[key] for key in keys if key in found]
+
+    async def apeek_many(self, endpoint: str, params_list: List[Dict], user_id: int = None) -> List:
+        if not self.ttl(endpoint) or not params_list:
+            return []
+        keys = [self.key(endpoint, params, user_id) for params in params_list]
+        found = await self.cache.aget_many(keys)
+        return [found[key] for key in keys if key in found]
+
+    def get_many(self, endpoint: str, ids: List[str]) -> Dict:
+        """look up catalog items one id at a time, returns {id: value} for hits"""
+        if not self.ttl(endpoint) or not ids:
+            return {}
+        keys = {self.key(endpoint, {'id': item_id}): item_id for item_id in ids}
+        found = {keys[key]: value for key, value in self.cache.get_many(list(keys)).items()}
+        self._record(endpoint, len(found), len(ids) - len(found))
+        return found
+
+    def set_many(self, endpoint: str, items: Dict):
+        ttl = self.ttl(endpoint)
+        if not ttl or not items:
+            return
+        self.cache.set_many(
+            {self.key(endpoint, {'id': item_id}): value for item_id, value in items.items()},
+            ttl
+        )
+
+    async def aget_many(self, endpoint: str, ids: List[str]) -> Dict:
+        if not self.ttl(endpoint) or not ids:
+            return {}
+        keys = {self.key(endpoint, {'id': item_id}): item_id for item_id in ids}
+        found = {keys[key]: value for key, value in (await self.cache.aget_many(list(keys))).items()}
+        self._record(endpoint, len(found), len(ids) - len(found))
+        return found
+
+    async def aset_many(self, endpoint: str, items: Dict):
+        ttl = self.ttl(endpoint)
+        if not ttl or not items:
+            return
+        await self.cache.aset_many(
+            {self.key(endpoint, {'id': item_id}): value for item_id, value in items.items()},
+            ttl
+        )
+
+    def stats(self) -> Dict:
+        """hit/miss counters for this process, per endpoint"""
+        with self._lock:
+            endpoints = sorted(set(self._hits) | set(self._misses) | set(self._coalesced))
+            return {
+                endpoint: {
+                    'hits': self._hits[endpoint],
+                    'misses': self._misses[endpoint],
+                    'coalesced': self._coalesced[endpoint],  # misses that waited on another fetch
+                    'hit_rate': round(
+                        self._hits[endpoint] / ((self._hits[endpoint] + self._misses[endpoint]) or 1), 3
+                    ),
+                }
+                for endpoint in endpoints
+            }
+
+spotify_cache = SpotifyCache()
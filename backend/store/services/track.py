@@ -1,31 +1,113 @@
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, DateTimeField, F, Q, Value, When
 from django.utils import timezone
 from datetime import timedelta
-from store.models.track import Track
+from store.models.track import PLACEHOLDER_IMAGE_URL, Track, TrackMetadata
+from store.services.vault import vault_versions
+
+METADATA_FIELDS = ['title', 'artist', 'album', 'preview_url', 'image_url', 'release_date']
+
+def metadata_from_spotify(track):
+    """map a spotify track object onto TrackMetadata fields"""
+    images = track['album']['images']
+    return {
+        'spotify_id': track['id'],
+        'title': track['name'][:255],
+        'artist': ', '.join(artist['name'] for artist in track['artists'])[:255],
+        'album': track['album']['name'][:255],
+        'preview_url': track.get('preview_url'),
+        'image_url': images[0]['url'] if images else PLACEHOLDER_IMAGE_URL,
+        'release_date': (track['album'].get('release_date') or '')[:10],
+    }
+
+# bulk status changes: statuses a track may be in, and the error otherwise
+TRANSITIONS = {
+    'lock': (['active'], 'Track is not active'),
+    'reveal': (['pending', 'available'], 'Track must be pending or available'),
+    'make_available': (['pending'], 'Track must be pending'),
+}
+
+def lock_duration():
+    return (
+        timedelta(days=settings.TRACK_SETTINGS['DEVELOPMENT_LOCK_DAYS'])
+        if settings.TRACK_SETTINGS['DEVELOPMENT_MODE']
+        else timedelta(weeks=settings.TRACK_SETTINGS['PRODUCTION_LOCK_WEEKS'])
+    )
 
 class TrackService:
     @staticmethod
     def get_revealed_tracks(user):
         """get tracks that were revealed recently"""
+        # plain value rows, no model instances for a read-only widget
         revealed = Track.objects.filter(
             user=user,
             status='revealed'
-        ).select_related('metadata').order_by('-revealed_at')[:10]
+        ).order_by('-revealed_at').values_list(
+            'metadata__spotify_id',
+            'metadata__title',
+            'metadata__artist',
+            'metadata__album',
+            'metadata__image_url',
+            'metadata__preview_url',
+            'metadata__release_date',
+            'revealed_at',
+            named=True
+        )[:10]
         
         return [
             {
-                'id': track.metadata.spotify_id,
-                'title': track.metadata.title,
-                'artist': track.metadata.artist,
-                'album': track.metadata.album,
-                'image': track.metadata.image_url,
-                'preview_url': track.metadata.preview_url,
-                'release_date': track.metadata.release_date,
+                'id': track.metadata__spotify_id,
+                'title': track.metadata__title,
+                'artist': track.metadata__artist,
+                'album': track.metadata__album,
+                'image': track.metadata__image_url,
+                'preview_url': track.metadata__preview_url,
+                'release_date': track.metadata__release_date,
                 'revealed_at': track.revealed_at
             }
             for track in revealed
         ]
 
+    @staticmethod
+    def get_rediscovered_tracks(user, limit=None):
+        """revealed tracks the user has played on spotify since, latest play first"""
+        limit = limit or settings.LISTENING_SETTINGS['REDISCOVERED_LIMIT']
+        # walks the (user, -played_at) index, played_at is kept current by the ingestion job
+        rediscovered = Track.objects.filter(
+            user=user,
+            status='revealed',
+            played_at__gt=F('revealed_at')
+        ).order_by('-played_at').values_list(
+            'id',
+            'metadata__spotify_id',
+            'metadata__title',
+            'metadata__artist',
+            'metadata__album',
+            'metadata__image_url',
+            'metadata__preview_url',
+            'metadata__release_date',
+            'revealed_at',
+            'played_at',
+            named=True
+        )[:limit]
+
+        return [
+            {
+                'id': track.id,
+                'spotify_id': track.metadata__spotify_id,
+                'title': track.metadata__title,
+                'artist': track.metadata__artist,
+                'album': track.metadata__album,
+                'image': track.metadata__image_url,
+                'preview_url': track.metadata__preview_url,
+                'release_date': track.metadata__release_date,
+                'revealed_at': track.revealed_at,
+                'played_at': track.played_at
+            }
+            for track in rediscovered
+        ]
+
     @staticmethod
     def get_available_tracks(user):
         """get tracks that are available to reveal"""
@@ -39,24 +121,37 @@ class TrackService:
         now = timezone.now()
         cutoff_time = now - locked_time
 
+        # derived status, no write needs to have happened first
         available_tracks = Track.objects.filter(
-            user=user,
-            status='available',
-            available_at__lte=now
-        ).select_related('metadata').order_by('available_at')[:10]
+            user=user
+        ).with_status('available', now).order_by('available_at').values_list(
+            'id',
+            'metadata__spotify_id',
+            'metadata__title',
+            'metadata__artist',
+            'metadata__album',
+            'metadata__image_url',
+            'metadata__preview_url',
+            'metadata__release_date',
+            'status',
+            'available_at',
+            'revealed_at',
+            'created_at',
+            named=True
+        )[:10]
 
         return {    
             'tracks': [
                 {
                     'id': track.id,
-                    'spotify_id': track.metadata.spotify_id,
-                    'title': track.metadata.title,
-                    'artist': track.metadata.artist,
-                    'album': track.metadata.album,
-                    'image': track.metadata.image_url,
-                    'preview_url': track.metadata.preview_url,
-                    'release_date': track.metadata.release_date,
-                    'status': track.status,
+                    'spotify_id': track.metadata__spotify_id,
+                    'title': track.metadata__title,
+                    'artist': track.metadata__artist,
+                    'album': track.metadata__album,
+                    'image': track.metadata__image_url,
+                    'preview_url': track.metadata__preview_url,
+                    'release_date': track.metadata__release_date,
+                    'status': Track.derive_status(track.status, track.available_at, now),
                     'available_at': track.available_at,
                     'revealed_at': track.revealed_at,
                     'created_at': track.created_at,
@@ -69,4 +164,204 @@ class TrackService:
                 'days': locked_time.days,
                 'development_mode': settings.TRACK_SETTINGS['DEVELOPMENT_MODE']
             }
-        }
\ No newline at end of file
+        }
+
+    @staticmethod
+    def bulk_create(user, items):
+        """vault many tracks at once, items are validated TrackCreateSerializer data
+
+        one metadata insert, one metadata lookup and one track insert however
+        many items there are. returns (results, created spotify ids) with one
+        result per item, in order. losing an insert race to a concurrent
+        request retries once, the other request's tracks then count as existing.
+        """
+        now = timezone.now()
+        available_at = now + lock_duration()
+        # the first item wins when the same track is listed twice
+        first = {}
+        for item in items:
+            first.setdefault(item['spotify_id'], item)
+        spotify_ids = list(first)
+
+        for attempt in range(2):
+            try:
+                with transaction.atomic():
+                    # stored metadata is kept as is, like TrackMetadata.objects.upsert,
+                    # so rows other requests insert concurrently are skipped, not overwritten
+                    TrackMetadata.objects.bulk_create(
+                        [TrackMetadata(**item) for item in first.values()],
+                        ignore_conflicts=True
+                    )
+                    metadata = TrackMetadata.objects.in_bulk(spotify_ids, field_name='spotify_id')
+                    existing = TrackService._vaulted(user, spotify_ids)
+
+                    # a plain insert, update_conflicts would rewrite a track another
+                    # request just vaulted and couldn't say which rows were ours
+                    tracks = Track.objects.bulk_create([
+                        Track(
+                            user=user,
+                            metadata=metadata[spotify_id],
+                            status='pending',
+                            locked_at=now,
+                            available_at=available_at
+                        )
+                        for spotify_id in spotify_ids
+                        if spotify_id not in existing
+                    ])
+                break
+            except IntegrityError:
+                # a concurrent request vaulted one of these tracks after we looked,
+                # the second pass reads it back as existing
+                if attempt:
+                    raise
+        created = {track.metadata.spotify_id: track for track in tracks}
+
+        results = []
+        seen = set()
+        for item in items:
+            spotify_id = item['spotify_id']
+            if spotify_id in seen:
+                results.append({'spotify_id': spotify_id, 'result': 'duplicate'})
+            elif spotify_id in created:
+                track = created[spotify_id]
+                results.append({
+                    'spotify_id': spotify_id,
+                    'result': 'created',
+                    'id': track.id,
+                    'status': track.status,
+                    'available_at': track.available_at,
+                })
+            else:
+                results.append({'spotify_id': spotify_id, 'result': 'exists', 'id': existing[spotify_id]})
+            seen.add(spotify_id)
+        return results, list(created)
+
+    @staticmethod
+    def _vaulted(user, spotify_ids):
+        """{spotify_id: track id} for the ones the user already has"""
+        return dict(Track.objects.filter(
+            user=user,
+            metadata__spotify_id__in=spotify_ids
+        ).values_list('metadata__spotify_id', 'id'))
+
+    @staticmethod
+    def bulk_transition(user, action, track_ids):
+        """apply lock/reveal/make_available to many tracks with one UPDATE
+
+        returns one result per id, tracks in the wrong status or not owned by
+        the user are reported and left alone.
+        """
+        allowed, error = TRANSITIONS[action]
+        now = timezone.now()
+        if action == 'lock':
+            changes = {'status': 'pending', 'locked_at': now, 'available_at': now + lock_duration()}
+        elif action == 'reveal':
+            changes = {'status': 'revealed', 'revealed_at': now}
+        else:
+            changes = {'status': 'available', 'available_at': now}
+
+        with transaction.atomic():
+            # lock the rows so the statuses we checked are the ones we update
+            current = dict(Track.objects.select_for_update().filter(
+                user=user,
+                id__in=track_ids
+            ).values_list('id', 'status'))
+            ok_ids = {track_id for track_id, track_status in current.items() if track_status in allowed}
+            if ok_ids:
+                Track.objects.filter(id__in=ok_ids).update(**changes)
+
+        results = []
+        for track_id in dict.fromkeys(track_ids):
+            if track_id not in current:
+                results.append({'id': track_id, 'detail': 'Not found.'})
+            elif track_id in ok_ids:
+                results.append({'id': track_id, **changes})
+            else:
+                results.append({'id': track_id, 'detail': error})
+        return results, len(ok_ids)
+
+    @staticmethod
+    def apply_playlist_sync(user_id, revealed=(), reverted=()):
+        """reveal tracks added to a playlist and revert removed ones in one UPDATE
+
+        returns {'revealed': [...], 'reverted': [...]}, the spotify ids whose
+        track actually changed, in request order.
+        """
+        metadata_ids = dict(
+            TrackMetadata.objects.filter(spotify_id__in=[*revealed, *reverted]).values_list('spotify_id', 'id')
+        )
+        # like the playlist diff, an id both added and removed counts as added
+        added = set(revealed)
+        revealed = [spotify_id for spotify_id in dict.fromkeys(revealed) if spotify_id in metadata_ids]
+        reverted = [
+            spotify_id for spotify_id in dict.fromkeys(reverted)
+            if spotify_id in metadata_ids and spotify_id not in added
+        ]
+        if not revealed and not reverted:
+            return {'revealed': [], 'reverted': []}
+
+        reveal_ids = [metadata_ids[spotify_id] for spotify_id in revealed]
+        revert_ids = [metadata_ids[spotify_id] for spotify_id in reverted]
+        now = timezone.now()
+        with transaction.atomic():
+            # lock the rows so the statuses we checked are the ones we update
+            changed = dict(Track.objects.select_for_update().filter(
+                Q(metadata_id__in=reveal_ids, status__in=['pending', 'available'])
+                | Q(metadata_id__in=revert_ids, status='revealed'),
+                user_id=user_id
+            ).values_list('metadata_id', 'id'))
+            if changed:
+                Track.objects.filter(id__in=changed.values()).update(
+                    status=Case(When(metadata_id__in=reveal_ids, then=Value('revealed')), default=Value('available')),
+                    revealed_at=Case(
+                        When(metadata_id__in=reveal_ids, then=Value(now)),
+                        default=None,
+                        output_field=DateTimeField()
+                    )
+                )
+        return {
+            'revealed': [spotify_id for spotify_id in revealed if metadata_ids[spotify_id] in changed],
+            'reverted': [spotify_id for spotify_id in reverted if metadata_ids[spotify_id] in changed],
+        }
+
+    @staticmethod
+    def refresh_metadata(spotify, metadata_rows, now=None):
+        """refresh metadata rows from spotify in multi-id batches, returns (updated, missing)
+
+        every row spotify was asked about gets refreshed_at stamped, so ids it
+        no longer knows aren't retried until they're stale again.
+        """
+        now = now or timezone.now()
+        rows_by_id = {}
+        for row in metadata_rows:
+            rows_by_id.setdefault(row.spotify_id, []).append(row)
+        if not rows_by_id:
+            return [], []
+
+        result = spotify.get_tracks(list(rows_by_id), use_cache=False)
+
+        # only write rows whose fields actually changed
+        changed = []
+        for track in result['tracks']:
+            fields = metadata_from_spotify(track)
+            # a relinked track comes back under its new id, linked_from holds the one we asked for
+            requested_id = (track.get('linked_from') or {}).get('id', track['id'])
+            for row in rows_by_id.get(requested_id, []):
+                if any(getattr(row, field) != fields[field] for field in METADATA_FIELDS):
+                    for field in METADATA_FIELDS:
+                        setattr(row, field, fields[field])
+                    row.refreshed_at = now
+                    changed.append(row)
+
+        TrackMetadata.objects.bulk_update(changed, METADATA_FIELDS + ['refreshed_at'], batch_size=500)
+        changed_ids = {row.id for row in changed}
+        if changed_ids:
+            # the listings embed metadata, every vault holding a changed row gets a new etag
+            vault_versions.bump_many(
+                Track.objects.filter(metadata_id__in=changed_ids).values_list('user_id', flat=True).distinct()
+            )
+        # unchanged and missing rows only need the stamp, one UPDATE
+        TrackMetadata.objects.filter(
+            id__in=[row.id for rows in rows_by_id.values() for row in rows if row.id not in changed_ids]
+        ).update(refreshed_at=now)
+        return changed, result['missing']
@@ -0,0 +1,74 @@
+import logging
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.db.models import Min
+from django.utils import timezone
+from store.models.track import Track
+from store.services.events import vault_events
+from store.services.vault import vault_versions
+
+logger = logging.getLogger(__name__)
+
+class TrackTransitionEngine:
+    """moves pending tracks to available for every user once available_at passes
+
+    instead of polling per request it looks up the next available_at deadline,
+    sleeps until then (capped so locks made elsewhere are picked up) and applies
+    everything that's due in one bulk update.
+    """
+
+    def __init__(self, max_sleep: float = None):
+        self.max_sleep = (
+            max_sleep if max_sleep is not None
+            else settings.TRACK_SETTINGS['TRANSITION_MAX_SLEEP_SECONDS']
+        )
+        self._stop = threading.Event()
+
+    def due(self, now=None):
+        return Track.objects.filter(status='pending', available_at__lte=now or timezone.now())
+
+    def next_deadline(self):
+        """earliest pending available_at, None when nothing is pending
+
+        rows already overdue are included on purpose, one that came due after
+        the last apply_due makes the watch loop go round again right away.
+        """
+        return Track.objects.filter(
+            status='pending',
+            available_at__isnull=False
+        ).aggregate(deadline=Min('available_at'))['deadline']
+
+    def apply_due(self, now=None) -> int:
+        """bulk apply every transition that's due, returns the number of tracks moved"""
+        now = now or timezone.now()
+        # only what the UPDATE itself changed gets versions bumped and events sent
+        due = defaultdict(list)
+        for user_id, track_id in Track.objects.make_due_available(now):
+            due[user_id].append(track_id)
+        updated = sum(len(ids) for ids in due.values())
+        vault_versions.bump_many(due)
+        for user_id, ids in due.items():
+            vault_events.publish(user_id, 'available', track_ids=sorted(ids))
+        if updated:
+            logger.info(f"Made {updated} tracks available")
+        return updated
+
+    def seconds_until_next(self, now=None) -> float:
+        now = now or timezone.now()
+        deadline = self.next_deadline()
+        if deadline is None:
+            return self.max_sleep
+        return min(max((deadline - now).total_seconds(), 0), self.max_sleep)
+
+    def run(self):
+        """apply transitions as they come due until stop() is called"""
+        logger.info("Track transition engine started")
+        while not self._stop.is_set():
+            self.apply_due()
+            wait = self.seconds_until_next()
+            logger.debug(f"Next transition check in {wait:.1f}s")
+            self._stop.wait(wait)
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,120 @@
+import time
+from asgiref.sync import sync_to_async
+from typing import Iterable, Optional, Tuple
+from django.core.cache import caches
+from django.utils import timezone
+from store.models.track import Track, VaultVersion
+
+class VaultVersions:
+    """per-user vault version for conditional GETs
+
+    every Track write bumps the owner's version, reads compare it against
+    If-None-Match without touching the tracks table. the version is a row in
+    vault_versions, so bumps from the workers and the other web processes
+    are seen everywhere. pending tracks change their derived status when
+    available_at passes without any write, so the next deadline is cached
+    per version and crossing it bumps the version too.
+
+    the same cache tracks which spotify ids the user has vaulted, so check
+    can answer membership without the tracks table. it's stamped with the
+    version it matches and only used while that's still the version in the
+    database. a bump carries it forward in the process that made it, other
+    processes see a newer version and rebuild it on the next read. the
+    cache only holds these derived entries, so a per-process one is fine.
+    """
+
+    def __init__(self, alias: str = 'default'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, user_id: int, part: str) -> str:
+        return f'vault:{user_id}:{part}'
+
+    def bump(self, user_id: int, added: Iterable[str] = (), removed: Iterable[str] = (),
+             reindex: bool = False) -> int:
+        """record a write to the user's vault, returns the new version
+
+        pass the spotify ids a create/delete added or removed, or reindex=True
+        when membership changed in a way the caller can't describe.
+        """
+        version = VaultVersion.objects.bump([user_id])[user_id]
+        self._advance_index(user_id, version, added, removed, reindex)
+        return version
+
+    def bump_many(self, user_ids: Iterable[int]):
+        """one statement however many users, their indexes are rebuilt on the next read"""
+        VaultVersion.objects.bump(user_ids)
+
+    async def abump(self, user_id: int) -> int:
+        # async writes are status changes only, membership stays the same
+        return await sync_to_async(self.bump)(user_id)
+
+    def version(self, user_id: int) -> Tuple[int, int]:
+        """(version, last modified timestamp) as stored, bumping users who have no row yet"""
+        row = VaultVersion.objects.filter(user_id=user_id).values_list('version', 'modified_at').first()
+        if row is None:
+            return self.bump(user_id), int(time.time())
+        return row[0], int(row[1].timestamp())
+
+    def _advance_index(self, user_id: int, version: int, added: Iterable[str] = (),
+                       removed: Iterable[str] = (), reindex: bool = False):
+        key = self.key(user_id, 'locked')
+        index = None if reindex else self.cache.get(key)
+        # only safe when nobody else wrote in between, otherwise rebuild lazily
+        if index is None or index[0] != version - 1:
+            self.cache.delete(key)
+            return
+        spotify_ids = (index[1] | frozenset(added)) - frozenset(removed)
+        self.cache.set(key, (version, spotify_ids), None)
+
+    def locked_ids(self, user_id: int) -> frozenset:
+        """every spotify id in the user's vault, from the cache when it's current"""
+        version, _ = self.version(user_id)
+        key = self.key(user_id, 'locked')
+        index = self.cache.get(key)
+        if index is not None and index[0] == version:
+            return index[1]
+
+        spotify_ids = frozenset(
+            Track.objects.filter(user_id=user_id).values_list('metadata__spotify_id', flat=True)
+        )
+        # a write racing this is fine, deltas are idempotent and a newer version wins
+        self.cache.set(key, (version, spotify_ids), None)
+        return spotify_ids
+
+    def next_deadline(self, user_id: int, now) -> Optional[float]:
+        available_at = Track.objects.filter(
+            user_id=user_id,
+            status='pending',
+            available_at__gt=now
+        ).order_by('available_at').values_list('available_at', flat=True).first()
+        return available_at.timestamp() if available_at else None
+
+    def current(self, user_id: int, now=None) -> Tuple[int, int]:
+        """(version, last modified timestamp) for the user's vault"""
+        now = now or timezone.now()
+        version, modified = self.version(user_id)
+        key = self.key(user_id, 'deadline')
+        deadline = self.cache.get(key)
+
+        if deadline and deadline[0] == version and deadline[1] and deadline[1] <= now.timestamp():
+            # a pending track became available, its derived status changed
+            version = self.bump(user_id)
+            modified = int(time.time())
+            deadline = None
+
+        if deadline is None or deadline[0] != version:
+            # tagged with the version so a write racing this lookup invalidates it
+            self.cache.set(key, (version, self.next_deadline(user_id, now)), None)
+
+        return version, modified
+
+    def validators(self, user_id: int) -> Tuple[str, int]:
+        """etag and last-modified timestamp for the user's vault"""
+        version, modified = self.current(user_id)
+        return f'"{user_id}.{version}"', modified
+
+vault_versions = VaultVersions()
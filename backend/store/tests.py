@@ -1,3 +1,1746 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import threading
+import time
+import httpx
+from datetime import datetime, timedelta, timezone as dt_timezone
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.handlers.asgi import ASGIHandler
+from django.db import DatabaseError, connection
+from django.db.migrations.executor import MigrationExecutor
+from unittest import mock
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from store.models.spotify import (
+    BuriedRecommendations,
+    RecentlyPlayedCursor,
+    RevealJob,
+    SpotifyPlaylistSettings,
+    SpotifyToken,
+)
+from store.models.track import Track, TrackMetadata, VaultEvent, VaultVersion
+from store.renderers import FastJSONRenderer
+from store.serializers.track import TrackRowSerializer, TrackSerializer
+from store.services.backup import VaultBackupService
+from store.services.events import VaultEventBroadcaster, stream_events, vault_events
+from store.services.listening import ListeningHistoryService
+from store.services.recommendations import RecommendationService
+from store.services.reveal import RevealJobLost, RevealJobService
+from store.services.search import SearchService, mark_vaulted, normalize_query
+from store.services.scheduler import (
+    CircuitBreaker,
+    RequestScheduler,
+    SpotifyRateLimited,
+    SpotifyUnavailable,
+    TokenBucket,
+    parse_retry_after,
+)
+from store.services.spotify import SpotifyService, get_session, playlist_chunks, playlist_diff
+from store.services.spotify_cache import SpotifyCache
+from store.services.track import TrackService
+from store.services.transitions import TrackTransitionEngine
+from store.services.vault import vault_versions
 
-# Create your tests here.
+
+def at(minutes):
+    return datetime(2024, 1, 1, tzinfo=dt_timezone.utc) + timedelta(minutes=minutes)
+
+
+def make_metadata(spotify_id, **fields):
+    return TrackMetadata.objects.create(**{
+        'spotify_id': spotify_id,
+        'title': f'title {spotify_id}',
+        'artist': 'artist',
+        'album': 'album',
+        'image_url': f'https://i.example.com/{spotify_id}',
+        'release_date': '2020-01-01',
+        **fields
+    })
+
+
+def make_track(user, spotify_id, created_at=None, **fields):
+    track = Track.objects.create(user=user, metadata=make_metadata(spotify_id), **fields)
+    if created_at:
+        Track.objects.filter(id=track.id).update(created_at=created_at)
+    return track
+
+
+class BatchedTrackLookupTests(SimpleTestCase):
+    def test_chunks_dedupes_and_keeps_order(self):
+        service = SpotifyService('token')
+        track_ids = [f'id{i}' for i in range(120)] + ['id0', 'gone']
+        calls = []
+
+        def fetch_chunk(chunk):
+            calls.append(chunk)
+            # spotify answers null for ids it doesn't know
+            return [None if track_id == 'gone' else {'id': track_id} for track_id in chunk]
+
+        with mock.patch.object(service, '_get_tracks_chunk', side_effect=fetch_chunk):
+            result = service.get_tracks(track_ids, use_cache=False)
+
+        self.assertEqual(sorted(len(chunk) for chunk in calls), [21, 50, 50])
+        self.assertEqual([track['id'] for track in result['tracks']], [f'id{i}' for i in range(120)])
+        self.assertEqual(result['missing'], ['gone'])
+
+
+class PlaylistDiffTests(SimpleTestCase):
+    def test_chunks(self):
+        self.assertEqual(playlist_chunks([], 100), [])
+        self.assertEqual(playlist_chunks(list(range(5)), 2), [[0, 1], [2, 3], [4]])
+        self.assertEqual([len(chunk) for chunk in playlist_chunks(list(range(250)), 100)], [100, 100, 50])
+
+    def test_diff_only_keeps_real_changes(self):
+        diff = playlist_diff({'a', 'b'}, add=['a', 'c', 'c'], remove=['b', 'd'])
+        self.assertEqual(diff, {'added': ['c'], 'removed': ['b'], 'unchanged': ['a', 'd']})
+
+    def test_id_added_and_removed_counts_as_added(self):
+        self.assertEqual(playlist_diff(set(), add=['a'], remove=['a'])['added'], ['a'])
+        self.assertEqual(playlist_diff({'a'}, add=['a'], remove=['a'])['removed'], [])
+
+
+class PlaylistSyncTests(SimpleTestCase):
+    def sync(self, present, add=(), remove=()):
+        service = SpotifyService('token')
+        writes = []
+
+        def write(method, playlist_id, body):
+            writes.append((method, body))
+            return {'snapshot_id': f'snap{len(writes)}'}
+
+        with mock.patch.object(service, '_get_page', return_value={'snapshot_id': 'snap0'}), \
+                mock.patch.object(service, 'iter_playlist_tracks', return_value=[{'track': {'id': i}} for i in present]), \
+                mock.patch.object(service, '_write_playlist_chunk', side_effect=write):
+            return service.sync_playlist('playlist', add, remove), writes
+
+    def test_in_sync_sends_nothing(self):
+        result, writes = self.sync(['a', 'b'], add=['a'], remove=['c'])
+        self.assertEqual(writes, [])
+        self.assertEqual(result['snapshot_id'], 'snap0')
+
+    def test_writes_in_chunks_of_100_with_removals_pinned(self):
+        present = [f'old{i}' for i in range(150)]
+        result, writes = self.sync(present, add=[f'new{i}' for i in range(230)], remove=present)
+
+        removals = [body for method, body in writes if method == 'DELETE']
+        additions = [body for method, body in writes if method == 'POST']
+        self.assertEqual(sorted(len(body['tracks']) for body in removals), [50, 100])
+        self.assertTrue(all(body['snapshot_id'] == 'snap0' for body in removals))
+        self.assertEqual(sorted(len(body['uris']) for body in additions), [30, 100, 100])
+        self.assertEqual(len(result['added']), 230)
+        self.assertEqual(len(result['removed']), 150)
+
+
+class ApplyPlaylistSyncTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='sync')
+        make_track(self.user, 'pending', status='pending', available_at=timezone.now() + timedelta(days=1))
+        make_track(self.user, 'revealed', status='revealed', revealed_at=at(0))
+        make_track(self.user, 'both', status='available')
+        make_track(self.user, 'already', status='revealed', revealed_at=at(0))
+        make_track(self.user, 'active')
+
+    def test_reveals_and_reverts_in_one_update(self):
+        # one metadata lookup, one locking read and one UPDATE inside a savepoint
+        with self.assertNumQueries(5):
+            changed = TrackService.apply_playlist_sync(
+                self.user.id,
+                revealed=['pending', 'both', 'already', 'unknown'],
+                reverted=['revealed', 'both', 'active']
+            )
+
+        # tracks already in the wanted status, or never vaulted, didn't change
+        self.assertEqual(changed, {'revealed': ['pending', 'both'], 'reverted': ['revealed']})
+        statuses = dict(Track.objects.filter(user=self.user).values_list('metadata__spotify_id', 'status'))
+        self.assertEqual(statuses, {
+            'pending': 'revealed', 'revealed': 'available', 'both': 'revealed', 'already': 'revealed', 'active': 'active'
+        })
+        self.assertIsNone(Track.objects.get(user=self.user, metadata__spotify_id='revealed').revealed_at)
+
+    def test_playlist_endpoint_publishes_only_changed_ids(self):
+        SpotifyToken.objects.create(
+            user=self.user, access_token='access', refresh_token='refresh',
+            expires_at=timezone.now() + timedelta(hours=1)
+        )
+        client = APIClient()
+        client.force_login(self.user)
+
+        with mock.patch.object(SpotifyService, 'sync_playlist', return_value={'added': 2}) as sync:
+            response = client.patch(
+                '/api/spotify/playlists/playlist/tracks/',
+                {'add': ['pending', 'already'], 'remove': ['active']},
+                format='json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        sync.assert_called_once_with('playlist', add=['pending', 'already'], remove=['active'])
+        self.assertEqual(
+            [event.event for event in VaultEvent.objects.filter(user=self.user)],
+            [{'type': 'revealed', 'spotify_ids': ['pending']}]
+        )
+
+    def test_nothing_changed_publishes_nothing(self):
+        changed = TrackService.apply_playlist_sync(self.user.id, revealed=['already'], reverted=['active'])
+
+        self.assertEqual(changed, {'revealed': [], 'reverted': []})
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('store.services.scheduler.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bucket = TokenBucket(rate=2, capacity=2)
+
+    def test_burst_then_queued_reservations(self):
+        self.assertEqual(self.bucket.reserve(max_wait=10), 0)
+        self.assertEqual(self.bucket.reserve(max_wait=10), 0)
+        # empty, each reservation queues behind the previous one
+        self.assertEqual(self.bucket.reserve(max_wait=10), 0.5)
+        self.assertEqual(self.bucket.reserve(max_wait=10), 1.0)
+
+    def test_reservation_over_max_wait_takes_nothing(self):
+        self.bucket.reserve(max_wait=10)
+        self.bucket.reserve(max_wait=10)
+        self.assertIsNone(self.bucket.reserve(max_wait=0.1))
+        self.assertEqual(self.bucket.reserve(max_wait=10), 0.5)
+
+    def test_refills_over_time_up_to_capacity(self):
+        for _ in range(3):
+            self.bucket.reserve(max_wait=10)
+        self.clock.now += 60
+        self.assertEqual(self.bucket.reserve(max_wait=0), 0)
+        self.assertEqual(self.bucket.reserve(max_wait=0), 0)
+        self.assertIsNone(self.bucket.reserve(max_wait=0))
+
+    def test_release_and_block(self):
+        self.bucket.reserve(max_wait=10)
+        self.bucket.reserve(max_wait=10)
+        self.bucket.release()
+        self.assertEqual(self.bucket.reserve(max_wait=0), 0)
+
+        self.clock.now += 60
+        self.bucket.block(5)
+        self.assertIsNone(self.bucket.reserve(max_wait=1))
+        self.assertEqual(self.bucket.reserve(max_wait=10), 5)
+        self.assertEqual(self.bucket.retry_after(), 5)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('store.services.scheduler.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    def test_opens_after_consecutive_failures(self):
+        self.assertFalse(self.breaker.record_failure())
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.record_failure())
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_after(), 30)
+
+    def test_success_resets_the_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.assertFalse(self.breaker.record_failure())
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_half_open_lets_one_probe_through(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.now += 30
+        self.assertEqual(self.breaker.state, 'half-open')
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.record_failure())
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertEqual(self.breaker.retry_after(), 30)
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class RequestSchedulerTests(SimpleTestCase):
+    """the breaker's half-open probe must never be lost to a call that didn't reach spotify"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('store.services.scheduler.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        settings_patcher = self.settings(SPOTIFY_RATE_LIMIT={
+            'APP_RATE': 1000, 'APP_BURST': 1000, 'USER_RATE': 1, 'USER_BURST': 1, 'TRACKED_USERS': 10,
+            'MAX_QUEUE_WAIT': 0, 'MAX_RETRIES': 0, 'RETRY_BACKOFF': 0, 'RETRY_JITTER': 0,
+            'BREAKER_FAILURES': 1, 'BREAKER_RESET_SECONDS': 30,
+        })
+        settings_patcher.enable()
+        self.addCleanup(settings_patcher.disable)
+        self.scheduler = RequestScheduler()
+
+    def open_then_half_open(self):
+        self.scheduler.execute(lambda: FakeResponse(503))
+        self.assertEqual(self.scheduler.breaker.state, 'open')
+        self.clock.now += 30
+        self.assertEqual(self.scheduler.breaker.state, 'half-open')
+
+    def test_throttled_probe_leaves_the_probe_free(self):
+        self.open_then_half_open()
+        self.scheduler.user_bucket('user').reserve(max_wait=10)  # the user has no budget left
+        with self.assertRaises(SpotifyRateLimited):
+            self.scheduler.execute(lambda: FakeResponse(200), user_key='user')
+        # another caller can still probe and close the circuit
+        self.assertEqual(self.scheduler.execute(lambda: FakeResponse(200)).status_code, 200)
+        self.assertEqual(self.scheduler.breaker.state, 'closed')
+
+    def test_interrupted_probe_leaves_the_probe_free(self):
+        self.open_then_half_open()
+
+        def cancelled():
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.scheduler.execute(cancelled)
+        self.assertTrue(self.scheduler.breaker.allow())
+
+    def test_cancelled_async_probe_leaves_the_probe_free(self):
+        self.open_then_half_open()
+
+        async def run():
+            async def hang():
+                await asyncio.sleep(3600)
+            task = asyncio.ensure_future(self.scheduler.aexecute(hang))
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        self.assertTrue(self.scheduler.breaker.allow())
+
+    def test_open_circuit_rejects_without_spending_tokens(self):
+        self.open_then_half_open()
+        self.assertTrue(self.scheduler.breaker.allow())  # someone else is probing
+        with self.assertRaises(SpotifyUnavailable):
+            self.scheduler.execute(lambda: FakeResponse(200), user_key='user')
+        self.assertEqual(self.scheduler.user_bucket('user').reserve(max_wait=0), 0)
+
+    def test_retry_after_as_seconds_or_http_date(self):
+        self.assertEqual(parse_retry_after('7'), 7)
+        self.assertEqual(parse_retry_after(None), 1)
+        self.assertEqual(parse_retry_after('soon'), 1)
+        in_a_minute = (timezone.now() + timedelta(seconds=60)).strftime('%a, %d %b %Y %H:%M:%S GMT')
+        self.assertAlmostEqual(parse_retry_after(in_a_minute), 60, delta=2)
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+
+        response = FakeResponse(429, {'Retry-After': in_a_minute})
+        with self.assertRaises(SpotifyRateLimited) as raised:
+            self.scheduler.execute(lambda: response)
+        self.assertAlmostEqual(raised.exception.retry_after, 60, delta=2)
+
+
+class TrackRowSerializerTests(TestCase):
+    """the orjson fast path has to render the same bytes as the drf serializer"""
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='rows')
+        now = timezone.now()
+        make_track(user, 'active', created_at=at(0))
+        make_track(user, 'pending', created_at=at(1), status='pending', locked_at=now, available_at=now + timedelta(days=7))
+        # due but not transitioned yet, reads as available
+        make_track(user, 'due', created_at=at(2).replace(microsecond=123456), status='pending',
+                   locked_at=at(2), available_at=now - timedelta(seconds=1))
+        make_track(user, 'available', created_at=at(3), status='available', locked_at=at(1), available_at=at(2))
+        make_track(user, 'revealed', status='revealed', locked_at=at(1), available_at=at(2),
+                   revealed_at=at(3).replace(microsecond=7), played_at=at(4))
+        track = make_track(user, 'unicode', created_at=at(5))
+        TrackMetadata.objects.filter(id=track.metadata_id).update(
+            title='line\u2028separator \u00e9\u2603', preview_url=None, release_date=''
+        )
+        cls.queryset = Track.objects.filter(user=user).order_by('id')
+
+    def render_both(self, fields=None):
+        expected = JSONRenderer().render(TrackSerializer(self.queryset, many=True, fields=fields).data)
+        rows = TrackRowSerializer(fields)
+        actual = FastJSONRenderer().render(rows.serialize(rows.rows(self.queryset)))
+        return expected, actual
+
+    def test_same_bytes_as_track_serializer(self):
+        expected, actual = self.render_both()
+        self.assertEqual(actual, expected)
+        self.assertIn(b'"status":"available"', actual)
+
+    def test_same_bytes_for_sparse_fields(self):
+        for fields in (['id'], ['status', 'available_at'], ['metadata', 'played_at']):
+            with self.subTest(fields=fields):
+                expected, actual = self.render_both(fields)
+                self.assertEqual(actual, expected)
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='pages')
+        # two pairs share a created_at, the id breaks the tie
+        for i, minutes in enumerate([0, 1, 1, 2, 3, 3, 4]):
+            make_track(cls.user, f'p{i}', created_at=at(minutes))
+        cls.expected = list(Track.objects.filter(user=cls.user).order_by('-created_at', '-id').values_list('id', flat=True))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, **params):
+        response = self.client.get('/api/tracks/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_walks_every_row_once_in_order(self):
+        seen, params, pages = [], {'page_size': 3}, 0
+        while True:
+            page = self.get(**params)
+            pages += 1
+            seen += [track['id'] for track in page['results']]
+            if not page['next_cursor']:
+                break
+            self.assertIn('cursor=', page['next'])
+            params = {'page_size': 3, 'cursor': page['next_cursor']}
+        self.assertEqual(seen, self.expected)
+        self.assertEqual(pages, 3)
+
+    def test_cursor_keeps_the_sparse_fieldset(self):
+        first = self.get(page_size=2, fields='id')
+        second = self.get(page_size=2, fields='id', cursor=first['next_cursor'])
+        self.assertEqual(second['results'], [{'id': track_id} for track_id in self.expected[2:4]])
+
+    def test_page_size_is_clamped(self):
+        self.assertEqual(len(self.get(page_size=0)['results']), 1)
+        self.assertEqual(len(self.get(page_size=1000)['results']), len(self.expected))
+        self.assertEqual(len(self.get(page_size='x')['results']), len(self.expected))
+
+    def test_plain_request_is_not_paginated(self):
+        tracks = self.get()
+        self.assertIsInstance(tracks, list)
+        self.assertEqual(sorted(track['id'] for track in tracks), sorted(self.expected))
+
+    def test_invalid_cursor_is_404(self):
+        for cursor in ('garbage', 'bm90LWEtZGF0ZXwx'):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get('/api/tracks/', {'cursor': cursor}).status_code, 404)
+
+
+class VaultVersionTests(TestCase):
+    """bumps made by workers and other processes have to reach this one's etags"""
+
+    def setUp(self):
+        # the default cache is per process, clearing it is what another process looks like
+        caches['default'].clear()
+        self.user = User.objects.create(username='vault')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get('/api/tracks/', **headers)
+
+    def test_unchanged_vault_answers_304(self):
+        make_track(self.user, 'a')
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(etag).status_code, 304)
+
+    def test_bump_from_another_process_changes_the_etag(self):
+        etag = self.get()['ETag']
+        # what a worker's bump amounts to, nothing in this process' cache changes
+        VaultVersion.objects.bump([self.user.id])
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_transition_engine_bump_changes_the_etag(self):
+        make_track(self.user, 'due', status='pending', available_at=timezone.now() + timedelta(days=1))
+        etag = self.get()['ETag']
+        Track.objects.filter(user=self.user).update(available_at=timezone.now() - timedelta(seconds=1))
+        # the engine runs in another process, so only its bump can change the etag here
+        caches['default'].clear()
+        self.assertEqual(TrackTransitionEngine().apply_due(), 1)
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['status'], 'available')
+
+    def test_bump_creates_missing_rows_and_increments(self):
+        other = User.objects.create(username='other')
+        self.assertEqual(VaultVersion.objects.bump([self.user.id, other.id]), {self.user.id: 1, other.id: 1})
+        self.assertEqual(VaultVersion.objects.bump([other.id, other.id]), {other.id: 2})
+
+
+class LockedIdIndexTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create(username='index')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        make_track(self.user, 'a')
+
+    def check(self, *spotify_ids):
+        return self.client.get('/api/tracks/check/', {'spotify_ids': ','.join(spotify_ids)}).json()['locked_ids']
+
+    def test_index_follows_writes_in_this_process(self):
+        self.assertEqual(self.check('a', 'b'), ['a'])
+        self.client.post('/api/tracks/', {
+            'spotify_id': 'b', 'title': 't', 'artist': 'a', 'album': 'al', 'image_url': 'https://i.example.com/b'
+        }, format='json')
+        self.assertEqual(self.check('a', 'b'), ['a', 'b'])
+
+    def test_import_in_another_process_rebuilds_the_index(self):
+        self.assertEqual(self.check('a', 'b'), ['a'])
+        line = (
+            '{"metadata": {"spotify_id": "b", "title": "t", "artist": "a", "album": "al", '
+            '"image_url": "https://i.example.com/b"}, "status": "pending"}'
+        )
+        # what import_vault does in its own process: write and bump, this cache keeps the old index
+        VaultBackupService.import_lines(self.user.id, [line])
+        VaultVersion.objects.bump([self.user.id])
+        self.assertEqual(self.check('a', 'b'), ['a', 'b'])
+
+
+class VaultEventsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='events')
+        self.other = User.objects.create(username='other')
+
+    def read(self, after, until=None):
+        until = until if until is not None else async_to_sync(vault_events.alatest)()
+        return async_to_sync(vault_events.aread)(after, until)
+
+    def test_reads_back_what_any_process_published(self):
+        first = vault_events.publish(self.user.id, 'locked', track_ids=[1])
+        second = vault_events.publish(self.other.id, 'revealed', spotify_ids=['abc'])
+        entries, complete = self.read(first - 1)
+        self.assertTrue(complete)
+        self.assertEqual(entries, [
+            (first, {'user_id': self.user.id, 'event': {'type': 'locked', 'track_ids': [1]}}),
+            (second, {'user_id': self.other.id, 'event': {'type': 'revealed', 'spotify_ids': ['abc']}}),
+        ])
+
+    def test_pruned_events_are_reported_lost(self):
+        first = vault_events.publish(self.user.id, 'locked', track_ids=[1])
+        vault_events.publish(self.user.id, 'locked', track_ids=[2])
+        last = vault_events.publish(self.user.id, 'locked', track_ids=[3])
+        VaultEvent.objects.exclude(id=last).update(created_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(vault_events.prune(), 2)
+
+        entries, complete = self.read(first)
+        self.assertFalse(complete)
+        self.assertEqual([seq for seq, _ in entries], [last])
+        # a client that had seen everything up to the pruned rows lost nothing
+        self.assertTrue(self.read(last - 1)[1])
+
+    def test_stream_replays_after_last_event_id(self):
+        first = vault_events.publish(self.user.id, 'locked', track_ids=[1])
+        vault_events.publish(self.other.id, 'locked', track_ids=[2])
+        third = vault_events.publish(self.user.id, 'revealed', track_ids=[1])
+
+        async def replay():
+            stream = stream_events(self.user.id, first)
+            try:
+                return [await stream.__anext__(), await stream.__anext__()]
+            finally:
+                await stream.aclose()
+
+        retry, event = async_to_sync(replay)()
+        self.assertTrue(retry.startswith('retry: '))
+        self.assertEqual(event, f'id: {third}\nevent: revealed\ndata: {{"type": "revealed", "track_ids": [1]}}\n\n')
+
+
+class BroadcasterGapTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='gaps')
+        self.clock = FakeClock()
+        patcher = mock.patch('store.services.events.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.broadcaster = VaultEventBroadcaster()
+        self.broadcaster.cursor = async_to_sync(vault_events.alatest)()
+        self.queue = asyncio.Queue()
+        self.broadcaster.subscribers[self.user.id].add(self.queue)
+
+    def publish(self, n):
+        return [vault_events.publish(self.user.id, 'locked', track_ids=[i]) for i in range(n)]
+
+    def poll(self):
+        async_to_sync(self.broadcaster._poll)()
+        delivered = []
+        while not self.queue.empty():
+            delivered.append(self.queue.get_nowait()[0])
+        return delivered
+
+    def test_late_commit_is_delivered_in_order(self):
+        first, late, last = self.publish(3)
+        # the writer holding `late` hasn't committed yet
+        row = VaultEvent.objects.get(id=late)
+        row.delete()
+
+        self.assertEqual(self.poll(), [first])
+        self.clock.now += 2
+        # still inside GAP_TIMEOUT_SECONDS, keep waiting past a single tick
+        self.assertEqual(self.poll(), [])
+        VaultEvent.objects.create(id=late, user=self.user, event=row.event)
+        self.assertEqual(self.poll(), [late, last])
+        self.assertEqual(self.broadcaster.gaps, {})
+
+    def test_gap_that_never_fills_is_skipped_after_the_timeout(self):
+        first, rolled_back, last = self.publish(3)
+        VaultEvent.objects.filter(id=rolled_back).delete()
+
+        self.assertEqual(self.poll(), [first])
+        self.clock.now += settings.VAULT_EVENT_SETTINGS['GAP_TIMEOUT_SECONDS'] + 1
+        self.assertEqual(self.poll(), [last])
+        self.assertEqual(self.broadcaster.cursor, last)
+
+    def test_each_gap_gets_its_own_timeout(self):
+        first, slow, middle, later, last = self.publish(5)
+        VaultEvent.objects.filter(id=slow).delete()
+        self.assertEqual(self.poll(), [first])
+
+        self.clock.now += 3
+        VaultEvent.objects.filter(id=later).delete()
+        self.assertEqual(self.poll(), [])
+        # the first gap timed out, the second one was only seen 3 seconds ago
+        self.clock.now += 3
+        self.assertEqual(self.poll(), [middle])
+        self.clock.now += 3
+        self.assertEqual(self.poll(), [last])
+
+
+class VaultBackupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='source')
+        self.target = User.objects.create(username='target')
+        now = timezone.now()
+        make_track(self.user, 'a', created_at=at(0))
+        make_track(self.user, 'b', created_at=at(1), status='pending', locked_at=now, available_at=now + timedelta(days=1))
+        make_track(self.user, 'c', created_at=at(2).replace(microsecond=5), status='revealed',
+                   locked_at=at(0), available_at=at(1), revealed_at=at(2), played_at=at(3))
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def export(self, user):
+        response = self.client_for(user).get('/api/tracks/export/')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return b''.join(response.streaming_content).decode()
+
+    def import_(self, user, body):
+        return self.client_for(user).generic(
+            'POST', '/api/tracks/import/', body.encode(), content_type='application/x-ndjson'
+        ).json()
+
+    def test_round_trip(self):
+        body = self.export(self.user)
+        self.assertEqual(len(body.splitlines()), 3)
+
+        result = self.import_(self.target, body + 'not json\n{"status": "bogus"}\n')
+        self.assertEqual((result['created'], result['updated'], result['unchanged'], result['invalid']), (3, 0, 0, 2))
+        self.assertEqual([error['line'] for error in result['errors']], [4, 5])
+        # the same lines, created_at included, come back out of the other vault
+        self.assertEqual(self.export(self.target), body)
+
+    def test_reimport_writes_nothing(self):
+        body = self.export(self.user)
+        self.import_(self.target, body)
+        etag = self.client_for(self.target).get('/api/tracks/')['ETag']
+
+        result = self.import_(self.target, body)
+        self.assertEqual((result['created'], result['updated'], result['unchanged']), (0, 0, 3))
+        self.assertEqual(self.client_for(self.target).get('/api/tracks/')['ETag'], etag)
+
+    def test_reimport_counts_changed_tracks(self):
+        body = self.export(self.user)
+        self.import_(self.target, body)
+        lines = [json.loads(line) for line in body.splitlines()]
+        lines[0]['status'] = 'revealed'
+        lines[0]['revealed_at'] = '2024-02-01T00:00:00Z'
+
+        result = self.import_(self.target, ''.join(json.dumps(line) + '\n' for line in lines))
+        self.assertEqual((result['created'], result['updated'], result['unchanged']), (0, 1, 2))
+        self.assertEqual(Track.objects.get(user=self.target, metadata__spotify_id='a').status, 'revealed')
+
+
+class DedupeTrackMetadataMigrationTests(TransactionTestCase):
+    migrate_from = [('store', '0004_track_keyset_index')]
+    migrate_to = [('store', '0005_dedupe_track_metadata')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(self.migrate_from)
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_keeps_the_most_advanced_copy_and_merges_dates(self):
+        apps = self.migrate(self.migrate_from)
+        User = apps.get_model('auth', 'User')
+        TrackMetadata = apps.get_model('store', 'TrackMetadata')
+        Track = apps.get_model('store', 'Track')
+
+        fields = {'title': 't', 'artist': 'a', 'album': 'al', 'image_url': 'https://i.example.com/x'}
+        first = TrackMetadata.objects.create(spotify_id='dup', **fields)
+        second = TrackMetadata.objects.create(spotify_id='dup', **fields)
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+
+        # alice's newer pending copy is on the kept row, the revealed one on the extra row
+        pending = Track.objects.create(user=alice, metadata=first, status='pending')
+        revealed = Track.objects.create(user=alice, metadata=second, status='revealed', revealed_at=at(30), played_at=at(40))
+        Track.objects.filter(id=pending.id).update(created_at=at(20), played_at=at(50))
+        Track.objects.filter(id=revealed.id).update(created_at=at(10))
+        only = Track.objects.create(user=bob, metadata=second, status='active')
+
+        apps = self.migrate(self.migrate_to)
+        TrackMetadata = apps.get_model('store', 'TrackMetadata')
+        Track = apps.get_model('store', 'Track')
+
+        self.assertEqual(list(TrackMetadata.objects.values_list('id', flat=True)), [first.id])
+        kept = Track.objects.get(user_id=alice.id)
+        self.assertEqual(kept.id, revealed.id)
+        self.assertEqual(kept.metadata_id, first.id)
+        self.assertEqual(kept.status, 'revealed')
+        self.assertEqual(kept.created_at, at(10))
+        self.assertEqual(kept.revealed_at, at(30))
+        self.assertEqual(kept.played_at, at(50))
+        self.assertEqual(Track.objects.get(user_id=bob.id).id, only.id)
+        self.assertEqual(Track.objects.get(user_id=bob.id).metadata_id, first.id)
+
+
+class AsyncSpotifyViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('async', password='pw')
+        SpotifyToken.objects.create(
+            user=cls.user,
+            access_token='access',
+            refresh_token='refresh',
+            expires_at=timezone.now() + timedelta(hours=1)
+        )
+        make_track(cls.user, 'saved')
+
+    def setUp(self):
+        caches['spotify'].clear()
+        self.async_client.force_login(self.user)
+        self.requests = []
+
+    def spotify(self, request):
+        self.requests.append(request)
+        items = [{
+            'id': spotify_id,
+            'name': spotify_id,
+            'artists': [{'name': 'artist'}],
+            'album': {'name': 'album', 'images': [], 'release_date': '2020'},
+            'preview_url': None
+        } for spotify_id in ('saved', 'new')]
+        return httpx.Response(200, json={'tracks': {'items': items}})
+
+    async def test_search_runs_through_the_async_stack(self):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(self.spotify))
+        with mock.patch('store.services.spotify_async.get_client', return_value=client):
+            response = await self.async_client.get('/api/spotify/async/search/', {'q': '  Daft  PUNK '})
+        await client.aclose()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-User-Authenticated'], 'True')
+        self.assertEqual(
+            [(track['metadata']['spotify_id'], track['in_vault']) for track in response.json()['tracks']['items']],
+            [('saved', True), ('new', False)]
+        )
+        [request] = self.requests
+        self.assertEqual(request.url.params['q'], 'daft punk')
+        self.assertEqual(request.headers['Authorization'], 'Bearer access')
+
+    async def test_anonymous_request_is_rejected(self):
+        response = await AsyncClient().get('/api/spotify/async/search/', {'q': 'daft punk'})
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response['X-User-Authenticated'], 'False')
+        self.assertEqual(self.requests, [])
+
+
+class SpotifyTokenMiddlewareTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('lazy', password='pw')
+        SpotifyToken.objects.create(
+            user=cls.user,
+            access_token='access',
+            refresh_token='refresh',
+            expires_at=timezone.now() + timedelta(hours=1)
+        )
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def token_queries(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in queries if SpotifyToken._meta.db_table in query['sql']]
+
+    def test_token_is_not_loaded_unless_a_view_asks(self):
+        self.assertEqual(self.token_queries('/api/tracks/check/?spotify_ids=a,b'), [])
+
+    def test_token_is_loaded_once_per_request(self):
+        self.assertEqual(len(self.token_queries('/api/spotify/status/')), 1)
+
+    def test_middleware_stack_stays_async(self):
+        adapted = []
+        adapt_method_mode = ASGIHandler.adapt_method_mode
+
+        def spy(handler, is_async, method, method_is_async=None, debug=False, name=None):
+            if method_is_async is None:
+                method_is_async = iscoroutinefunction(method)
+            # named calls wrap a middleware's handler, unnamed ones are django's own process_view hooks
+            if is_async != method_is_async and name:
+                adapted.append(name)
+            return adapt_method_mode(handler, is_async, method, method_is_async, debug, name)
+
+        with mock.patch.object(ASGIHandler, 'adapt_method_mode', spy):
+            ASGIHandler()
+
+        self.assertEqual(adapted, [])
+
+
+class FakePlaylist:
+    """the few SpotifyService calls a reveal job makes, against an in-memory playlist"""
+    PLAYLIST_WRITE_SIZE = 2
+
+    def __init__(self, present=(), on_write=None):
+        self.present = list(present)
+        self.writes = []
+        self.on_write = on_write
+
+    def iter_playlist_tracks(self, playlist_id, fields=None):
+        return [{'track': {'id': spotify_id}} for spotify_id in self.present]
+
+    def add_tracks_to_playlist(self, playlist_id, track_ids):
+        self.writes.append(list(track_ids))
+        self.present.extend(track_ids)
+        if self.on_write:
+            self.on_write()
+
+
+class RevealJobServiceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reveal')
+        SpotifyPlaylistSettings.objects.create(user=cls.user, playlist_id='playlist', playlist_name='vault')
+
+    def make_available(self, *spotify_ids):
+        return [make_track(self.user, spotify_id, status='available').id for spotify_id in spotify_ids]
+
+    def test_start_queues_one_job_per_user(self):
+        self.make_available('a', 'b')
+
+        job, created = RevealJobService.start(self.user)
+        again, created_again = RevealJobService.start(self.user)
+
+        self.assertTrue(created)
+        self.assertEqual((job.status, job.total), ('queued', 2))
+        self.assertFalse(created_again)
+        self.assertEqual(again.id, job.id)
+
+    def test_start_with_nothing_to_reveal_completes_at_once(self):
+        job, created = RevealJobService.start(self.user)
+
+        self.assertTrue(created)
+        self.assertEqual(job.status, 'completed')
+        self.assertIsNotNone(job.finished_at)
+
+    def test_claim_takes_queued_and_stale_jobs_only(self):
+        self.make_available('a')
+        job, _ = RevealJobService.start(self.user)
+
+        claimed = RevealJobService.claim()
+        self.assertEqual((claimed.id, claimed.status), (job.id, 'running'))
+        self.assertIsNotNone(claimed.lease)
+        # the worker is alive, nobody else gets it
+        self.assertIsNone(RevealJobService.claim())
+
+        RevealJob.objects.filter(id=job.id).update(updated_at=timezone.now() - timedelta(hours=1))
+        reclaimed = RevealJobService.claim()
+        self.assertEqual(reclaimed.id, job.id)
+        self.assertNotEqual(reclaimed.lease, claimed.lease)
+
+    def test_run_resumes_after_last_track_id(self):
+        first, *rest = self.make_available('a', 'b', 'c')
+        RevealJobService.start(self.user)
+        job = RevealJobService.claim()
+        # a crashed attempt got through the first track, and already wrote the second to spotify
+        RevealJobService.heartbeat(job, last_track_id=first, revealed=1)
+        spotify = FakePlaylist(present=['a', 'b'])
+
+        job = RevealJobService.run(job, spotify, batch_size=2)
+
+        self.assertEqual(spotify.writes, [['c']])
+        self.assertEqual((job.status, job.revealed, job.last_track_id), ('completed', 3, rest[-1]))
+        self.assertEqual(
+            set(Track.objects.filter(id__in=rest).values_list('status', flat=True)), {'revealed'}
+        )
+        self.assertEqual(Track.objects.get(id=first).status, 'available')
+
+    def stall(self, job):
+        # as if the last write took longer than STALE_AFTER_SECONDS
+        RevealJob.objects.filter(id=job.id).update(updated_at=timezone.now() - timedelta(hours=1))
+
+    def test_slow_batch_heartbeats_before_every_chunk(self):
+        self.make_available('a', 'b', 'c', 'd', 'e')
+        RevealJobService.start(self.user)
+        job = RevealJobService.claim()
+
+        def write():
+            # the heartbeat just before this write keeps the job from being claimed again
+            self.assertIsNone(RevealJobService.claim())
+            self.stall(job)
+
+        spotify = FakePlaylist(on_write=write)
+        job = RevealJobService.run(job, spotify, batch_size=5)
+
+        self.assertEqual(spotify.writes, [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertEqual((job.status, job.revealed), ('completed', 5))
+
+    def test_worker_that_lost_its_lease_stops(self):
+        ids = self.make_available('a', 'b', 'c')
+        RevealJobService.start(self.user)
+        job = RevealJobService.claim()
+
+        def write():
+            self.stall(job)
+            self.taken_over = RevealJobService.claim()
+
+        spotify = FakePlaylist(on_write=write)
+        with self.assertRaises(RevealJobLost):
+            RevealJobService.run(job, spotify, batch_size=3)
+
+        self.assertEqual(spotify.writes, [['a', 'b']])
+        current = RevealJob.objects.get(id=job.id)
+        self.assertEqual((current.status, current.lease, current.revealed), ('running', self.taken_over.lease, 0))
+        self.assertFalse(Track.objects.filter(id__in=ids, status='revealed').exists())
+        # nor can the old worker settle the job
+        with self.assertRaises(RevealJobLost):
+            RevealJobService.fail(job, 'boom')
+        self.assertEqual(RevealJob.objects.get(id=job.id).status, 'running')
+
+    def test_requeue_hands_the_job_back(self):
+        self.make_available('a')
+        RevealJobService.start(self.user)
+        job = RevealJobService.claim()
+
+        RevealJobService.requeue(job)
+
+        requeued = RevealJob.objects.get(id=job.id)
+        self.assertEqual((requeued.status, requeued.lease), ('queued', None))
+        self.assertEqual(RevealJobService.claim().id, job.id)
+
+    def test_fail_records_the_error(self):
+        self.make_available('a')
+        RevealJobService.start(self.user)
+        job = RevealJobService.claim()
+
+        RevealJobService.fail(job, 'Spotify not connected')
+
+        failed = RevealJob.objects.get(id=job.id)
+        self.assertEqual((failed.status, failed.error), ('failed', 'Spotify not connected'))
+        self.assertIsNotNone(failed.finished_at)
+        self.assertIsNone(RevealJobService.claim())
+
+
+class BulkTrackTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('bulk')
+        cls.other = User.objects.create_user('other')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def item(self, spotify_id, **fields):
+        return {
+            'spotify_id': spotify_id,
+            'title': f'title {spotify_id}',
+            'artist': 'artist',
+            'album': 'album',
+            'image_url': f'https://i.example.com/{spotify_id}',
+            **fields
+        }
+
+    def test_bulk_reports_every_item_in_order(self):
+        existing = make_track(self.user, 'kept', status='revealed')
+        make_track(self.other, 'shared')
+
+        response = self.client.post('/api/tracks/bulk/', {'tracks': [
+            self.item('new'),
+            self.item('kept'),
+            self.item('new'),
+            self.item('bad', image_url='not a url'),
+            self.item('shared', title='not the stored title'),
+        ]}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['created'], 2)
+        self.assertEqual(
+            [result['result'] for result in body['results']],
+            ['created', 'exists', 'duplicate', 'invalid', 'created']
+        )
+        self.assertEqual(body['results'][1]['id'], existing.id)
+        self.assertEqual(body['results'][3]['spotify_id'], 'bad')
+        self.assertEqual(
+            set(Track.objects.filter(user=self.user).values_list('metadata__spotify_id', 'status')),
+            {('new', 'pending'), ('kept', 'revealed'), ('shared', 'pending')}
+        )
+        # metadata another user vaulted first is reused as stored
+        self.assertEqual(TrackMetadata.objects.get(spotify_id='shared').title, 'title shared')
+
+    def test_bulk_survives_a_concurrent_insert(self):
+        # another request vaults the track after our read of the user's tracks
+        raced = make_track(self.user, 'raced')
+        vaulted = TrackService._vaulted
+
+        with mock.patch.object(TrackService, '_vaulted', side_effect=[{}, vaulted(self.user, ['raced', 'new'])]):
+            response = self.client.post(
+                '/api/tracks/bulk/',
+                {'tracks': [self.item('raced'), self.item('new')]},
+                format='json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(result['result'], result.get('id')) for result in response.json()['results']][0],
+            ('exists', raced.id)
+        )
+        self.assertEqual(response.json()['results'][1]['result'], 'created')
+        self.assertEqual(Track.objects.filter(user=self.user).count(), 2)
+
+    def test_bulk_rejects_a_bad_body(self):
+        for body in ({}, {'tracks': []}, {'tracks': 'x'}):
+            self.assertEqual(self.client.post('/api/tracks/bulk/', body, format='json').status_code, 400)
+
+    def test_bulk_transition_updates_allowed_tracks_only(self):
+        active = make_track(self.user, 'a')
+        pending = make_track(self.user, 'b', status='pending')
+        theirs = make_track(self.other, 'c')
+        version = vault_versions.version(self.user.id)
+
+        response = self.client.post('/api/tracks/bulk/transition/', {
+            'action': 'lock',
+            'ids': [active.id, pending.id, theirs.id, active.id]
+        }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['updated'], 1)
+        self.assertEqual(
+            [(result['id'], result.get('status'), result.get('detail')) for result in body['results']],
+            [
+                (active.id, 'pending', None),
+                (pending.id, None, 'Track is not active'),
+                (theirs.id, None, 'Not found.'),
+            ]
+        )
+        active.refresh_from_db()
+        self.assertEqual(active.status, 'pending')
+        self.assertIsNotNone(active.available_at)
+        self.assertEqual(Track.objects.get(id=theirs.id).status, 'active')
+        self.assertGreater(vault_versions.version(self.user.id), version)
+        [event] = VaultEvent.objects.filter(user=self.user)
+        self.assertEqual(event.event['track_ids'], [active.id])
+
+    def test_bulk_transition_validates_the_action(self):
+        response = self.client.post('/api/tracks/bulk/transition/', {'action': 'delete', 'ids': [1]}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+def spotify_track(spotify_id, name, **fields):
+    return {
+        'id': spotify_id,
+        'name': name,
+        'artists': [{'name': 'artist'}],
+        'album': {'name': 'album', 'images': [{'url': f'https://i.example.com/{spotify_id}'}], 'release_date': '2020-01-01'},
+        'preview_url': None,
+        **fields
+    }
+
+
+class FakeCatalog:
+    """SpotifyService.get_tracks over a dict of spotify track objects, keyed by the id asked for"""
+    def __init__(self, tracks):
+        self.tracks = tracks
+        self.requested = []
+
+    def get_tracks(self, track_ids, use_cache=True):
+        self.requested.extend(track_ids)
+        return {
+            'tracks': [self.tracks[track_id] for track_id in track_ids if track_id in self.tracks],
+            'missing': [track_id for track_id in track_ids if track_id not in self.tracks],
+        }
+
+
+class RefreshMetadataTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('refresh')
+        self.now = timezone.now()
+        self.catalog = FakeCatalog({
+            'same': spotify_track('same', 'title same'),
+            'renamed': spotify_track('renamed', 'new title'),
+            # asked for 'old', spotify answers with the track it was relinked to
+            'old': spotify_track('new', 'relinked title', linked_from={'id': 'old'}),
+        })
+
+    def test_updates_changed_and_relinked_rows(self):
+        track = make_track(self.user, 'old')
+        rows = [make_metadata('same'), make_metadata('renamed'),
+                track.metadata, make_metadata('gone')]
+        version = vault_versions.version(self.user.id)
+
+        changed, missing = TrackService.refresh_metadata(self.catalog, rows, self.now)
+
+        self.assertEqual(sorted(row.spotify_id for row in changed), ['old', 'renamed'])
+        self.assertEqual(missing, ['gone'])
+        relinked = TrackMetadata.objects.get(id=track.metadata_id)
+        # the row keeps the id it was saved under, the vault still points at it
+        self.assertEqual((relinked.spotify_id, relinked.title), ('old', 'relinked title'))
+        self.assertEqual(
+            set(TrackMetadata.objects.values_list('spotify_id', 'refreshed_at')),
+            {(spotify_id, self.now) for spotify_id in ('same', 'renamed', 'old', 'gone')}
+        )
+        self.assertGreater(vault_versions.version(self.user.id), version)
+
+    def test_command_refreshes_only_stale_rows(self):
+        make_metadata('renamed')
+        make_metadata('old')
+        make_metadata('same', refreshed_at=self.now)
+        out = io.StringIO()
+
+        with mock.patch('store.services.spotify.SpotifyService.for_app', return_value=self.catalog):
+            call_command('refresh_track_metadata', '--batch-size', '1', stdout=out)
+
+        self.assertEqual(self.catalog.requested, ['renamed', 'old'])
+        self.assertIn('checked 2, updated 2, missing on spotify 0, failed 0', out.getvalue())
+        self.assertEqual(TrackMetadata.objects.get(spotify_id='old').title, 'relinked title')
+        self.assertEqual(TrackMetadata.objects.stale().count(), 0)
+
+
+class FakeSearch:
+    """SpotifyService.search_tracks over a fixed catalog, every word has to match"""
+    def __init__(self, tracks):
+        self.tracks = tracks
+        self.queries = []
+
+    def search_tracks(self, query, limit=15, use_cache=True):
+        self.queries.append(query)
+        matches = [
+            track for track in self.tracks
+            if all(word in f"{track['name']} {track['album']['name']}".casefold() for word in query.split())
+        ]
+        return {'tracks': {'items': matches[:limit], 'total': len(matches)}}
+
+
+class SearchServiceTests(TestCase):
+    def setUp(self):
+        caches['spotify'].clear()
+        self.user = User.objects.create_user('search')
+        self.spotify = FakeSearch([
+            spotify_track('one', 'One More Time'),
+            spotify_track('aero', 'Aerodynamic'),
+            spotify_track('more', 'More Spell On You'),
+        ])
+
+    def search(self, query, user=None, limit=15):
+        return SearchService.search(self.spotify, (user or self.user).id, query, limit)
+
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query('  Daft\tPUNK  one '), 'daft punk one')
+        self.assertEqual(normalize_query('   '), '')
+
+    def test_mark_vaulted(self):
+        tracks = [{'metadata': {'spotify_id': 'a'}}, {'metadata': {'spotify_id': 'b'}}]
+
+        marked = mark_vaulted(tracks, frozenset({'b'}))
+
+        self.assertEqual([track['in_vault'] for track in marked], [False, True])
+        self.assertNotIn('in_vault', tracks[0])
+
+    def test_in_vault_is_per_user_over_shared_results(self):
+        other = User.objects.create_user('other')
+        make_track(self.user, 'one')
+
+        mine = self.search('  MORE ')
+        theirs = self.search('more', user=other)
+
+        self.assertEqual(self.spotify.queries, ['more'])
+        self.assertEqual([(track['metadata']['spotify_id'], track['in_vault']) for track in mine],
+                         [('one', True), ('more', False)])
+        self.assertEqual([track['in_vault'] for track in theirs], [False, False])
+
+    def test_longer_query_reuses_a_complete_prefix(self):
+        self.search('more')
+
+        tracks = self.search('more time')
+        self.search('more tim')
+
+        self.assertEqual(self.spotify.queries, ['more'])
+        self.assertEqual([track['metadata']['spotify_id'] for track in tracks], ['one'])
+
+    def test_truncated_prefix_is_not_reused(self):
+        # spotify had more than the one result it returned
+        self.search('more', limit=1)
+
+        tracks = self.search('more spell', limit=1)
+
+        self.assertEqual(self.spotify.queries, ['more', 'more spell'])
+        self.assertEqual([track['metadata']['spotify_id'] for track in tracks], ['more'])
+
+    def test_async_search_reuses_a_complete_prefix(self):
+        class AsyncSearch:
+            queries = self.spotify.queries
+
+            async def search_tracks(inner, query, limit=15, use_cache=True):
+                return self.spotify.search_tracks(query, limit, use_cache)
+
+        spotify = AsyncSearch()
+        async_to_sync(SearchService.asearch)(spotify, self.user.id, 'aero')
+        tracks = async_to_sync(SearchService.asearch)(spotify, self.user.id, 'aerody')
+
+        self.assertEqual(self.spotify.queries, ['aero'])
+        self.assertEqual([track['metadata']['spotify_id'] for track in tracks], ['aero'])
+
+
+class TransitionEngineTests(TestCase):
+    def test_only_changed_tracks_are_bumped_and_published(self):
+        user = User.objects.create_user('due')
+        other = User.objects.create_user('not-due')
+        past = timezone.now() - timedelta(minutes=1)
+        due = [make_track(user, spotify_id, status='pending', available_at=past).id for spotify_id in ('a', 'b')]
+        # revealed by hand after it came due, the engine must leave it and say nothing
+        make_track(other, 'c', status='revealed', available_at=past)
+        make_track(other, 'd', status='pending', available_at=timezone.now() + timedelta(days=1))
+
+        self.assertEqual(TrackTransitionEngine().apply_due(), 2)
+
+        self.assertEqual(
+            set(Track.objects.values_list('metadata__spotify_id', 'status')),
+            {('a', 'available'), ('b', 'available'), ('c', 'revealed'), ('d', 'pending')}
+        )
+        [event] = VaultEvent.objects.all()
+        self.assertEqual((event.user_id, event.event['type'], event.event['track_ids']), (user.id, 'available', due))
+        self.assertFalse(VaultVersion.objects.filter(user=other).exists())
+        self.assertEqual(TrackTransitionEngine().apply_due(), 0)
+        self.assertEqual(VaultEvent.objects.count(), 1)
+
+
+class SpotifyTokenRefreshTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('tokens')
+        self.token = SpotifyToken.objects.create(
+            user=self.user,
+            access_token='old',
+            refresh_token='refresh',
+            expires_at=timezone.now() - timedelta(minutes=1)
+        )
+        self.calls = []
+
+    def refreshed(self, refresh_token):
+        self.calls.append(refresh_token)
+        # slow enough for the second caller to arrive while this one holds the lock
+        time.sleep(0.2)
+        return {'access_token': f'new{len(self.calls)}', 'expires_in': 3600}
+
+    def test_concurrent_refreshes_call_spotify_once(self):
+        start = threading.Barrier(2)
+        tokens = []
+
+        def request():
+            try:
+                token = SpotifyToken.objects.get(pk=self.token.pk)
+                start.wait()
+                tokens.append(token.get_valid_access_token())
+            finally:
+                connection.close()
+
+        with mock.patch.object(SpotifyService, 'refresh_token', side_effect=self.refreshed):
+            threads = [threading.Thread(target=request) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(self.calls, ['refresh'])
+        self.assertEqual(tokens, ['new1', 'new1'])
+        self.assertEqual(SpotifyToken.objects.get(pk=self.token.pk).access_token, 'new1')
+
+    def test_loop_refreshes_expiring_tokens_each_pass(self):
+        fresh = User.objects.create_user('fresh')
+        SpotifyToken.objects.create(
+            user=fresh, access_token='fresh', refresh_token='fresh', expires_at=timezone.now() + timedelta(hours=1)
+        )
+        out = io.StringIO()
+
+        class Stop(Exception):
+            pass
+
+        passes = []
+
+        def sleep(seconds):
+            passes.append(seconds)
+            if len(passes) == 1:
+                # the token is about to expire again by the next pass
+                SpotifyToken.objects.filter(pk=self.token.pk).update(expires_at=timezone.now())
+            else:
+                raise Stop
+
+        with mock.patch.object(SpotifyService, 'refresh_token', side_effect=lambda refresh_token: (
+            self.calls.append(refresh_token) or {'access_token': 'new', 'refresh_token': 'rotated', 'expires_in': 3600}
+        )), mock.patch('store.management.commands.refresh_spotify_tokens.time.sleep', sleep):
+            with self.assertRaises(Stop):
+                call_command('refresh_spotify_tokens', '--loop', '--interval', '7', stdout=out)
+
+        self.assertEqual(passes, [7, 7])
+        # the second pass used the refresh token spotify rotated in the first
+        self.assertEqual(self.calls, ['refresh', 'rotated'])
+        self.assertEqual(out.getvalue().count('Refreshed 1 tokens (0 failed)'), 2)
+        self.assertEqual(SpotifyToken.objects.get(user=fresh).access_token, 'fresh')
+
+
+class SpotifyCacheTests(SimpleTestCase):
+    def setUp(self):
+        caches['spotify'].clear()
+        self.cache = SpotifyCache()
+        self.fetches = 0
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_concurrent_misses_share_one_fetch(self):
+        fetching = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def fetch():
+            self.fetches += 1
+            fetching.set()
+            release.wait(5)
+            return {'tracks': ['a']}
+
+        def search():
+            results.append(self.cache.get_or_fetch('search', {'q': 'a'}, fetch))
+
+        threads = [threading.Thread(target=search) for _ in range(5)]
+        threads[0].start()
+        fetching.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        self.wait_for(lambda: self.cache.stats()['search']['coalesced'] == 4)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(results, [{'tracks': ['a']}] * 5)
+        self.assertEqual(self.cache.get_or_fetch('search', {'q': 'a'}, fetch), {'tracks': ['a']})
+        self.assertEqual(
+            self.cache.stats(),
+            {'search': {'hits': 1, 'misses': 1, 'coalesced': 4, 'hit_rate': 0.5}}
+        )
+
+    def test_a_failed_fetch_reaches_the_waiters_and_is_not_cached(self):
+        fetching = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def fetch():
+            fetching.set()
+            release.wait(5)
+            raise SpotifyUnavailable(1)
+
+        def search():
+            try:
+                self.cache.get_or_fetch('search', {'q': 'a'}, fetch)
+            except SpotifyUnavailable as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=search) for _ in range(2)]
+        threads[0].start()
+        fetching.wait(5)
+        threads[1].start()
+        self.wait_for(lambda: self.cache.stats()['search']['coalesced'] == 1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(self.cache.get_or_fetch('search', {'q': 'a'}, lambda: 'fetched'), 'fetched')
+
+    def test_concurrent_async_misses_share_one_fetch(self):
+        async def fetch():
+            self.fetches += 1
+            await asyncio.sleep(0.01)
+            return {'tracks': ['a']}
+
+        async def search():
+            first = await asyncio.gather(*[self.cache.aget_or_fetch('search', {'q': 'a'}, fetch) for _ in range(5)])
+            return first, await self.cache.aget_or_fetch('search', {'q': 'a'}, fetch)
+
+        results, cached = async_to_sync(search)()
+
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(results, [{'tracks': ['a']}] * 5)
+        self.assertEqual(cached, {'tracks': ['a']})
+        self.assertEqual(
+            self.cache.stats(),
+            {'search': {'hits': 1, 'misses': 1, 'coalesced': 4, 'hit_rate': 0.5}}
+        )
+
+    def test_catalog_keys_are_shared_and_me_keys_per_user(self):
+        self.assertEqual(self.cache.key('search', {'q': 'a'}), self.cache.key('search', {'q': 'a'}))
+        self.assertTrue(self.cache.key('search', {'q': 'a'}).startswith('catalog:'))
+        self.assertNotEqual(
+            self.cache.key('me/playlists', {'limit': 50}, user_id=1),
+            self.cache.key('me/playlists', {'limit': 50}, user_id=2)
+        )
+
+    def test_me_responses_are_never_shared_between_users(self):
+        def request(service, method, url, **kwargs):
+            self.fetches += 1
+            return mock.Mock(ok=True, json=lambda: {'owner': service.access_token})
+
+        first, second = SpotifyService('first', user_id=1), SpotifyService('second', user_id=2)
+        anonymous = SpotifyService('anonymous')
+        with mock.patch.object(SpotifyService, '_request', autospec=True, side_effect=request):
+            self.assertEqual(first.get_user_playlists(), {'owner': 'first'})
+            self.assertEqual(second.get_user_playlists(), {'owner': 'second'})
+            self.assertEqual(first.get_user_playlists(), {'owner': 'first'})
+            self.assertEqual(second.get_user_playlists(), {'owner': 'second'})
+            # without a user id there's no safe key, nothing is cached
+            anonymous.get_user_playlists()
+            anonymous.get_user_playlists()
+
+        self.assertEqual(self.fetches, 4)
+
+
+class FakeRecommender:
+    """the spotify calls the recommendation service makes, over fixed answers"""
+    def __init__(self, top=(), saved=(), recommendations=None, recent=()):
+        self.top = list(top)
+        self.saved = list(saved)
+        self.recommendations = recommendations or {}
+        self.recent = list(recent)
+        self.calls = []
+
+    def get_user_top_tracks(self, limit=20):
+        return {'items': self.top[:limit]}
+
+    def iter_saved_tracks(self, max_items=None):
+        return iter(self.saved[:max_items])
+
+    def get_recommendations(self, seeds, limit=20):
+        self.calls.append((tuple(seeds), limit))
+        return {'tracks': self.recommendations.get(tuple(seeds), [])[:limit]}
+
+    def get_recently_played(self, limit=6, after=None):
+        return {'items': [{'track': track} for track in self.recent[:limit]]}
+
+
+def saved_item(spotify_id, added_minutes):
+    return {'track': spotify_track(spotify_id, spotify_id), 'added_at': at(added_minutes).isoformat()}
+
+
+class BuriedRecommendationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buried')
+        self.spotify = FakeRecommender(
+            top=[spotify_track('hit', 'hit')],
+            saved=[saved_item('newer', 20), saved_item('hit', 5), saved_item('older', 10), saved_item('vaulted', 1)],
+            recommendations={('hit',): [
+                spotify_track('rec1', 'rec1'), spotify_track('older', 'older'), {'id': None}, spotify_track('rec2', 'rec2')
+            ]},
+        )
+        make_track(self.user, 'vaulted')
+
+    def ranked(self, result):
+        return [(track['metadata']['spotify_id'], track['source']) for track in result['tracks']]
+
+    def test_saved_tracks_that_left_the_top_interleave_with_recommendations(self):
+        result = RecommendationService.get_buried(self.user.id, self.spotify)
+
+        # oldest saves first, no vaulted, top or unplayable tracks, nothing twice
+        self.assertEqual(self.ranked(result), [
+            ('rec1', 'recommended'), ('older', 'saved'), ('newer', 'saved'), ('rec2', 'recommended')
+        ])
+        self.assertEqual(self.spotify.calls, [(('hit',), 50)])
+
+    def test_stored_list_is_served_until_it_expires(self):
+        RecommendationService.get_buried(self.user.id, self.spotify)
+        make_track(self.user, 'rec1')
+        vault_versions.bump(self.user.id, added=['rec1'])
+
+        # no spotify calls, and the track vaulted since drops out on read
+        result = RecommendationService.get_buried(self.user.id, self.spotify)
+        self.assertEqual(len(self.spotify.calls), 1)
+        self.assertEqual([spotify_id for spotify_id, _ in self.ranked(result)], ['older', 'newer', 'rec2'])
+
+        BuriedRecommendations.objects.filter(user=self.user).update(expires_at=timezone.now())
+        RecommendationService.get_buried(self.user.id, self.spotify)
+        self.assertEqual(len(self.spotify.calls), 2)
+
+    def test_without_spotify_nothing_is_computed(self):
+        self.assertEqual(RecommendationService.get_buried(self.user.id), {'tracks': [], 'computed_at': None})
+
+    def test_endpoint_serves_the_stored_list(self):
+        RecommendationService.get_buried(self.user.id, self.spotify)
+        SpotifyToken.objects.create(
+            user=self.user, access_token='access', refresh_token='refresh',
+            expires_at=timezone.now() + timedelta(hours=1)
+        )
+        client = APIClient()
+        client.force_login(self.user)
+
+        response = client.get('/api/spotify/buried-recommendations/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(track['metadata']['spotify_id'], track['source']) for track in response.json()['tracks']][:2],
+            [('rec1', 'recommended'), ('older', 'saved')]
+        )
+
+
+class UniqueRecommendationTests(TestCase):
+    def setUp(self):
+        caches['spotify'].clear()
+        self.user = User.objects.create_user('unique')
+        make_track(self.user, 'vaulted')
+
+    def test_filters_the_vault_and_recent_plays(self):
+        spotify = FakeRecommender(
+            recommendations={('a', 'b'): [spotify_track(spotify_id, spotify_id) for spotify_id in
+                                          ('vaulted', 'played', 'one', 'one', 'two', 'three')]},
+            recent=[spotify_track('played', 'played')],
+        )
+
+        result = RecommendationService.get_unique(spotify, self.user.id, ['a', 'b'], limit=2)
+
+        self.assertEqual([track['spotify_id'] for track in result['tracks']], ['one', 'two'])
+        # overfetched once, enough was left so no refill
+        self.assertEqual(spotify.calls, [(('a', 'b'), 6)])
+
+    def test_refills_from_single_seeds_until_the_limit(self):
+        spotify = FakeRecommender(recommendations={
+            ('a', 'b'): [spotify_track('vaulted', 'vaulted'), spotify_track('one', 'one')],
+            ('a',): [spotify_track('one', 'one'), spotify_track('two', 'two')],
+            ('b',): [spotify_track('three', 'three'), spotify_track('four', 'four')],
+        })
+
+        result = RecommendationService.get_unique(spotify, self.user.id, ['a', 'b'], limit=3)
+
+        self.assertEqual([track['spotify_id'] for track in result['tracks']], ['one', 'two', 'three'])
+        self.assertEqual(sorted(seeds for seeds, _ in spotify.calls), [('a',), ('a', 'b'), ('b',)])
+
+    def test_seeds_default_to_top_tracks_and_limit_is_clamped(self):
+        spotify = FakeRecommender(
+            top=[spotify_track('t1', 't1'), spotify_track('t2', 't2')],
+            recommendations={('t1', 't2'): [spotify_track('one', 'one'), spotify_track('two', 'two')]},
+        )
+
+        result = RecommendationService.get_unique(spotify, self.user.id, limit=0)
+
+        self.assertEqual(result['seeds'], ['t1', 't2'])
+        self.assertEqual([track['spotify_id'] for track in result['tracks']], ['one'])
+
+    def test_no_seeds_no_calls(self):
+        spotify = FakeRecommender()
+
+        self.assertEqual(RecommendationService.get_unique(spotify, self.user.id), {'tracks': [], 'seeds': []})
+        self.assertEqual(spotify.calls, [])
+
+
+class ListeningHistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('listening')
+        self.track = make_track(self.user, 'a', status='revealed')
+        Track.objects.filter(id=self.track.id).update(played_at=at(10))
+
+    def played_at(self, track):
+        return Track.objects.get(id=track.id).played_at
+
+    def test_record_plays_only_moves_forward(self):
+        other = make_track(User.objects.create_user('other'), 'b')
+        mine = Track.objects.create(user=self.user, metadata=other.metadata)
+
+        # an older play of 'a' must not overwrite the newer one
+        self.assertEqual(ListeningHistoryService.record_plays(self.user.id, {'a': at(5), 'b': at(7), 'gone': at(8)}), 1)
+        self.assertEqual(self.played_at(self.track), at(10))
+        self.assertEqual(self.played_at(mine), at(7))
+        self.assertIsNone(self.played_at(other))
+
+        self.assertEqual(ListeningHistoryService.record_plays(self.user.id, {'a': at(20)}), 1)
+        self.assertEqual(self.played_at(self.track), at(20))
+        # replaying the same history changes nothing
+        self.assertEqual(ListeningHistoryService.record_plays(self.user.id, {'a': at(20), 'b': at(7)}), 0)
+
+    def history(self, *plays):
+        spotify = mock.Mock()
+        spotify.iter_recently_played.return_value = [
+            {'track': {'id': spotify_id}, 'played_at': played_at.isoformat()} for spotify_id, played_at in plays
+        ]
+        return spotify
+
+    def test_ingest_keeps_the_latest_play_and_advances_the_cursor(self):
+        spotify = self.history(('a', at(30)), ('a', at(40)), ('unknown', at(50)))
+
+        self.assertEqual(ListeningHistoryService.ingest(spotify, self.user.id), 1)
+
+        spotify.iter_recently_played.assert_called_once_with(after=0)
+        self.assertEqual(self.played_at(self.track), at(40))
+        self.assertEqual(RecentlyPlayedCursor.objects.get(user=self.user).after, int(at(50).timestamp() * 1000))
+
+    def test_cursor_stays_put_when_storing_the_plays_fails(self):
+        spotify = self.history(('a', at(30)))
+
+        with mock.patch.object(ListeningHistoryService, 'record_plays', side_effect=DatabaseError('down')):
+            with self.assertRaises(DatabaseError):
+                ListeningHistoryService.ingest(spotify, self.user.id)
+        self.assertEqual(RecentlyPlayedCursor.objects.get(user=self.user).after, 0)
+
+        # the next pass asks for the same plays again and stores them
+        self.assertEqual(ListeningHistoryService.ingest(spotify, self.user.id), 1)
+        self.assertEqual(spotify.iter_recently_played.call_args_list, [mock.call(after=0), mock.call(after=0)])
+        self.assertEqual(self.played_at(self.track), at(30))
+
+
+class SpotifySessionTests(SimpleTestCase):
+    def test_one_session_per_process(self):
+        session = get_session()
+        self.assertIs(get_session(), session)
+
+        # a forked worker must not share the parent's pooled sockets
+        with mock.patch('store.services.spotify.os.getpid', return_value=os.getpid() + 1):
+            forked = get_session()
+            self.assertIsNot(forked, session)
+            self.assertIs(get_session(), forked)
+
+
+class IterPagesTests(SimpleTestCase):
+    def setUp(self):
+        self.service = SpotifyService('token')
+        self.service.PAGE_SIZE = 2
+        self.requested = []
+
+    def pages(self, total, with_total=True):
+        def get_page(url, params):
+            if url.startswith('next:'):
+                offset = int(url[5:])
+            else:
+                offset = params['offset']
+            self.requested.append(offset)
+            # later pages answer first, the iterator still has to yield in order
+            time.sleep(0.01 * (total - offset) / total)
+            page = {'items': list(range(offset, min(offset + 2, total)))}
+            if with_total:
+                page['total'] = total
+            page['next'] = f'next:{offset + 2}' if offset + 2 < total else None
+            return page
+        return mock.patch.object(self.service, '_get_page', side_effect=get_page)
+
+    def test_prefetched_pages_are_yielded_in_order(self):
+        with self.pages(9):
+            items = list(self.service._iter_pages('url'))
+
+        self.assertEqual(items, list(range(9)))
+        self.assertEqual(sorted(self.requested), [0, 2, 4, 6, 8])
+
+    def test_stops_at_max_items(self):
+        with self.pages(9):
+            items = list(self.service._iter_pages('url', max_items=5))
+
+        self.assertEqual(items, list(range(5)))
+        self.assertEqual(sorted(self.requested), [0, 2, 4])
+
+    def test_without_a_total_follows_next_links(self):
+        with self.pages(5, with_total=False):
+            items = list(self.service._iter_pages('url', max_items=3))
+
+        self.assertEqual(items, [0, 1, 2])
+        self.assertEqual(self.requested, [0, 2])
+
+    def test_window_bounds_pages_in_flight(self):
+        window = settings.SPOTIFY_HTTP['BATCH_CONCURRENCY']
+        with self.pages(40):
+            pages = self.service._iter_pages('url')
+            next(pages)
+            next(pages)
+            next(pages)
+            pages.close()
+
+        # the first page and one window of prefetches, plus the refill for the page consumed
+        self.assertLessEqual(len(self.requested), 2 + window)
+
+
+class TrackMetadataUpsertTests(TestCase):
+    def fields(self, **fields):
+        # every column, as TrackCreateSerializer passes them
+        return {
+            'spotify_id': 'abc', 'title': 'first', 'artist': 'artist', 'album': 'album',
+            'preview_url': None, 'image_url': 'https://i.example.com/abc', 'release_date': '', **fields
+        }
+
+    def test_inserts_then_returns_the_stored_row(self):
+        created = TrackMetadata.objects.upsert(**self.fields())
+        again = TrackMetadata.objects.upsert(**self.fields(title='second', artist='other', image_url='https://i.example.com/x'))
+
+        self.assertIsNotNone(created.id)
+        self.assertEqual(again.id, created.id)
+        # an existing row is kept as it is
+        self.assertEqual((again.title, again.artist, again.image_url), ('first', 'artist', 'https://i.example.com/abc'))
+        self.assertEqual(TrackMetadata.objects.get(spotify_id='abc').title, 'first')
+        self.assertEqual(TrackMetadata.objects.count(), 1)
+        self.assertFalse(again._state.adding)
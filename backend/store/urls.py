@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from store.views import spotify, auth
+from store.views import spotify, spotify_async, auth, events
 from store.views.track import TrackViewSet
 
 # configure router with trailing slash support
@@ -26,6 +26,23 @@ urlpatterns = [
     path('spotify/playlist-settings/', spotify.playlist_settings, name='spotify_playlist_settings'),
     path('spotify/playlists/create/', spotify.create_playlist, name='spotify_create_playlist'),
     path('spotify/playlists/<str:playlist_id>/tracks/', spotify.add_tracks_to_playlist, name='spotify_add_tracks'),
+    path('spotify/reveal-jobs/', spotify.reveal_jobs, name='spotify_reveal_jobs'),
+    path('spotify/reveal-jobs/<int:job_id>/', spotify.reveal_job_detail, name='spotify_reveal_job_detail'),
     path('spotify/search/', spotify.spotify_search, name='spotify_search'),
     path('spotify/recently-played/', spotify.recently_played, name='spotify_recently_played'),
+    path('spotify/saved-tracks/', spotify.saved_tracks, name='spotify_saved_tracks'),
+    path('spotify/buried-recommendations/', spotify.buried_recommendations, name='spotify_buried_recommendations'),
+    path('spotify/rediscovered/', spotify.rediscovered, name='spotify_rediscovered'),
+    path('spotify/recommendations/unique/', spotify.unique_recommendations, name='spotify_unique_recommendations'),
+    path('spotify/cache-stats/', spotify.cache_stats, name='spotify_cache_stats'),
+    path('spotify/scheduler-stats/', spotify.scheduler_stats, name='spotify_scheduler_stats'),
+
+    # async spotify routes, for deployments served through core/asgi.py
+    path('spotify/async/search/', spotify_async.spotify_search, name='spotify_search_async'),
+    path('spotify/async/recently-played/', spotify_async.recently_played, name='spotify_recently_played_async'),
+    path('spotify/async/playlists/', spotify_async.spotify_playlists, name='spotify_playlists_async'),
+    path('spotify/async/playlists/<str:playlist_id>/tracks/', spotify_async.add_tracks_to_playlist, name='spotify_add_tracks_async'),
+
+    # server-sent vault events, also asgi only
+    path('events/vault/', events.vault_events, name='vault_events'),
 ]
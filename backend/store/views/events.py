@@ -0,0 +1,26 @@
+from django.http import StreamingHttpResponse
+from store.services.events import stream_events
+from store.views.spotify_async import async_methods, get_authenticated_user, not_authenticated_response
+
+@async_methods(['GET'])
+async def vault_events(request):
+    """server-sent events for the user's vault: locked, available, revealed, reverted
+
+    needs the asgi server (core/asgi.py), a reconnect with Last-Event-ID
+    replays what was missed.
+    """
+    user = await get_authenticated_user(request)
+    if not user:
+        return not_authenticated_response()
+
+    # EventSource sends Last-Event-ID itself, the query param is for clients that can't set headers
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    response = StreamingHttpResponse(stream_events(user.id, last_event_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx would otherwise hold events back
+    return response
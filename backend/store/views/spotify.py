@@ -1,20 +1,89 @@
+import json
+from django.http import StreamingHttpResponse
 from django.utils import timezone
 from datetime import timedelta
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.response import Response
 from rest_framework import status
 from django.views.decorators.csrf import ensure_csrf_cookie
 from store.services.spotify import SpotifyService
-from store.models.spotify import SpotifyToken, SpotifyPlaylistSettings
-import requests
-from django.conf import settings
+from store.services.spotify_cache import spotify_cache
+from store.services.scheduler import scheduler, SpotifyRateLimited, SpotifyUnavailable
+from store.services.events import vault_events
+from store.services.vault import vault_versions
+from store.services.recommendations import RecommendationService
+from store.services.reveal import RevealJobService
+from store.services.search import SearchService
+from store.services.track import TrackService
+from store.models.spotify import RevealJob, SpotifyToken, SpotifyPlaylistSettings
 
 SPOTIFY_NOT_CONNECTED_RESPONSE = Response(
     {'detail': 'Spotify not connected'}, 
     status=status.HTTP_403_FORBIDDEN
 )
 
+def spotify_error_response(e, message):
+    """map spotify failures to a response, throttling and outages keep their meaning"""
+    if isinstance(e, SpotifyRateLimited):
+        return Response(
+            {'detail': str(e)},
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            headers={'Retry-After': str(int(e.retry_after) + 1)}
+        )
+    if isinstance(e, SpotifyUnavailable):
+        return Response(
+            {'detail': str(e)},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={'Retry-After': str(int(e.retry_after) + 1)}
+        )
+    return Response(
+        {'detail': f'{message}: {str(e)}'}, 
+        status=status.HTTP_500_INTERNAL_SERVER_ERROR
+    )
+
+def stream_items(items):
+    """stream {"items": [...]} from an iterator without holding the whole list"""
+    items = iter(items)
+    # pull the first item now so spotify errors still become a normal error response
+    first = next(items, None)
+
+    def generate():
+        yield '{"items":['
+        if first is not None:
+            yield json.dumps(first)
+            for item in items:
+                yield ',' + json.dumps(item)
+        yield ']}'
+
+    return StreamingHttpResponse(generate(), content_type='application/json')
+
+def get_max_items(request):
+    # optional cap on streamed listings
+    try:
+        return int(request.GET['max'])
+    except (KeyError, ValueError):
+        return None
+
+def publish_playlist_sync(user_id, changed):
+    # changed is what TrackService.apply_playlist_sync actually moved
+    if changed['revealed']:
+        vault_events.publish(user_id, 'revealed', spotify_ids=changed['revealed'])
+    if changed['reverted']:
+        vault_events.publish(user_id, 'reverted', spotify_ids=changed['reverted'])
+
+def format_recent_track(item):
+    """shape a recently played item for the listening widget"""
+    return {
+        'id': item['track']['id'],
+        'title': item['track']['name'],
+        'artist': item['track']['artists'][0]['name'],
+        'album': item['track']['album']['name'],
+        'image': item['track']['album']['images'][0]['url'] if item['track']['album']['images'] else None,
+        'played_at': item['played_at'],
+        'release_date': item['track']['album']['release_date']
+    }
+
 @api_view(['GET'])
 @permission_classes([AllowAny])  # allow unauthenticated access to get auth url
 def get_auth_url(request):
@@ -73,7 +142,7 @@ def callback(request):
 @permission_classes([IsAuthenticated])
 def connection_status(request):
     # check if user has connected spotify
-    token = SpotifyToken.objects.filter(user=request.user).first()
+    token = request.spotify.token
     
     if not token:
         return Response({'connected': False})
@@ -96,53 +165,44 @@ def connection_status(request):
 @permission_classes([IsAuthenticated])
 def spotify_playlists(request):
     try:
-        token = SpotifyToken.objects.get(user=request.user)
-        if token.is_expired:
-            token.refresh()
-        
-        spotify = SpotifyService(token.access_token)
+        spotify = request.spotify.service
+
+        # ?all=true streams every page instead of just the first
+        if request.GET.get('all') == 'true':
+            return stream_items(spotify.iter_user_playlists(get_max_items(request)))
+
         playlists = spotify.get_user_playlists()
         return Response(playlists)
         
     except SpotifyToken.DoesNotExist:
         return SPOTIFY_NOT_CONNECTED_RESPONSE
     except Exception as e:
-        return Response(
-            {'detail': f'Failed to fetch playlists: {str(e)}'}, 
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
+        return spotify_error_response(e, 'Failed to fetch playlists')
 
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated])
 def spotify_disconnect(request):
     try:
         # get token before deletion
-        token = SpotifyToken.objects.get(user=request.user)
+        token = request.spotify.token
+        if not token:
+            return SPOTIFY_NOT_CONNECTED_RESPONSE
         
         # revoke spotify access
-        requests.post('https://accounts.spotify.com/api/token/revoke', data={
-            'token': token.access_token,
-            'client_id': settings.SPOTIFY_CLIENT_ID,
-            'client_secret': settings.SPOTIFY_CLIENT_SECRET,
-        })
+        SpotifyService(token.access_token).revoke_token()
         
         # delete token from database
         token.delete()
         return Response({'detail': 'Spotify disconnected successfully'})
         
-    except SpotifyToken.DoesNotExist:
-        return SPOTIFY_NOT_CONNECTED_RESPONSE
     except Exception as e:
-        return Response(
-            {'detail': f'Failed to disconnect Spotify: {str(e)}'}, 
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
+        return spotify_error_response(e, 'Failed to disconnect Spotify')
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def spotify_search(request):
     # get search query from request params
-    query = request.GET.get('q')
+    query = request.GET.get('q', '').strip()
     if not query:
         return Response(
             {'detail': 'Search query is required'}, 
@@ -150,87 +210,154 @@ def spotify_search(request):
         )
     
     try:
-        # get spotify token
-        token = SpotifyToken.objects.get(user=request.user)
-        if token.is_expired:
-            token.refresh()
-        
-        # search tracks using spotify service
-        spotify = SpotifyService(token.access_token)
-        results = spotify.search_tracks(query)
-        
-        # format track results
-        tracks = [
-            {
-                'id': 0,  # temporary id since it's not saved yet
-                'metadata': {
-                    'spotify_id': track['id'],
-                    'title': track['name'],
-                    'artist': ', '.join(artist['name'] for artist in track['artists']),
-                    'album': track['album']['name'],
-                    'image_url': track['album']['images'][0]['url'] if track['album']['images'] else '/placeholder-album.jpg',
-                    'preview_url': track['preview_url'],
-                    'release_date': track['album']['release_date']
-                },
-                'status': 'active'  # default status for search results
-            }
-            for track in results['tracks']['items']
-        ]
+        # cached per normalized query, flagged with what's already in the vault
+        tracks = SearchService.search(request.spotify.service, request.user.id, query)
         
         return Response({'tracks': {'items': tracks}})
         
     except SpotifyToken.DoesNotExist:
         return SPOTIFY_NOT_CONNECTED_RESPONSE
     except Exception as e:
-        return Response(
-            {'detail': f'Failed to search tracks: {str(e)}'}, 
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
+        return spotify_error_response(e, 'Failed to search tracks')
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def recently_played(request):
     """get user's recently played tracks"""
     try:
-        token = SpotifyToken.objects.get(user=request.user)
-        if token.is_expired:
-            token.refresh()
-        
-        spotify = SpotifyService(token.access_token)
+        spotify = request.spotify.service
         results = spotify.get_recently_played()
         
         # format track results
-        tracks = [
-            {
-                'id': item['track']['id'],
-                'title': item['track']['name'],
-                'artist': item['track']['artists'][0]['name'],
-                'album': item['track']['album']['name'],
-                'image': item['track']['album']['images'][0]['url'] if item['track']['album']['images'] else None,
-                'played_at': item['played_at'],
-                'release_date': item['track']['album']['release_date']
-            }
-            for item in results['items']
-        ]
+        tracks = [format_recent_track(item) for item in results['items']]
         
         return Response({'tracks': tracks})
         
     except SpotifyToken.DoesNotExist:
         return SPOTIFY_NOT_CONNECTED_RESPONSE
+    except Exception as e:
+        return spotify_error_response(e, 'Failed to fetch recent tracks')
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def saved_tracks(request):
+    """stream the user's saved tracks"""
+    try:
+        spotify = request.spotify.service
+        return stream_items(spotify.iter_saved_tracks(get_max_items(request)))
+
+    except SpotifyToken.DoesNotExist:
+        return SPOTIFY_NOT_CONNECTED_RESPONSE
+    except Exception as e:
+        return spotify_error_response(e, 'Failed to fetch saved tracks')
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def buried_recommendations(request):
+    """saved tracks the user stopped playing plus recommendations, from the precomputed list"""
+    try:
+        result = RecommendationService.get_buried(request.user.id, request.spotify.service)
+
+        # same shape as search results so the ui can vault them directly
+        tracks = [
+            {'id': 0, 'metadata': candidate['metadata'], 'status': 'active', 'source': candidate['source']}
+            for candidate in result['tracks']
+        ]
+        return Response({'tracks': tracks, 'computed_at': result['computed_at']})
+
+    except SpotifyToken.DoesNotExist:
+        return SPOTIFY_NOT_CONNECTED_RESPONSE
+    except Exception as e:
+        return spotify_error_response(e, 'Failed to fetch buried recommendations')
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def unique_recommendations(request):
+    """recommendations that aren't in the vault or recently played"""
+    seeds = [seed for seed in request.GET.get('seed_tracks', '').split(',') if seed][:5]
+    try:
+        limit = int(request.GET['limit'])
+    except (KeyError, ValueError):
+        limit = None
+
+    try:
+        result = RecommendationService.get_unique(request.spotify.service, request.user.id, seeds, limit)
+
+        # same shape as search results so the ui can vault them directly
+        tracks = [{'id': 0, 'metadata': metadata, 'status': 'active'} for metadata in result['tracks']]
+        return Response({'tracks': tracks, 'seeds': result['seeds']})
+
+    except SpotifyToken.DoesNotExist:
+        return SPOTIFY_NOT_CONNECTED_RESPONSE
+    except Exception as e:
+        return spotify_error_response(e, 'Failed to fetch recommendations')
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def rediscovered(request):
+    """revealed tracks the user went back to on spotify, from ingested play history"""
+    if not request.spotify.token:
+        return SPOTIFY_NOT_CONNECTED_RESPONSE
+    try:
+        return Response({'tracks': TrackService.get_rediscovered_tracks(request.user)})
     except Exception as e:
         return Response(
-            {'detail': f'Failed to fetch recent tracks: {str(e)}'}, 
+            {'detail': f'Failed to fetch rediscovered tracks: {str(e)}'},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
+def format_reveal_job(job):
+    return {
+        'id': job.id,
+        'status': job.status,
+        'playlist_id': job.playlist_id,
+        'total': job.total,
+        'revealed': job.revealed,
+        'progress': round(job.revealed / job.total, 3) if job.total else 1.0,
+        'error': job.error or None,
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+    }
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def reveal_jobs(request):
+    """queue a reveal of every available track into the playlist, or poll the latest job"""
+    if request.method == 'GET':
+        job = RevealJob.objects.filter(user=request.user).order_by('-created_at').first()
+        if not job:
+            return Response({'detail': 'No reveal job'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(format_reveal_job(job))
+
+    if not request.spotify.token:
+        return SPOTIFY_NOT_CONNECTED_RESPONSE
+    try:
+        # picked up by the run_reveal_jobs worker
+        job, created = RevealJobService.start(request.user)
+    except SpotifyPlaylistSettings.DoesNotExist:
+        return Response({'detail': 'No playlist selected'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(
+        format_reveal_job(job),
+        status=status.HTTP_202_ACCEPTED if created else status.HTTP_200_OK
+    )
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def reveal_job_detail(request, job_id):
+    """progress of one reveal job"""
+    job = RevealJob.objects.filter(user=request.user, id=job_id).first()
+    if not job:
+        return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(format_reveal_job(job))
+
 @api_view(['GET', 'POST'])
 @permission_classes([IsAuthenticated])
 def playlist_settings(request):
     """get or update playlist settings for recommendations"""
     try:
-        token = SpotifyToken.objects.get(user=request.user)
-        if token.is_expired:
-            token.refresh()
+        if not request.spotify.token:
+            return SPOTIFY_NOT_CONNECTED_RESPONSE
         
         if request.method == 'POST':
             playlist_id = request.data.get('playlist_id')
@@ -271,24 +398,15 @@ def playlist_settings(request):
             'playlist_name': settings.playlist_name
         })
 
-    except SpotifyToken.DoesNotExist:
-        return SPOTIFY_NOT_CONNECTED_RESPONSE
     except Exception as e:
-        return Response(
-            {'detail': f'Failed to manage playlist settings: {str(e)}'}, 
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
+        return spotify_error_response(e, 'Failed to manage playlist settings')
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def create_playlist(request):
     """Create a new playlist for the user."""
     try:
-        token = SpotifyToken.objects.get(user=request.user)
-        if token.is_expired:
-            token.refresh()
-        
-        spotify = SpotifyService(token.access_token)
+        spotify = request.spotify.service
         name = request.data.get('name', 'My Cache Playlist')
         
         # create playlist
@@ -306,61 +424,57 @@ def create_playlist(request):
     except SpotifyToken.DoesNotExist:
         return SPOTIFY_NOT_CONNECTED_RESPONSE
     except Exception as e:
-        return Response(
-            {'detail': f'Failed to create playlist: {str(e)}'}, 
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
+        return spotify_error_response(e, 'Failed to create playlist')
 
-@api_view(['POST', 'DELETE'])
+@api_view(['GET', 'POST', 'PATCH', 'DELETE'])
 @permission_classes([IsAuthenticated])
 def add_tracks_to_playlist(request, playlist_id):
-    """add or remove tracks from a playlist"""
+    """list, add or remove tracks from a playlist"""
     try:
-        token = SpotifyToken.objects.get(user=request.user)
-        if token.is_expired:
-            token.refresh()
-        
-        track_ids = request.data.get('track_ids', [])
-        if not track_ids:
+        if request.method == 'GET':
+            # stream every item in the playlist
+            spotify = request.spotify.service
+            return stream_items(spotify.iter_playlist_tracks(playlist_id, get_max_items(request)))
+
+        # POST adds, DELETE removes, PATCH does both from {"add": [...], "remove": [...]}
+        if request.method == 'PATCH':
+            add = request.data.get('add', [])
+            remove = request.data.get('remove', [])
+        elif request.method == 'POST':
+            add, remove = request.data.get('track_ids', []), []
+        else:
+            add, remove = [], request.data.get('track_ids', [])
+        if not add and not remove:
             return Response(
                 {'detail': 'track_ids are required'}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        spotify = SpotifyService(token.access_token)
+        spotify = request.spotify.service
+        # only what the playlist doesn't already match is sent, in 100 uri chunks
+        result = spotify.sync_playlist(playlist_id, add=add, remove=remove)
         
-        if request.method == 'POST':
-            # add tracks to playlist
-            result = spotify.add_tracks_to_playlist(playlist_id, track_ids)
-            
-            # reveal tracks
-            from store.models.track import Track, TrackMetadata
-            now = timezone.now()
-            Track.objects.filter(
-                user=request.user,
-                metadata__spotify_id__in=track_ids,
-                status__in=['pending', 'available']
-            ).update(status='revealed', revealed_at=now)
-            
-            return Response(result)
-        else:  # DELETE
-            # remove tracks from playlist
-            result = spotify.remove_tracks_from_playlist(playlist_id, track_ids)
-            
-            # revert tracks back to available status
-            from store.models.track import Track, TrackMetadata
-            Track.objects.filter(
-                user=request.user,
-                metadata__spotify_id__in=track_ids,
-                status='revealed'
-            ).update(status='available', revealed_at=None)
-            
-            return Response(result)
+        # reveal added tracks and revert removed ones
+        changed = TrackService.apply_playlist_sync(request.user.id, revealed=add, reverted=remove)
+        if changed['revealed'] or changed['reverted']:
+            vault_versions.bump(request.user.id)
+            publish_playlist_sync(request.user.id, changed)
+        
+        return Response(result)
         
     except SpotifyToken.DoesNotExist:
         return SPOTIFY_NOT_CONNECTED_RESPONSE
     except Exception as e:
-        return Response(
-            {'detail': f'Failed to modify playlist: {str(e)}'}, 
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
+        return spotify_error_response(e, 'Failed to modify playlist')
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def cache_stats(request):
+    """spotify response cache hit/miss counters for this worker process"""
+    return Response(spotify_cache.stats())
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def scheduler_stats(request):
+    """spotify request scheduler metrics for this worker process"""
+    return Response(scheduler.stats())
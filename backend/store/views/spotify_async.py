@@ -0,0 +1,146 @@
+import functools
+import json
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, HttpResponseNotAllowed
+from store.services.spotify_async import AsyncSpotifyService
+from store.services.scheduler import SpotifyRateLimited, SpotifyUnavailable
+from store.services.search import SearchService
+from store.services.track import TrackService
+from store.services.vault import vault_versions
+from store.models.spotify import SpotifyToken
+from store.views.spotify import format_recent_track, publish_playlist_sync
+
+# async versions of the spotify views, so one asgi worker can keep many
+# spotify round trips in flight instead of blocking a thread per call
+
+def not_connected_response():
+    return JsonResponse({'detail': 'Spotify not connected'}, status=403)
+
+def not_authenticated_response():
+    return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=403)
+
+def spotify_error_json(e, message):
+    # same mapping as spotify_error_response in the sync views
+    if isinstance(e, (SpotifyRateLimited, SpotifyUnavailable)):
+        response = JsonResponse(
+            {'detail': str(e)},
+            status=429 if isinstance(e, SpotifyRateLimited) else 503
+        )
+        response['Retry-After'] = str(int(e.retry_after) + 1)
+        return response
+    return JsonResponse({'detail': f'{message}: {str(e)}'}, status=500)
+
+def async_methods(methods):
+    """require_http_methods for coroutine views (django 4.2 only wraps sync views)"""
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            return await view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+@sync_to_async
+def get_authenticated_user(request):
+    # request.user is a lazy session lookup, resolve it off the event loop
+    return request.user if request.user.is_authenticated else None
+
+async def get_spotify(user) -> AsyncSpotifyService:
+    """load the user's token, refreshing it if needed"""
+    token = await SpotifyToken.objects.aget(user=user)
+    return AsyncSpotifyService(await token.aget_valid_access_token(), user_id=user.id)
+
+@async_methods(['GET'])
+async def spotify_search(request):
+    user = await get_authenticated_user(request)
+    if not user:
+        return not_authenticated_response()
+
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'detail': 'Search query is required'}, status=400)
+
+    try:
+        spotify = await get_spotify(user)
+        tracks = await SearchService.asearch(spotify, user.id, query)
+        return JsonResponse({'tracks': {'items': tracks}})
+
+    except SpotifyToken.DoesNotExist:
+        return not_connected_response()
+    except Exception as e:
+        return spotify_error_json(e, 'Failed to search tracks')
+
+@async_methods(['GET'])
+async def recently_played(request):
+    """get user's recently played tracks"""
+    user = await get_authenticated_user(request)
+    if not user:
+        return not_authenticated_response()
+
+    try:
+        spotify = await get_spotify(user)
+        results = await spotify.get_recently_played()
+        tracks = [format_recent_track(item) for item in results['items']]
+        return JsonResponse({'tracks': tracks})
+
+    except SpotifyToken.DoesNotExist:
+        return not_connected_response()
+    except Exception as e:
+        return spotify_error_json(e, 'Failed to fetch recent tracks')
+
+@async_methods(['GET'])
+async def spotify_playlists(request):
+    user = await get_authenticated_user(request)
+    if not user:
+        return not_authenticated_response()
+
+    try:
+        spotify = await get_spotify(user)
+        playlists = await spotify.get_user_playlists()
+        return JsonResponse(playlists)
+
+    except SpotifyToken.DoesNotExist:
+        return not_connected_response()
+    except Exception as e:
+        return spotify_error_json(e, 'Failed to fetch playlists')
+
+@async_methods(['POST', 'PATCH', 'DELETE'])
+async def add_tracks_to_playlist(request, playlist_id):
+    """add or remove tracks from a playlist"""
+    user = await get_authenticated_user(request)
+    if not user:
+        return not_authenticated_response()
+
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'detail': 'Invalid JSON body'}, status=400)
+
+    # POST adds, DELETE removes, PATCH does both from {"add": [...], "remove": [...]}
+    if request.method == 'PATCH':
+        add, remove = data.get('add', []), data.get('remove', [])
+    elif request.method == 'POST':
+        add, remove = data.get('track_ids', []), []
+    else:
+        add, remove = [], data.get('track_ids', [])
+    if not add and not remove:
+        return JsonResponse({'detail': 'track_ids are required'}, status=400)
+
+    try:
+        spotify = await get_spotify(user)
+        # only what the playlist doesn't already match is sent, in 100 uri chunks
+        result = await spotify.sync_playlist(playlist_id, add=add, remove=remove)
+
+        # reveal added tracks and revert removed ones
+        changed = await sync_to_async(TrackService.apply_playlist_sync)(user.id, revealed=add, reverted=remove)
+        if changed['revealed'] or changed['reverted']:
+            await vault_versions.abump(user.id)
+            await sync_to_async(publish_playlist_sync)(user.id, changed)
+
+        return JsonResponse(result)
+
+    except SpotifyToken.DoesNotExist:
+        return not_connected_response()
+    except Exception as e:
+        return spotify_error_json(e, 'Failed to modify playlist')
@@ -1,31 +1,45 @@
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import BrowsableAPIRenderer
 from django.utils import timezone
 from datetime import timedelta
 from django.conf import settings
 
 from store.models.track import TrackMetadata, Track
-from store.models.spotify import SpotifyToken
+from store.pagination import KeysetPagination
+from store.renderers import FastJSONRenderer
+from store.services.backup import VaultBackupService
+from store.services.events import vault_events
+from store.services.track import TrackService
+from store.services.vault import vault_versions
 from store.serializers.track import (
     TrackSerializer,
-    TrackCreateSerializer
+    TrackRowSerializer,
+    TrackCreateSerializer,
+    TrackBulkTransitionSerializer
 )
-from store.services.spotify import SpotifyService
+
+# vault event published for each bulk transition action
+BULK_TRANSITION_EVENTS = {'lock': 'locked', 'reveal': 'revealed', 'make_available': 'available'}
 
 class TrackViewSet(viewsets.ModelViewSet):
     """viewset for managing tracks"""
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination  # opt-in with ?cursor= or ?page_size=
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]  # track payloads hold no floats
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
-        # add spotify service if user has valid token
+        # add spotify service if user has valid token, shared with the rest of the request
         try:
-            token = SpotifyToken.objects.get(user=self.request.user)
-            if token:
-                context['spotify'] = SpotifyService(token.get_valid_access_token())
+            if self.request.spotify.token:
+                context['spotify'] = self.request.spotify.service
         except Exception as e:
             print(f"Error getting spotify token: {str(e)}")
         return context
@@ -35,6 +49,18 @@ class TrackViewSet(viewsets.ModelViewSet):
             return TrackCreateSerializer
         return TrackSerializer
 
+    def get_fields_param(self):
+        """sparse fieldset from ?fields=, None means every field"""
+        if self.action not in ('list', 'retrieve'):
+            return None
+        return TrackSerializer.parse_fields(self.request.query_params.get('fields'))
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_fields_param()
+        if fields is not None:
+            kwargs['fields'] = fields
+        return super().get_serializer(*args, **kwargs)
+
     def get_queryset(self):
         if not self.request.user.is_authenticated:
             return Track.objects.none()
@@ -46,12 +72,20 @@ class TrackViewSet(viewsets.ModelViewSet):
         queryset = Track.objects.filter(user=self.request.user)
         
         if status:
-            queryset = queryset.filter(status=status)
+            # effective status, so due pending tracks already count as available
+            queryset = queryset.with_status(status)
             
-        queryset = queryset.order_by('-created_at')
+        # id breaks ties between tracks created in the same instant
+        queryset = queryset.order_by('-created_at', '-id')
+
+        fields = self.get_fields_param()
+        if fields is None or 'metadata' in fields:
+            queryset = queryset.select_related('metadata')
+        if fields is not None:
+            queryset = queryset.only(*TrackSerializer.columns_for(fields))
         
-        # apply limit if specified
-        if limit:
+        # apply limit if specified, paginated requests use page_size instead
+        if limit and not self.paginator.is_requested(self.request):
             try:
                 limit = int(limit)
                 queryset = queryset[:limit]
@@ -60,6 +94,43 @@ class TrackViewSet(viewsets.ModelViewSet):
                 
         return queryset
 
+    def conditional(self, build):
+        """answer If-None-Match/If-Modified-Since from the vault version, build() only on a miss"""
+        etag, last_modified = vault_versions.validators(self.request.user.id)
+        response = get_conditional_response(self.request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = build()
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        # clients must revalidate, the 304 is what keeps polling cheap
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        """same output as TrackSerializer, built from value rows instead of model instances"""
+        def build():
+            serializer = TrackRowSerializer(self.get_fields_param())
+            queryset = serializer.rows(self.filter_queryset(self.get_queryset()))
+
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                return self.get_paginated_response(serializer.serialize(page))
+            return Response(serializer.serialize(queryset))
+        return self.conditional(build)
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        vault_versions.bump(self.request.user.id, added=[serializer.instance.metadata.spotify_id])
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        vault_versions.bump(self.request.user.id)
+
+    def perform_destroy(self, instance):
+        spotify_id = instance.metadata.spotify_id
+        super().perform_destroy(instance)
+        vault_versions.bump(self.request.user.id, removed=[spotify_id])
+
     @action(detail=True, methods=['post'])
     def lock(self, request, pk=None):
         """lock an active track, changing status to pending"""
@@ -88,6 +159,8 @@ class TrackViewSet(viewsets.ModelViewSet):
         track.locked_at = now
         track.available_at = now + locked_time
         track.save()
+        vault_versions.bump(request.user.id)
+        vault_events.publish(request.user.id, 'locked', track_ids=[track.id])
         
         serializer = self.get_serializer(track)
         return Response(serializer.data)
@@ -105,6 +178,8 @@ class TrackViewSet(viewsets.ModelViewSet):
         track.status = 'revealed'
         track.revealed_at = timezone.now()
         track.save()
+        vault_versions.bump(request.user.id)
+        vault_events.publish(request.user.id, 'revealed', track_ids=[track.id])
         
         serializer = self.get_serializer(track)
         return Response(serializer.data)
@@ -122,29 +197,130 @@ class TrackViewSet(viewsets.ModelViewSet):
         track.status = 'available'
         track.available_at = timezone.now()
         track.save()
+        vault_versions.bump(request.user.id)
+        vault_events.publish(request.user.id, 'available', track_ids=[track.id])
         
         serializer = self.get_serializer(track)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk_create(self, request):
+        """vault many tracks in one call, body is {"tracks": [<track create fields>, ...]}"""
+        items = request.data.get('tracks')
+        if not isinstance(items, list) or not items:
+            return Response(
+                {'detail': 'tracks must be a non-empty list'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(items) > settings.TRACK_SETTINGS['BULK_MAX_ITEMS']:
+            return Response(
+                {'detail': f"At most {settings.TRACK_SETTINGS['BULK_MAX_ITEMS']} tracks per request"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # validate item by item so one bad track doesn't reject the batch
+        results = []
+        valid = []
+        for item in items:
+            serializer = TrackCreateSerializer(data=item)
+            if serializer.is_valid():
+                valid.append(serializer.validated_data)
+                results.append(None)
+            else:
+                results.append({
+                    'spotify_id': item.get('spotify_id') if isinstance(item, dict) else None,
+                    'result': 'invalid',
+                    'errors': serializer.errors,
+                })
+
+        created, added = TrackService.bulk_create(request.user, valid) if valid else ([], [])
+        if added:
+            vault_versions.bump(request.user.id, added=added)
+
+        created = iter(created)
+        results = [result or next(created) for result in results]
+        return Response({'created': len(added), 'results': results})
+
+    @action(detail=False, methods=['post'], url_path='bulk/transition')
+    def bulk_transition(self, request):
+        """lock, reveal or make_available many tracks, body is {"action": ..., "ids": [...]}"""
+        serializer = TrackBulkTransitionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        results, updated = TrackService.bulk_transition(
+            request.user,
+            serializer.validated_data['action'],
+            serializer.validated_data['ids']
+        )
+        if updated:
+            vault_versions.bump(request.user.id)
+            vault_events.publish(
+                request.user.id,
+                BULK_TRANSITION_EVENTS[serializer.validated_data['action']],
+                track_ids=[result['id'] for result in results if 'detail' not in result]
+            )
+        return Response({'updated': updated, 'results': results})
+
     @action(detail=False, methods=['get'])
+    def export(self, request):
+        """stream the whole vault as ndjson, one track per line"""
+        response = StreamingHttpResponse(
+            VaultBackupService.export_lines(request.user.id),
+            content_type='application/x-ndjson'
+        )
+        response['Content-Disposition'] = f'attachment; filename="vault-{request.user.username}.ndjson"'
+        return response
+
+    @action(detail=False, methods=['post'], url_path='import')
+    def import_tracks(self, request):
+        """upsert tracks from an ndjson export in the request body, read line by line"""
+        if request.stream is None:
+            return Response(
+                {'detail': 'Request body must be ndjson, one track per line'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        result = VaultBackupService.import_lines(request.user.id, request.stream)
+        if result['created'] or result['updated']:
+            # membership changed in bulk, let the locked-id index rebuild
+            vault_versions.bump(request.user.id, reindex=True)
+        return Response(result)
+
+    @action(detail=False, methods=['get', 'post'])
     def check(self, request):
-        """check status of tracks by spotify ids"""
-        spotify_ids = request.query_params.get('spotify_ids', '').split(',')
+        """check which spotify ids are in the vault, ids come from ?spotify_ids= or a POST body"""
+        if request.method == 'POST':
+            spotify_ids = request.data.get('spotify_ids', [])
+            if not isinstance(spotify_ids, list) or not all(isinstance(i, str) for i in spotify_ids):
+                return Response(
+                    {'detail': 'spotify_ids must be a list of strings'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        else:
+            spotify_ids = request.query_params.get('spotify_ids', '').split(',')
         if not spotify_ids or spotify_ids[0] == '':
             return Response(
                 {'detail': 'No spotify_ids provided'}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
+        if len(spotify_ids) > settings.TRACK_SETTINGS['CHECK_MAX_IDS']:
+            return Response(
+                {'detail': f"At most {settings.TRACK_SETTINGS['CHECK_MAX_IDS']} spotify_ids per request"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        def build():
+            # set lookups against the cached index, one version read once it's warm
+            vaulted = vault_versions.locked_ids(request.user.id)
             
-        tracks = Track.objects.filter(
-            user=request.user,
-            metadata__spotify_id__in=spotify_ids
-        ).select_related('metadata')
-        
-        # return list of locked track ids
-        locked_ids = [
-            track.metadata.spotify_id 
-            for track in tracks
-        ]
-        
-        return Response({'locked_ids': locked_ids})
\ No newline at end of file
+            # return list of locked track ids, in request order
+            locked_ids = [
+                spotify_id
+                for spotify_id in dict.fromkeys(spotify_ids)
+                if spotify_id in vaulted
+            ]
+            
+            return Response({'locked_ids': locked_ids})
+        if request.method == 'POST':
+            return build()
+        return self.conditional(build)
\ No newline at end of file
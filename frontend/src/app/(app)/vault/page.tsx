@@ -1,7 +1,7 @@
 "use client";
 
 import { useEffect, useState } from "react";
-import { getAllTracks, deleteTrack, onTrackUpdate, makeAvailable } from "@/lib/track";
+import { getAllTracks, deleteTrack, onTrackUpdate, makeAvailable, subscribeVaultEvents } from "@/lib/track";
 import { format, isThisWeek, isThisMonth, subDays, isWithinInterval, differenceInDays, differenceInHours, differenceInMinutes } from "date-fns";
 import { Trash2, CalendarIcon, Undo2 } from "lucide-react";
 import { Button } from "@/components/ui/button";
@@ -251,7 +251,12 @@ export default function VaultPage() {
   useEffect(() => {
     fetchData();
     const unsubscribe = onTrackUpdate(fetchData);
-    return () => unsubscribe();
+    // refetch when the server says something changed instead of polling
+    const closeEvents = subscribeVaultEvents();
+    return () => {
+      unsubscribe();
+      closeEvents();
+    };
   }, []);
 
   // check for tracks that should be available
@@ -86,7 +86,7 @@ export default function TrackSearch() {
     checkStatus();
   }, []);
 
-  // update locked tracks when lock status changes or results update
+  // update locked tracks when lock status changes
   useEffect(() => {
     // only subscribe when dialog is open
     if (!isOpen) return;
@@ -100,8 +100,7 @@ export default function TrackSearch() {
       setLockedTracks(new Set(lockedData.locked_ids));
     };
 
-    // run initial check and subscribe to updates
-    updateLockedTracks();
+    // search results already carry in_vault, only re-check on updates
     const unsubscribe = onTrackUpdate(updateLockedTracks);
     return () => unsubscribe();
   }, [displayResults, isOpen]);
@@ -129,10 +128,14 @@ export default function TrackSearch() {
         const tracks = data.tracks.items;
         setDisplayResults(tracks);
 
-        // check which tracks are already locked
-        const trackIds = tracks.map((t: Track) => t.metadata.spotify_id);
-        const lockedData = await checkTracksStatus(trackIds);
-        setLockedTracks(new Set(lockedData.locked_ids));
+        // results come flagged with what's already locked
+        setLockedTracks(
+          new Set(
+            tracks
+              .filter((t: Track) => t.in_vault)
+              .map((t: Track) => t.metadata.spotify_id)
+          )
+        );
       } catch (error) {
         console.error("search failed:", error);
       } finally {
@@ -30,6 +30,18 @@ export function notifyTrackUpdate() {
     trackUpdateListeners.forEach(listener => listener())
 }
 
+// server-sent vault events, status changes from other tabs or the background
+// workers notify the same listeners a local change does
+export function subscribeVaultEvents() {
+    const source = new EventSource(
+        `${process.env.NEXT_PUBLIC_API_URL}/api/events/vault/`,
+        { withCredentials: true }
+    )
+    const eventTypes = ['locked', 'available', 'revealed', 'reverted', 'reset']
+    eventTypes.forEach(type => source.addEventListener(type, notifyTrackUpdate))
+    return () => source.close()
+}
+
 export async function getTracks(limit: number = 5, status?: string) {
     const url = new URL(`${process.env.NEXT_PUBLIC_API_URL}/api/tracks`);
     url.searchParams.append('limit', limit.toString());
@@ -24,4 +24,5 @@ export interface Track {
   revealed_at?: string;
   created_at: string;
   played_at?: string;
+  in_vault?: boolean; // set on search results
 } 
\ No newline at end of file